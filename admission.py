@@ -0,0 +1,182 @@
+"""Admission control, so that overload is refused early instead of queued until clients time out.
+
+Before a request under /api reaches its route, and all in memory:
+- its client (the subject of its access token once verified, otherwise its address) takes a token
+  from a bucket refilled at ADMISSION_RATE per second and holding up to ADMISSION_BURST; an empty
+  bucket gets 429;
+- its route class (read, write or login) must be under its limit of requests in flight;
+- fewer than ADMISSION_MAX_QUEUE requests may be waiting for a worker thread or a database
+  connection; past that, new requests get 503 at once instead of joining the queue.
+Every rejection carries Retry-After. Other paths, such as /metrics, are never refused.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from anyio.to_thread import current_default_thread_limiter
+
+from config import (ADMISSION_RATE, ADMISSION_BURST, ADMISSION_MAX_CLIENTS, ADMISSION_READ_CONCURRENCY,
+                    ADMISSION_WRITE_CONCURRENCY, ADMISSION_LOGIN_CONCURRENCY, ADMISSION_MAX_QUEUE,
+                    ADMISSION_RETRY_AFTER)
+from db_connector import pool_queue_depth
+from log_config import logger
+from utils import verified_token_subject
+
+LOGIN_PATHS = ("/api/users/login", "/api/users/register")
+EXEMPT_PATHS = ("/api/cache/stats", "/api/db/stats")
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class TokenBuckets:
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_clients=ADMISSION_MAX_CLIENTS,
+                 clock=time.monotonic):
+        """
+            One token bucket per client, created full on the client's first request.
+            Args:
+                rate (float, optional): Tokens added per second; 0 disables rate limiting.
+                burst (float, optional): Tokens a bucket holds at most.
+                max_clients (int, optional): Buckets kept; the least recently used is dropped first.
+                clock (Callable, optional): Time source, replaceable in tests. Defaults to time.monotonic.
+            """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client):
+        """
+            Takes a token from the client's bucket.
+            Args:
+                client (str): The client's key.
+            Returns:
+                float: 0 if a token was taken, otherwise the seconds until the bucket has one.
+            """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class ConcurrencyLimits:
+    def __init__(self, limits):
+        """
+            Counts the requests in flight per route class.
+            Args:
+                limits (dict): The most requests of each class served at once; 0 for no limit.
+            """
+        self.limits = limits
+        self.in_flight = dict.fromkeys(limits, 0)
+        self._lock = threading.Lock()
+
+    def acquire(self, route_class):
+        with self._lock:
+            limit = self.limits[route_class]
+            if 0 < limit <= self.in_flight[route_class]:
+                return False
+            self.in_flight[route_class] += 1
+            return True
+
+    def release(self, route_class):
+        with self._lock:
+            self.in_flight[route_class] -= 1
+
+
+def route_class(method, path):
+    """The class whose limit a request counts against, or None for requests that are always admitted."""
+    if not path.startswith("/api/") or path in EXEMPT_PATHS:
+        return None
+    if path in LOGIN_PATHS:
+        return "login"
+    return "read" if method in READ_METHODS else "write"
+
+
+def queue_depth():
+    """Requests waiting for a worker thread (sync endpoints) or for a database connection."""
+    return current_default_thread_limiter().statistics().tasks_waiting + pool_queue_depth()
+
+
+def rate_limit_key(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            # Only tokens the auth dependency already verified count: decoding here would put the full cost of
+            # checking invalid tokens on the event loop, before any limit applies
+            sub = verified_token_subject(token) if scheme.lower() == "bearer" and token else None
+            if sub is not None:
+                return f"sub:{sub}"
+            break
+    client = scope.get("client")
+    return f"ip:{client[0]}" if client else "ip:unknown"
+
+
+rejections = {"rate_limited": 0, "concurrency": 0, "queue": 0}
+rejections_lock = threading.Lock()
+rate_limits = TokenBuckets()
+concurrency_limits = ConcurrencyLimits({"read": ADMISSION_READ_CONCURRENCY, "write": ADMISSION_WRITE_CONCURRENCY,
+                                        "login": ADMISSION_LOGIN_CONCURRENCY})
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that refuses requests over the rate, concurrency and queue limits."""
+
+    def __init__(self, app, buckets=rate_limits, limits=concurrency_limits, max_queue=ADMISSION_MAX_QUEUE,
+                 current_queue_depth=queue_depth):
+        self.app = app
+        self.buckets = buckets
+        self.limits = limits
+        self.max_queue = max_queue
+        self.current_queue_depth = current_queue_depth
+
+    async def __call__(self, scope, receive, send):
+        request_class = route_class(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if request_class is None:
+            await self.app(scope, receive, send)
+            return
+        wait = self.buckets.take(rate_limit_key(scope))
+        if wait > 0:
+            await self.reject(send, 429, "rate_limited", math.ceil(wait))
+            return
+        if 0 < self.max_queue <= self.current_queue_depth():
+            await self.reject(send, 503, "queue", ADMISSION_RETRY_AFTER)
+            return
+        if not self.limits.acquire(request_class):
+            await self.reject(send, 503, "concurrency", ADMISSION_RETRY_AFTER)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limits.release(request_class)
+
+    @staticmethod
+    async def reject(send, status_code, reason, retry_after):
+        with rejections_lock:
+            rejections[reason] += 1
+        logger.debug("Request refused by admission control: %s", reason)
+        body = b'{"detail":"Too many requests"}' if status_code == 429 else b'{"detail":"Server overloaded"}'
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"retry-after", str(retry_after).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def stats():
+    with concurrency_limits._lock:
+        in_flight = dict(concurrency_limits.in_flight)
+    with rejections_lock:
+        rejected = dict(rejections)
+    return {"in_flight": in_flight, "limits": concurrency_limits.limits, "rejected": rejected}
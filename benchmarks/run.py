@@ -0,0 +1,455 @@
+"""Load test of every endpoint, against the app in-process and over a real socket.
+
+Seeds the database with a configurable number of users and blogs, then runs each endpoint in turn
+for a fixed time with a pool of concurrent asyncio/httpx clients, and reports throughput, latency
+percentiles and the SQL statements and database time per request (from the app's own metrics).
+Results are written as JSON; pass an earlier file with --compare to print the differences.
+
+    python -m benchmarks.run --db sqlite --blogs 10000
+    DB_NAME=benchmark python -m benchmarks.run --db postgres --blogs 1000000 --reseed --mode socket
+
+With --db postgres the database configured by the DB_* settings is used; --reseed drops and
+recreates its tables, so point DB_NAME at a dedicated database. With --db sqlite a local file stands
+in for Postgres; registration (a data-modifying CTE) and the bulk update and delete endpoints (Postgres
+arrays) are skipped there.
+RabbitMQ is never contacted: the outbox relay publishes to a stub connection.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+WORDS = ("garden", "tomato", "python", "database", "travel", "coffee", "music", "cycling", "winter", "recipe",
+         "mountain", "ocean", "history", "camera", "startup", "running", "library", "market", "design", "river")
+
+
+class StubConnection:
+    """Stands in for a pika BlockingConnection and its channel, discarding every message."""
+    is_open = True
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body):
+        pass
+
+    def close(self):
+        pass
+
+
+class Endpoint:
+    def __init__(self, name, method, route, make_request, postgres_only=False, warmup=True):
+        """
+            One benchmarked request type.
+            Args:
+                name (str): The label used in the report.
+                method (str): The HTTP method.
+                route (str): The route template, used to find the route's SQL metrics.
+                make_request (Callable): Given the context and a Random, returns (url, json body, headers),
+                    or None when there is nothing left to request.
+                postgres_only (bool, optional): Skipped when running against SQLite.
+                warmup (bool, optional): False for requests that use up blogs created earlier in the run.
+            """
+        self.name = name
+        self.method = method
+        self.route = route
+        self.make_request = make_request
+        self.postgres_only = postgres_only
+        self.warmup = warmup
+
+
+class Context:
+    def __init__(self, blog_ids, users, headers):
+        """
+            State shared by the requests of a run.
+            Args:
+                blog_ids (list): Ids of the seeded blogs.
+                users (list): (id, email) of users whose password is "benchmark".
+                headers (dict): Sent with every request.
+            """
+        self.blog_ids = blog_ids
+        self.users = users
+        self.headers = headers
+        self.created = []
+        self.etags = {}
+        self.counter = 0
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}-{time.time_ns() % 10 ** 12}"
+
+
+def blog_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def pop_created(ctx, count=1):
+    """Takes ids of blogs created by earlier requests of the run, or None when too few are left."""
+    if len(ctx.created) < count:
+        return None
+    ids = ctx.created[-count:]
+    del ctx.created[-count:]
+    return ids
+
+
+def endpoints(page_size):
+    from utils import encode_cursor
+
+    def blogs_page(ctx, rng, params=""):
+        after = encode_cursor(rng.choice(ctx.blog_ids) - 1)
+        return f"/api/blogs?limit={page_size}&after={after}{params}", None, None
+
+    def blogs_summary_page(ctx, rng):
+        return blogs_page(ctx, rng, "&summary=true")
+
+    def read_blog(ctx, rng):
+        return f"/api/blogs/{rng.choice(ctx.blog_ids)}", None, None
+
+    def read_unchanged_blog(ctx, rng):
+        # Revalidates ETags seen by read_blog; the update endpoints forget those of the blogs they change
+        if not ctx.etags:
+            return None
+        blog_id = rng.choice(tuple(ctx.etags))
+        return f"/api/blogs/{blog_id}", None, {"If-None-Match": ctx.etags[blog_id]}
+
+    def search_blogs(ctx, rng):
+        return f"/api/blogs/search?q={rng.choice(WORDS)}+{rng.choice(WORDS)}&limit=20", None, None
+
+    def popular_blogs(ctx, rng):
+        return "/api/blogs/popular?limit=10", None, None
+
+    def read_user(ctx, rng):
+        return f"/api/users/{rng.choice(ctx.users)[0]}", None, None
+
+    def users_page(ctx, rng):
+        return f"/api/users/?limit={page_size}&after={encode_cursor(rng.choice(ctx.users)[0] - 1)}", None, None
+
+    def new_blog(ctx, rng):
+        return {"topic": ctx.unique("bench"), "data": blog_text(rng, 80)}
+
+    def create_blog(ctx, rng):
+        return "/api/blogs", new_blog(ctx, rng), None
+
+    def updated_blog_id(ctx, rng):
+        blog_id = rng.choice(ctx.blog_ids)
+        ctx.etags.pop(blog_id, None)
+        return blog_id
+
+    def update_blog(ctx, rng):
+        blog_id = updated_blog_id(ctx, rng)
+        return f"/api/blogs/{blog_id}", {"topic": f"updated-{blog_id}", "data": blog_text(rng, 80)}, None
+
+    def delete_blog(ctx, rng):
+        ids = pop_created(ctx)
+        return None if ids is None else (f"/api/blogs/{ids[0]}", None, None)
+
+    def create_blogs(ctx, rng):
+        return "/api/blogs/bulk", [new_blog(ctx, rng) for _ in range(100)], None
+
+    def update_blogs(ctx, rng):
+        blog_ids = {updated_blog_id(ctx, rng) for _ in range(100)}
+        return "/api/blogs/bulk", [{"id": blog_id, "topic": f"updated-{blog_id}", "data": blog_text(rng, 80)}
+                                   for blog_id in blog_ids], None
+
+    def delete_blogs(ctx, rng):
+        ids = pop_created(ctx, 100)
+        return None if ids is None else ("/api/blogs/bulk", ids, None)
+
+    def export_blogs(ctx, rng):
+        return "/api/blogs/export", None, None
+
+    def register(ctx, rng):
+        return "/api/users/register", {"name": "bench", "email": f"{ctx.unique('new')}@bench.example",
+                                       "password": "benchmark"}, None
+
+    def login(ctx, rng):
+        return "/api/users/login", {"email": rng.choice(ctx.users)[1], "password": "benchmark"}, None
+
+    return [
+        Endpoint("GET /api/blogs", "GET", "/api/blogs", blogs_page),
+        Endpoint("GET /api/blogs?summary=true", "GET", "/api/blogs", blogs_summary_page),
+        Endpoint("GET /api/blogs/{blog_id}", "GET", "/api/blogs/{blog_id}", read_blog),
+        Endpoint("GET /api/blogs/{blog_id} (304)", "GET", "/api/blogs/{blog_id}", read_unchanged_blog),
+        Endpoint("GET /api/blogs/search", "GET", "/api/blogs/search", search_blogs),
+        Endpoint("GET /api/blogs/popular", "GET", "/api/blogs/popular", popular_blogs),
+        Endpoint("GET /api/users/{user_id}", "GET", "/api/users/{user_id}", read_user),
+        Endpoint("GET /api/users/", "GET", "/api/users/", users_page),
+        Endpoint("POST /api/blogs", "POST", "/api/blogs", create_blog),
+        Endpoint("PUT /api/blogs/{blog_id}", "PUT", "/api/blogs/{blog_id}", update_blog),
+        Endpoint("DELETE /api/blogs/{blog_id}", "DELETE", "/api/blogs/{blog_id}", delete_blog, warmup=False),
+        Endpoint("POST /api/blogs/bulk", "POST", "/api/blogs/bulk", create_blogs),
+        Endpoint("PUT /api/blogs/bulk", "PUT", "/api/blogs/bulk", update_blogs, postgres_only=True),
+        Endpoint("DELETE /api/blogs/bulk", "DELETE", "/api/blogs/bulk", delete_blogs, postgres_only=True,
+                 warmup=False),
+        Endpoint("GET /api/blogs/export", "GET", "/api/blogs/export", export_blogs),
+        Endpoint("POST /api/users/register", "POST", "/api/users/register", register, postgres_only=True),
+        Endpoint("POST /api/users/login", "POST", "/api/users/login", login),
+    ]
+
+
+def seed(engine, blogs, users, body_words, reseed):
+    """Creates the tables and inserts the users and blogs, unless blogs are already there."""
+    from sqlalchemy import func, insert, select
+
+    from db_connector import Base
+    from models import Blog, User
+    from passwords import password_pool
+
+    if reseed:
+        Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(42)
+    with engine.begin() as connection:
+        if connection.execute(select(func.count()).select_from(Blog)).scalar() == 0:
+            password_hash = password_pool.hash("benchmark")
+            for start in range(0, users, 10000):
+                connection.execute(insert(User), [{"name": f"user{index}", "email": f"user{index}@bench.example",
+                                                   "password": password_hash}
+                                                  for index in range(start, min(start + 10000, users))])
+            for start in range(0, blogs, 10000):
+                connection.execute(insert(Blog), [{"topic": f"seed-{index}", "data": blog_text(rng, body_words)}
+                                                  for index in range(start, min(start + 10000, blogs))])
+        blog_ids = list(connection.execute(select(Blog.id)).scalars())
+        users = [tuple(row) for row in connection.execute(select(User.id, User.email)
+                                                          .where(User.email.like("%@bench.example")))]
+    return blog_ids, users
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def route_totals(method, route):
+    """Requests, SQL statements and database seconds recorded so far for a route by the app's metrics."""
+    import metrics
+
+    for route_metrics in metrics.route_metrics:
+        if route_metrics.labels == f'method="{method}",route="{route}"':
+            with route_metrics._lock:
+                return (sum(route_metrics.latency.counts), route_metrics.statements.sum, route_metrics.db_time.sum)
+    return 0, 0.0, 0.0
+
+
+async def run_endpoint(client, endpoint, ctx, concurrency, duration, warmup):
+    latencies = []
+    statuses = {}
+    rng = random.Random(7)
+
+    async def worker(deadline, record):
+        while time.perf_counter() < deadline:
+            request = endpoint.make_request(ctx, rng)
+            if request is None:
+                return
+            url, body, headers = request
+            started = time.perf_counter()
+            response = await client.request(endpoint.method, url, json=body, headers={**ctx.headers, **(headers or {})})
+            elapsed = time.perf_counter() - started
+            if endpoint.route == "/api/blogs/{blog_id}" and endpoint.method == "GET" and response.status_code == 200:
+                ctx.etags[int(url.rsplit("/", 1)[1])] = response.headers["etag"]
+            elif endpoint.method == "POST" and endpoint.route.startswith("/api/blogs") and response.status_code == 201:
+                created = response.json()
+                ctx.created.extend([created["id"]] if "id" in created else
+                                   [result["id"] for result in created["results"] if result["id"] is not None])
+            if record:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    if warmup > 0 and endpoint.warmup:
+        deadline = time.perf_counter() + warmup
+        await asyncio.gather(*(worker(deadline, False) for _ in range(concurrency)))
+    requests_before, statements_before, db_seconds_before = route_totals(endpoint.method, endpoint.route)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(started + duration, True) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    requests_after, statements_after, db_seconds_after = route_totals(endpoint.method, endpoint.route)
+
+    served = requests_after - requests_before
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status >= 500),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {name: (value * 1000 if value is not None else None) for name, value in (
+            ("p50", percentile(latencies, 0.50)), ("p95", percentile(latencies, 0.95)),
+            ("p99", percentile(latencies, 0.99)), ("max", latencies[-1] if latencies else None),
+            ("mean", sum(latencies) / len(latencies) if latencies else None))},
+        "sql_statements_per_request": (statements_after - statements_before) / served if served else None,
+        "db_ms_per_request": (db_seconds_after - db_seconds_before) * 1000 / served if served else None,
+    }
+
+
+async def run_mode(app, base_url, selected, ctx, args):
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    # In-process, an unhandled exception becomes a 500 as it would behind uvicorn instead of ending the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False) if base_url is None else None
+    async with httpx.AsyncClient(transport=transport, base_url=base_url or "http://benchmark",
+                                 limits=limits, timeout=120) as client:
+        for endpoint in selected:
+            result = await run_endpoint(client, endpoint, ctx, args.concurrency, args.duration, args.warmup)
+            results[endpoint.name] = result
+            latency = result["latency_ms"]
+            print(f"  {endpoint.name:<36} {result['throughput_rps']:>9.1f} req/s  "
+                  f"p50 {format_ms(latency['p50'])}  p95 {format_ms(latency['p95'])}  p99 {format_ms(latency['p99'])}  "
+                  f"sql/req {format_number(result['sql_statements_per_request'])}  errors {result['errors']}")
+    return results
+
+
+def format_ms(value):
+    return f"{value:8.2f}ms" if value is not None else "       -  "
+
+
+def format_number(value):
+    return f"{value:5.1f}" if value is not None else "    -"
+
+
+def serve_on_socket(app):
+    """Runs uvicorn on a free local port in a background thread; returns the base URL and the server."""
+    import uvicorn
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None
+    threading.Thread(target=server.run, name="benchmark-server", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", server
+
+
+def compare(results, baseline):
+    print(f"\nCompared with {baseline['started_at']} ({baseline.get('git_commit')}):")
+    for mode, endpoints_results in results["results"].items():
+        for name, result in endpoints_results.items():
+            before = baseline["results"].get(mode, {}).get(name)
+            if not before or not before["throughput_rps"] or not before["latency_ms"]["p95"]:
+                continue
+            throughput = result["throughput_rps"] / before["throughput_rps"] - 1
+            p95 = (result["latency_ms"]["p95"] or 0) / before["latency_ms"]["p95"] - 1
+            print(f"  {mode:<10} {name:<36} throughput {throughput:+7.1%}  p95 {p95:+7.1%}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", choices=("postgres", "sqlite"), default="sqlite")
+    parser.add_argument("--sqlite-path", default="benchmark.sqlite3")
+    parser.add_argument("--blogs", type=int, default=10000, help="blogs to seed, e.g. 10000, 100000 or 1000000")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--body-words", type=int, default=100, help="words in each seeded blog body")
+    parser.add_argument("--reseed", action="store_true", help="drop and recreate the tables before seeding")
+    parser.add_argument("--mode", choices=("inprocess", "socket", "both"), default="both")
+    parser.add_argument("--async-db", action="store_true", help="serve the async endpoints (Postgres only)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds measured per endpoint")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds of unmeasured requests per endpoint")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--endpoints", help="comma-separated substrings; only matching endpoints are run")
+    parser.add_argument("--output", help="JSON results file. Defaults to benchmarks/results/<timestamp>.json")
+    parser.add_argument("--compare", help="an earlier results file to compare against")
+    args = parser.parse_args()
+    if args.async_db and args.db != "postgres":
+        parser.error("--async-db needs --db postgres")
+
+    # Read by config.py on import, so they must be set first
+    os.environ["OUTBOX_RELAY_WORKERS"] = "0"
+    os.environ["USE_ASYNC_DB"] = "true" if args.async_db else "false"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # All requests come from one client, which would otherwise be rate limited
+    os.environ.setdefault("ADMISSION_RATE", "0")
+
+    import db_connector
+    import main as app_module
+    import metrics
+    from outbox_relay import OutboxRelay
+    from utils import create_access_token
+
+    engine, session_factory = db_connector.engine, db_connector.SessionLocal
+    if args.db == "sqlite":
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.orm import sessionmaker
+
+        engine = create_engine(f"sqlite:///{args.sqlite_path}", connect_args={"check_same_thread": False,
+                                                                               "timeout": 30})
+        event.listen(engine, "connect", lambda connection, _: connection.execute("PRAGMA journal_mode=WAL"))
+        metrics.instrument_engine(engine)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+        def get_sqlite_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app_module.app.dependency_overrides[db_connector.get_db] = get_sqlite_db
+
+    print(f"Seeding {args.blogs} blogs and {args.users} users ({args.db})...")
+    started = time.perf_counter()
+    blog_ids, users = seed(engine, args.blogs, args.users, args.body_words, args.reseed)
+    print(f"  {len(blog_ids)} blogs, {len(users)} users ready in {time.perf_counter() - started:.1f}s")
+
+    relay = OutboxRelay(session_factory=session_factory, connection_factory=StubConnection, poll_interval=0.1)
+    relay.start()
+    ctx = Context(blog_ids, users, {"Authorization": f"Bearer {create_access_token({'sub': str(users[0][0])})}"})
+    selected = [endpoint for endpoint in endpoints(args.page_size)
+                if not (endpoint.postgres_only and args.db == "sqlite")
+                and (not args.endpoints or any(part in endpoint.name for part in args.endpoints.split(",")))]
+
+    results = {"started_at": datetime.now(timezone.utc).isoformat(), "git_commit": git_commit(),
+               "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+               "seeded": {"blogs": len(blog_ids), "users": len(users)}, "results": {}}
+    modes = ("inprocess", "socket") if args.mode == "both" else (args.mode,)
+    try:
+        for mode in modes:
+            print(f"\n{mode} ({args.concurrency} concurrent clients, {args.duration:g}s per endpoint):")
+            if mode == "inprocess":
+                results["results"][mode] = asyncio.run(run_mode(app_module.app, None, selected, ctx, args))
+            else:
+                base_url, server = serve_on_socket(app_module.app)
+                try:
+                    results["results"][mode] = asyncio.run(run_mode(app_module.app, base_url, selected, ctx, args))
+                finally:
+                    server.should_exit = True
+    finally:
+        relay.stop()
+
+    output = args.output or os.path.join(os.path.dirname(__file__), "results",
+                                         f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Read-through cache used by crud.py for single blog and user lookups.
+
+Values are plain dicts of column values so that any backend, including a shared one
+across workers, can store them. The default backend is an in-process LRU with a TTL;
+another backend can be installed with set_backend().
+
+Under several workers, a write only invalidates the in-process cache of the worker that served it.
+crud.py then serves a cached blog only after checking its version against the row, and does not
+cache users at all.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_MAX_SIZE, CACHE_TTL, WEB_CONCURRENCY
+
+
+class CacheBackend:
+    """Interface for cache backends. Subclasses must be safe to call from several threads."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LRUCache(CacheBackend):
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        """
+            Creates an in-process cache.
+            Args:
+                max_size (int, optional): Maximum number of entries before the least recently used is evicted.
+                ttl (float, optional): Seconds an entry stays valid after it is set.
+                clock (Callable, optional): Time source, replaceable in tests. Defaults to time.monotonic.
+            """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Stores a value for `ttl` seconds, or for the cache's default TTL when ttl is None."""
+        with self._lock:
+            self._entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+backend: CacheBackend = LRUCache()
+# Whether every worker uses the backend, so that a write served by any of them invalidates it
+backend_shared = False
+
+
+def set_backend(new_backend: CacheBackend, shared=True):
+    global backend, backend_shared
+    backend, backend_shared = new_backend, shared
+
+
+def coherent():
+    """Whether every write invalidates the cache: all the workers share its backend, or there is only one worker."""
+    return backend_shared or WEB_CONCURRENCY <= 1
+
+
+def get(key):
+    if CACHE_TTL <= 0:
+        return None
+    return backend.get(key)
+
+
+def put(key, value):
+    if CACHE_TTL > 0:
+        backend.set(key, value)
+
+
+def invalidate(key):
+    backend.delete(key)
+
+
+def stats():
+    return backend.stats()
+
+
+def blog_key(id):
+    return f"blog:{id}"
+
+
+def user_key(id):
+    return f"user:{id}"
+
+
+def to_dict(record):
+    """Column values of an ORM record, the form in which records are cached."""
+    return {column.key: getattr(record, column.key) for column in record.__table__.columns}
@@ -0,0 +1,69 @@
+"""gzip compression of responses.
+
+Responses of at least RESPONSE_COMPRESSION_MIN_SIZE bytes are compressed by GZipMiddleware for
+clients that accept gzip. Single blogs are read far more often than they change, so their responses
+are instead serialized and compressed once per version and kept in memory: a hot post is served
+from stored bytes, and GZipMiddleware passes responses that already have a Content-Encoding through.
+"""
+
+import gzip
+
+from cache import LRUCache
+from config import RESPONSE_COMPRESSION_MIN_SIZE, RESPONSE_COMPRESSION_LEVEL, COMPRESSED_BLOG_CACHE_SIZE
+from schemas import BlogOut
+
+# Keyed by id and version, so an entry is never stale; old versions are evicted as they go cold
+compressed_blogs = LRUCache(max_size=COMPRESSED_BLOG_CACHE_SIZE, ttl=float("inf"))
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+        Whether an Accept-Encoding header allows a gzip response (RFC 9110, section 12.5.3).
+        Args:
+            accept_encoding (str): The header value, empty when the header is absent.
+        Returns:
+            bool: True if gzip, or "*" without an explicit gzip entry, has a non-zero weight.
+        """
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip()] = weight
+    return weights.get("gzip", weights.get("x-gzip", weights.get("*", 0.0))) > 0
+
+
+def compress(body: bytes) -> bytes:
+    # A fixed mtime keeps the output identical for identical bodies
+    return gzip.compress(body, compresslevel=RESPONSE_COMPRESSION_LEVEL, mtime=0)
+
+
+def cached_blog(blog_id: int, version: int):
+    """The compressed response of a blog version if it is cached, otherwise None."""
+    if COMPRESSED_BLOG_CACHE_SIZE <= 0:
+        return None
+    return compressed_blogs.get((blog_id, version))
+
+
+def compress_blog(blog_record):
+    """
+        Serializes a blog as its endpoint would and compresses it, caching the result.
+        Args:
+            blog_record (Blog): The blog to serialize.
+        Returns:
+            bytes | None: The gzip-compressed JSON, or None when the blog is too small to be worth compressing.
+        """
+    # Checked on the text first, so small blogs are not serialized twice on every read
+    if len(blog_record.topic) + len(blog_record.data or "") < RESPONSE_COMPRESSION_MIN_SIZE:
+        return None
+    body = BlogOut.model_validate(blog_record).model_dump_json().encode()
+    compressed = compress(body)
+    if COMPRESSED_BLOG_CACHE_SIZE > 0:
+        compressed_blogs.set((blog_record.id, blog_record.version), compressed)
+    return compressed
@@ -1,18 +1,36 @@
+import json
+from types import SimpleNamespace
+
+from sqlalchemy import (ARRAY, BigInteger, Double, Integer, String, and_, any_, bindparam, case, cast, column, delete,
+                        func, literal, literal_column, or_, select, table, true, union_all, update, values)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+import cache
+import revisions
+from config import BULK_CHUNK_SIZE
 from models import *
 
 
-def create_user(db: Session, email, password, name):
-    db_user = User(email=email, password=password, name=name)
-    db.add(db_user)
+def create_user(db: Session, email, password, name, outbox_events=()):
+    """Inserts the user and its outbox events in one statement; returns None if the email is taken."""
+    db_user = db.execute(create_user_statement(email, password, name, outbox_events)).scalars().first()
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 
 def get_user(db: Session, id):
+    # Users have no version to check a cached entry against, so they are only cached where every write invalidates it
+    coherent = cache.coherent()
+    cached = cache.get(cache.user_key(id)) if coherent else None
+    if cached is not None:
+        return User(**cached)
     db_user = db.query(User).filter(User.id == id).first()
+    # A replica may not have replayed the write that last invalidated the entry yet (see replicas.py)
+    if db_user is not None and "replica" not in db.info and coherent:
+        cache.put(cache.user_key(id), cache.to_dict(db_user))
     return db_user
 
 
@@ -21,57 +39,491 @@ def get_user_email(db: Session, email):
     return db_user
 
 
-def get_all_users(db: Session):
-    db_users = db.query(User).all()
-    return db_users
+def get_all_users(db: Session, limit, after=None):
+    # Rows of the listed columns rather than User instances: cheaper to load and never carry the password
+    query = select(User.id, User.email, User.name)
+    if after is not None:
+        query = query.where(User.id > after)
+    return db.execute(query.order_by(User.id).limit(limit)).all()
+
+
+def stream_users(db: Session, batch_size):
+    result = db.execute(select(User.id, User.email, User.name).order_by(User.id)
+                        .execution_options(yield_per=batch_size))
+    yield from result.partitions()
 
 
 def update_user(db: Session, id, name, email, password):
-    db_user: User = db.query(User).filter(User.id == id).first()
-    db_user.name = name
-    db_user.email = email
-    db_user.password = password
+    statement = (update(User).where(User.id == id).values(name=name, email=email, password=password)
+                 .returning(User))
+    db_user = db.execute(statement).scalars().first()
     db.commit()
-    db.refresh(db_user)
+    cache.invalidate(cache.user_key(id))
     return db_user
 
 
+def update_password(db: Session, id, password):
+    db.execute(update(User).where(User.id == id).values(password=password))
+    db.commit()
+    cache.invalidate(cache.user_key(id))
+
+
 def delete_user(db: Session, id):
-    db_user = db.query(User).filter(User.id == id).first()
-    db.delete(db_user)
+    deleted_id = db.execute(delete(User).where(User.id == id).returning(User.id)).scalar()
     db.commit()
-    return True
+    cache.invalidate(cache.user_key(id))
+    return deleted_id is not None
 
 
 def create_blog(db: Session, topic, data):
-    db_blog = Blog(topic=topic, data=data)
-    db.add(db_blog)
+    db_blog = db.execute(insert(Blog).values(topic=topic, data=data).returning(Blog)).scalars().one()
     db.commit()
-    db.refresh(db_blog)
     return db_blog
 
 
 def read_blog(db: Session, id):
+    cached = cache.get(cache.blog_key(id))
+    # Where other workers' writes do not invalidate the cache, an entry is only used while the row has its version
+    if cached is not None and (cache.coherent() or db.execute(blog_version_query(id)).scalar() == cached["version"]):
+        return Blog(**cached)
     db_blog = db.query(Blog).filter(Blog.id == id).first()
+    if db_blog is not None and "replica" not in db.info:
+        cache.put(cache.blog_key(id), cache.to_dict(db_blog))
     return db_blog
 
 
-def read_all_blog(db: Session):
-    db_blogs = db.query(Blog).all()
-    return db_blogs
+def read_blog_validators(db: Session, id):
+    cached = cache.get(cache.blog_key(id)) if cache.coherent() else None
+    if cached is not None:
+        return cached["version"], cached["updated_at"]
+    return db.query(Blog.version, Blog.updated_at).filter(Blog.id == id).first()
+
+
+def blog_version_query(id):
+    return select(Blog.version).where(Blog.id == id)
+
+
+def read_all_blog_validators(db: Session, limit, after=None):
+    query = db.query(Blog.id, Blog.version)
+    if after is not None:
+        query = query.filter(Blog.id > after)
+    return query.order_by(Blog.id).limit(limit).all()
+
+
+def read_all_blog(db: Session, limit, after=None):
+    query = select(*Blog.__table__.columns)
+    if after is not None:
+        query = query.where(Blog.id > after)
+    return db.execute(query.order_by(Blog.id).limit(limit)).all()
+
+
+def read_all_blog_fields(db: Session, fields, limit, after=None):
+    """Selects only the given Blog columns, plus the id, version and updated_at needed for cursors and validators."""
+    columns = [getattr(Blog, name) for name in dict.fromkeys(("id", "version", "updated_at", *fields))]
+    query = select(*columns)
+    if after is not None:
+        query = query.where(Blog.id > after)
+    return db.execute(query.order_by(Blog.id).limit(limit)).all()
+
+
+def stream_blogs(db: Session, batch_size):
+    result = db.execute(select(Blog.id, Blog.topic, Blog.data).order_by(Blog.id)
+                        .execution_options(yield_per=batch_size))
+    yield from result.partitions()
+
+
+def search_blogs(db: Session, q, limit, after=None):
+    statement = search_blogs_statement(db.get_bind().dialect.name, q, limit, after)
+    if statement is None:
+        return []
+    return db.execute(statement).all()
+
+
+def create_blogs(db: Session, blogs):
+    """Inserts (topic, data) pairs in one transaction; returns one result per pair, in order."""
+    created = {}
+    for start in range(0, len(blogs), BULK_CHUNK_SIZE):
+        chunk = blogs[start:start + BULK_CHUNK_SIZE]
+        statement = (insert(Blog).values([{"topic": topic, "data": data} for topic, data in chunk])
+                     .on_conflict_do_nothing(index_elements=[Blog.topic]).returning(Blog.id, Blog.topic))
+        created.update({row.topic: row.id for row in db.execute(statement)})
+    db.commit()
+    return bulk_create_results(blogs, created)
+
+
+def update_blogs(db: Session, blogs, attempts=3):
+    """
+        Updates (id, topic, data) triples in one transaction.
+        Args:
+            db (Session): The database session.
+            blogs (list): The (id, topic, data) triples.
+            attempts (int, optional): How many times the batch is tried. A topic taken by a concurrent write
+                after the owners were read fails the whole transaction, which then starts over and reports
+                the topic as a conflict. The last IntegrityError is raised.
+        Returns:
+            list: One result per triple, in order.
+        """
+    for attempt in range(attempts):
+        try:
+            return try_update_blogs(db, blogs)
+        except IntegrityError:
+            db.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+def try_update_blogs(db: Session, blogs):
+    topics = list({topic for _, topic, _ in blogs})
+    owners_query = select(Blog.topic, Blog.id).where(Blog.topic == any_(array_param(topics, String)))
+    owners = dict(db.execute(owners_query).all())
+    results, rows = bulk_update_plan(blogs, owners)
+    new_data = {blog_id: data for blog_id, _, data in rows}
+    updated = set()
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        replaced = db.execute(bulk_update_statement(rows[start:start + BULK_CHUNK_SIZE])).all()
+        if replaced:
+            db.execute(insert(BlogRevision).values(replaced_revisions(replaced, new_data)))
+        updated.update(row.id for row in replaced)
+    db.commit()
+    return bulk_update_results(results, blogs, updated)
+
+
+def delete_blogs(db: Session, ids):
+    """Deletes blogs by id in one statement; returns one result per id, in order."""
+    statement = delete(Blog).where(Blog.id == any_(array_param(ids, Integer))).returning(Blog.id)
+    deleted = set(db.execute(statement).scalars())
+    db.commit()
+    return bulk_delete_results(ids, deleted)
 
 
 def delete_blog(db: Session, id):
-    db_blog = db.query(Blog).filter(Blog.id == id).first()
-    db.delete(db_blog)
+    deleted_id = db.execute(delete(Blog).where(Blog.id == id).returning(Blog.id)).scalar()
     db.commit()
-    return True
+    cache.invalidate(cache.blog_key(id))
+    return deleted_id is not None
 
 
 def update_blog(db: Session, id, topic, data):
-    db_blog: Blog = db.query(Blog).filter(Blog.id == id).first()
-    db_blog.topic = topic
-    db_blog.data = data
+    """Updates the blog and stores the version it replaces in blog_revisions, in one transaction."""
+    if db.get_bind().dialect.name == "sqlite":
+        replaced = update_blog_sqlite(db, id, topic, data)
+    else:
+        replaced = db.execute(update_blog_statement(id, topic, data)).first()
+    db_blog = None
+    if replaced is not None:
+        db_blog = updated_blog(replaced)
+        db.execute(insert(BlogRevision).values(replaced_revisions([replaced], {id: data})))
     db.commit()
-    db.refresh(db_blog)
+    cache.invalidate(cache.blog_key(id))
     return db_blog
+
+
+def update_blog_sqlite(db: Session, id, topic, data):
+    """
+        update_blog_statement for SQLite, whose RETURNING cannot name the columns of another FROM. The replaced
+        version is read first, and the update only applies if no other write changed the blog in between.
+        """
+    blog = Blog.__table__
+    while True:
+        replaced = db.execute(select(replaced_versions(blog.c.id == id))).first()
+        if replaced is None:
+            return None
+        statement = (update(blog).where(blog.c.id == id, blog.c.version == replaced.old_version)
+                     .values(topic=topic, data=data, version=blog.c.version + 1).returning(*blog.c))
+        updated = db.execute(statement).first()
+        if updated is not None:
+            return SimpleNamespace(**{**replaced._mapping, **updated._mapping})
+
+
+def read_revisions(db: Session, blog_id, limit, after=None):
+    return db.execute(revisions_query(blog_id, limit, after)).all()
+
+
+def read_revision(db: Session, blog_id, revision):
+    chain = db.execute(revision_chain_query(blog_id, revision)).all()
+    return revisions.rebuild(chain, revision)
+
+
+def read_popular_blogs(db: Session, limit):
+    return db.execute(popular_blogs_query(limit)).all()
+
+
+def flush_views(db: Session, counts, top_size):
+    """
+        Adds view counts to blog_views in one statement, and updates popular_blogs in the same transaction.
+        Counts only grow, so a blog can only enter the top when its count changes: only the blogs counted
+        here are ranked, unless fewer than top_size blogs are ranked (e.g. after deletions).
+        Args:
+            db (Session): The database session.
+            counts (dict): Views to add, by blog id; blogs deleted in the meantime are skipped.
+            top_size (int): Blogs kept in popular_blogs.
+        """
+    dialect_name = db.get_bind().dialect.name
+    totals = db.execute(add_views_statement(dialect_name, counts)).all()
+    lowest_ranked = db.execute(select(PopularBlog.views).order_by(PopularBlog.views.desc())
+                               .offset(top_size - 1).limit(1)).scalar()
+    if lowest_ranked is None:
+        # SQLite needs a WHERE clause to tell ON CONFLICT from a join constraint in INSERT ... SELECT
+        ranked = (select(BlogViews.blog_id, BlogViews.views).where(true())
+                  .order_by(BlogViews.views.desc(), BlogViews.blog_id).limit(top_size))
+        statement = upsert(dialect_name, PopularBlog).from_select(["blog_id", "views"], ranked)
+        db.execute(upsert_popular_statement(statement))
+    else:
+        candidates = [{"blog_id": blog_id, "views": views} for blog_id, views in sorted(totals)
+                      if views >= lowest_ranked]
+        if candidates:
+            db.execute(upsert_popular_statement(upsert(dialect_name, PopularBlog).values(candidates)))
+    kept = (select(PopularBlog.blog_id).order_by(PopularBlog.views.desc(), PopularBlog.blog_id).limit(top_size)
+            .scalar_subquery())
+    db.execute(delete(PopularBlog).where(PopularBlog.blog_id.not_in(kept)))
+    db.commit()
+
+
+def claim_outbox_events(db: Session, limit):
+    db_events = (db.query(Outbox).order_by(Outbox.id).limit(limit)
+                 .with_for_update(skip_locked=True).all())
+    return db_events
+
+
+def delete_outbox_events(db: Session, ids):
+    db.query(Outbox).filter(Outbox.id.in_(ids)).delete(synchronize_session=False)
+    db.commit()
+    return True
+
+
+def outbox_backlog(db: Session):
+    """The number of outbox rows waiting to be published, and the age in seconds of the oldest one (0 when none)."""
+    oldest_age = func.extract("epoch", func.now() - func.min(Outbox.created_at))
+    pending, age = db.execute(select(func.count(), func.coalesce(oldest_age, 0))).one()
+    return pending, float(age)
+
+
+def array_param(values, item_type):
+    """Binds a list as a single array parameter, for `column = ANY(:param)`."""
+    return bindparam(None, values, type_=ARRAY(item_type))
+
+
+def bulk_create_results(blogs, created):
+    results = []
+    for topic, _ in blogs:
+        blog_id = created.pop(topic, None)
+        if blog_id is None:
+            results.append({"id": None, "topic": topic, "status": "conflict", "detail": "Topic already exists"})
+        else:
+            results.append({"id": blog_id, "topic": topic, "status": "created"})
+    return results
+
+
+def bulk_update_plan(blogs, owners):
+    """Splits (id, topic, data) triples into per-item results, with None for rows to update, and those rows."""
+    results, rows, claimed_topics, claimed_ids = [], [], set(), set()
+    for blog_id, topic, data in blogs:
+        owner = owners.get(topic)
+        if blog_id in claimed_ids:
+            results.append({"id": blog_id, "topic": topic, "status": "conflict", "detail": "Duplicate id"})
+        elif topic in claimed_topics or (owner is not None and owner != blog_id):
+            results.append({"id": blog_id, "topic": topic, "status": "conflict", "detail": "Topic already exists"})
+        else:
+            claimed_ids.add(blog_id)
+            claimed_topics.add(topic)
+            rows.append((blog_id, topic, data))
+            results.append(None)
+    return results, rows
+
+
+def replaced_versions(condition):
+    """
+        The blog rows an update is about to replace, locked in id order, to join in its FROM so that its
+        RETURNING clause has the replaced versions. Without the lock, the update of a row changed after the
+        statement started would return the version its snapshot saw rather than the one it replaced.
+        """
+    return (select(Blog.id, Blog.topic.label("old_topic"), Blog.data.label("old_data"),
+                   Blog.version.label("old_version"), Blog.updated_at.label("old_updated_at"))
+            .where(condition).order_by(Blog.id).with_for_update().subquery("replaced"))
+
+
+def update_blog_statement(id, topic, data):
+    """UPDATE blog ... FROM replaced RETURNING the columns of the updated blog and the version it replaced."""
+    # On the table: an ORM-enabled update cannot return the columns of another FROM
+    blog = Blog.__table__
+    replaced = replaced_versions(blog.c.id == id)
+    return (update(blog).where(blog.c.id == replaced.c.id)
+            .values(topic=topic, data=data, version=blog.c.version + 1)
+            .returning(*blog.c, *(column for column in replaced.c if column.name != "id")))
+
+
+def updated_blog(row):
+    return Blog(**{column.key: getattr(row, column.key) for column in Blog.__table__.c})
+
+
+def bulk_update_statement(rows):
+    """UPDATE blog ... FROM (VALUES ...), replaced RETURNING id and the replaced versions for (id, topic, data) rows."""
+    new_values = values(column("id", Integer), column("topic", String), column("data", String),
+                        name="new_values").data(rows)
+    blog = Blog.__table__
+    replaced = replaced_versions(blog.c.id == any_(array_param([row[0] for row in rows], Integer)))
+    return (update(blog).where(blog.c.id == new_values.c.id, blog.c.id == replaced.c.id)
+            .values(topic=new_values.c.topic, data=new_values.c.data, version=blog.c.version + 1)
+            .returning(*replaced.c))
+
+
+def replaced_revisions(replaced, new_data):
+    """BlogRevision rows for the versions returned by an update statement, given the new data of each blog id."""
+    return [revisions.past_revision(row.id, row.old_version, row.old_topic, row.old_data, row.old_updated_at,
+                                    new_data[row.id])
+            for row in replaced]
+
+
+def revisions_query(blog_id, limit, after=None):
+    """The current version and the stored revisions of a blog, newest first, without their data."""
+    current = select(Blog.version.label("revision"), Blog.topic, func.length(Blog.data).label("size"),
+                     Blog.updated_at).where(Blog.id == blog_id)
+    past = (select(BlogRevision.revision, BlogRevision.topic, BlogRevision.size, BlogRevision.updated_at)
+            .where(BlogRevision.blog_id == blog_id))
+    listing = union_all(current, past).subquery("listing")
+    query = select(listing)
+    if after is not None:
+        query = query.where(listing.c.revision < after)
+    return query.order_by(listing.c.revision.desc()).limit(limit)
+
+
+def revision_chain_query(blog_id, revision):
+    """
+        The rows revisions.rebuild needs for a revision, newest first. These are the stored revisions from it up
+        to the nearest snapshot above it. If there is no such snapshot, they are all the stored revisions from it
+        on, followed by the current version. Both cases are read in one statement, so a concurrent update cannot
+        leave a gap between them.
+        """
+    nearest_snapshot = (select(func.min(BlogRevision.revision))
+                        .where(BlogRevision.blog_id == blog_id, BlogRevision.revision >= revision,
+                               BlogRevision.snapshot)
+                        .scalar_subquery())
+    past = (select(BlogRevision.revision, BlogRevision.topic, BlogRevision.snapshot, BlogRevision.content,
+                   BlogRevision.updated_at)
+            .where(BlogRevision.blog_id == blog_id, BlogRevision.revision >= revision,
+                   or_(nearest_snapshot.is_(None), BlogRevision.revision <= nearest_snapshot)))
+    current = (select(Blog.version.label("revision"), Blog.topic, true().label("snapshot"),
+                      Blog.data.label("content"), Blog.updated_at)
+               .where(Blog.id == blog_id, Blog.version >= revision, nearest_snapshot.is_(None)))
+    chain = union_all(past, current).subquery("chain")
+    return select(chain).order_by(chain.c.revision.desc())
+
+
+def upsert(dialect_name, model):
+    """An INSERT for the dialect that supports on_conflict_do_update: "postgresql" or "sqlite"."""
+    return (sqlite_insert if dialect_name == "sqlite" else insert)(model)
+
+
+def add_views_statement(dialect_name, counts):
+    """
+        INSERT INTO blog_views ... SELECT FROM (VALUES ...) ON CONFLICT DO UPDATE adding the counts,
+        RETURNING the new totals. Rows are locked in id order, so concurrent flushes cannot deadlock.
+        SQLite cannot name the columns of a VALUES list, so there the counts are a CASE on the blog id.
+        """
+    if dialect_name == "sqlite":
+        rows = (select(Blog.id, case(counts, value=Blog.id)).where(Blog.id.in_(list(counts)))
+                .order_by(Blog.id))
+    else:
+        counted = values(column("blog_id", Integer), column("views", BigInteger),
+                         name="counted").data(sorted(counts.items()))
+        rows = (select(counted.c.blog_id, counted.c.views).join(Blog, Blog.id == counted.c.blog_id)
+                .order_by(counted.c.blog_id))
+    statement = upsert(dialect_name, BlogViews).from_select(["blog_id", "views"], rows)
+    return (statement.on_conflict_do_update(index_elements=[BlogViews.blog_id],
+                                            set_={"views": BlogViews.views + statement.excluded.views})
+            .returning(BlogViews.blog_id, BlogViews.views))
+
+
+def upsert_popular_statement(statement):
+    return statement.on_conflict_do_update(index_elements=[PopularBlog.blog_id],
+                                           set_={"views": statement.excluded.views})
+
+
+def popular_blogs_query(limit):
+    return (select(Blog.id, Blog.topic, Blog.excerpt, PopularBlog.views)
+            .join(PopularBlog, PopularBlog.blog_id == Blog.id)
+            .order_by(PopularBlog.views.desc(), Blog.id).limit(limit))
+
+
+def bulk_update_results(results, blogs, updated):
+    for index, (blog_id, topic, _) in enumerate(blogs):
+        if results[index] is not None:
+            continue
+        if blog_id in updated:
+            cache.invalidate(cache.blog_key(blog_id))
+            results[index] = {"id": blog_id, "topic": topic, "status": "updated"}
+        else:
+            results[index] = {"id": blog_id, "topic": topic, "status": "not_found"}
+    return results
+
+
+def bulk_delete_results(ids, deleted):
+    results = []
+    for blog_id in ids:
+        if blog_id in deleted:
+            cache.invalidate(cache.blog_key(blog_id))
+            results.append({"id": blog_id, "status": "deleted"})
+        else:
+            results.append({"id": blog_id, "status": "not_found"})
+    return results
+
+
+def create_user_statement(email, password, name, outbox_events):
+    """
+        INSERT INTO users ... ON CONFLICT (email) DO NOTHING, with one data-modifying CTE per outbox event
+        that only inserts when the user row was inserted, selecting the new user back as a User entity.
+        """
+    new_user = (insert(User.__table__).values(email=email, password=password, name=name)
+                .on_conflict_do_nothing(index_elements=[User.email])
+                .returning(*User.__table__.columns).cte("new_user"))
+    statement = select(*new_user.c)
+    for index, (queue, payload) in enumerate(outbox_events):
+        event_row = select(literal(queue), literal(json.dumps(payload))).select_from(new_user)
+        statement = statement.add_cte(insert(Outbox.__table__).from_select(["queue", "payload"], event_row)
+                                      .cte(f"new_event_{index}"))
+    # Built from Core tables and mapped afterwards, since ORM-enabled statements drop add_cte() CTEs
+    return select(User).from_statement(statement)
+
+
+def search_blogs_statement(dialect_name, q, limit, after=None):
+    """
+        Ranked full-text search over blog topic and data, ordered by rank then id.
+        Args:
+            dialect_name (str): "postgresql" uses the search_vector column, "sqlite" the blog_fts table.
+            q (str): The user's search text.
+            limit (int): Maximum rows to return.
+            after (tuple | None): The (rank, id) of the last row of the previous page.
+        Returns:
+            Select | None: Rows of (id, topic, rank, snippet), or None when q has no terms.
+        """
+    if not q.split():
+        return None
+    if dialect_name == "sqlite":
+        # Every term quoted, so user input is never parsed as FTS5 query syntax
+        match = " ".join('"%s"' % term.replace('"', '""') for term in q.split())
+        blog_fts = table("blog_fts")
+        ranked = (select(Blog.id, Blog.topic,
+                         (-literal_column("bm25(blog_fts, 10.0, 1.0)")).label("rank"),
+                         literal_column("snippet(blog_fts, 1, '<b>', '</b>', '...', 30)").label("snippet"))
+                  .select_from(blog_fts.join(Blog, literal_column("blog_fts.rowid") == Blog.id))
+                  .where(literal_column("blog_fts").op("MATCH")(match))
+                  .subquery("ranked"))
+    else:
+        query = func.websearch_to_tsquery("english", q)
+        ranked = (select(Blog.id, Blog.topic, Blog.data,
+                         cast(func.ts_rank_cd(blog_search_vector, query), Double).label("rank"))
+                  .where(blog_search_vector.op("@@")(query))
+                  .subquery("ranked"))
+    page = select(ranked)
+    if after is not None:
+        after_rank, after_id = after
+        page = page.where(or_(ranked.c.rank < after_rank, and_(ranked.c.rank == after_rank, ranked.c.id > after_id)))
+    page = page.order_by(ranked.c.rank.desc(), ranked.c.id).limit(limit).subquery("page")
+    if dialect_name == "sqlite":
+        snippet = page.c.snippet
+    else:
+        # Headlines are only generated for the rows of the page, not for every match
+        snippet = func.ts_headline("english", page.c.data, func.websearch_to_tsquery("english", q),
+                                   "MaxFragments=2, MaxWords=30, MinWords=10, StartSel=<b>, StopSel=</b>")
+    return (select(page.c.id, page.c.topic, page.c.rank, snippet.label("snippet"))
+            .order_by(page.c.rank.desc(), page.c.id))
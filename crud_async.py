@@ -0,0 +1,227 @@
+"""Async variants of the functions in crud.py, used when USE_ASYNC_DB is enabled"""
+
+from sqlalchemy import Integer, String, any_, delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import cache
+import revisions
+from config import BULK_CHUNK_SIZE
+from crud import (array_param, blog_version_query, bulk_create_results, bulk_update_plan, bulk_update_statement,
+                  bulk_update_results, bulk_delete_results, create_user_statement, popular_blogs_query,
+                  search_blogs_statement, update_blog_statement, updated_blog, replaced_revisions, revisions_query,
+                  revision_chain_query)
+from models import *
+
+
+async def create_user(db: AsyncSession, email, password, name, outbox_events=()):
+    """Inserts the user and its outbox events in one statement; returns None if the email is taken."""
+    db_user = (await db.execute(create_user_statement(email, password, name, outbox_events))).scalars().first()
+    await db.commit()
+    return db_user
+
+
+async def get_user(db: AsyncSession, id):
+    # Users have no version to check a cached entry against, so they are only cached where every write invalidates it
+    coherent = cache.coherent()
+    cached = cache.get(cache.user_key(id)) if coherent else None
+    if cached is not None:
+        return User(**cached)
+    result = await db.execute(select(User).filter(User.id == id))
+    db_user = result.scalars().first()
+    # A replica may not have replayed the write that last invalidated the entry yet (see replicas.py)
+    if db_user is not None and "replica" not in db.info and coherent:
+        cache.put(cache.user_key(id), cache.to_dict(db_user))
+    return db_user
+
+
+async def get_user_email(db: AsyncSession, email):
+    result = await db.execute(select(User).filter(User.email == email))
+    return result.scalars().first()
+
+
+async def get_all_users(db: AsyncSession, limit, after=None):
+    # Rows of the listed columns rather than User instances: cheaper to load and never carry the password
+    query = select(User.id, User.email, User.name)
+    if after is not None:
+        query = query.where(User.id > after)
+    return (await db.execute(query.order_by(User.id).limit(limit))).all()
+
+
+async def stream_users(db: AsyncSession, batch_size):
+    result = await db.stream(select(User.id, User.email, User.name).order_by(User.id)
+                             .execution_options(yield_per=batch_size))
+    async for partition in result.partitions():
+        yield partition
+
+
+async def update_user(db: AsyncSession, id, name, email, password):
+    statement = (update(User).where(User.id == id).values(name=name, email=email, password=password)
+                 .returning(User))
+    db_user = (await db.execute(statement)).scalars().first()
+    await db.commit()
+    cache.invalidate(cache.user_key(id))
+    return db_user
+
+
+async def update_password(db: AsyncSession, id, password):
+    await db.execute(update(User).where(User.id == id).values(password=password))
+    await db.commit()
+    cache.invalidate(cache.user_key(id))
+
+
+async def delete_user(db: AsyncSession, id):
+    deleted_id = (await db.execute(delete(User).where(User.id == id).returning(User.id))).scalar()
+    await db.commit()
+    cache.invalidate(cache.user_key(id))
+    return deleted_id is not None
+
+
+async def create_blog(db: AsyncSession, topic, data):
+    db_blog = (await db.execute(insert(Blog).values(topic=topic, data=data).returning(Blog))).scalars().one()
+    await db.commit()
+    return db_blog
+
+
+async def read_blog(db: AsyncSession, id):
+    cached = cache.get(cache.blog_key(id))
+    # Where other workers' writes do not invalidate the cache, an entry is only used while the row has its version
+    if cached is not None and (cache.coherent()
+                               or (await db.execute(blog_version_query(id))).scalar() == cached["version"]):
+        return Blog(**cached)
+    result = await db.execute(select(Blog).filter(Blog.id == id))
+    db_blog = result.scalars().first()
+    if db_blog is not None and "replica" not in db.info:
+        cache.put(cache.blog_key(id), cache.to_dict(db_blog))
+    return db_blog
+
+
+async def read_blog_validators(db: AsyncSession, id):
+    cached = cache.get(cache.blog_key(id)) if cache.coherent() else None
+    if cached is not None:
+        return cached["version"], cached["updated_at"]
+    result = await db.execute(select(Blog.version, Blog.updated_at).filter(Blog.id == id))
+    return result.first()
+
+
+async def read_all_blog_validators(db: AsyncSession, limit, after=None):
+    query = select(Blog.id, Blog.version)
+    if after is not None:
+        query = query.filter(Blog.id > after)
+    result = await db.execute(query.order_by(Blog.id).limit(limit))
+    return result.all()
+
+
+async def read_all_blog(db: AsyncSession, limit, after=None):
+    query = select(*Blog.__table__.columns)
+    if after is not None:
+        query = query.where(Blog.id > after)
+    return (await db.execute(query.order_by(Blog.id).limit(limit))).all()
+
+
+async def read_all_blog_fields(db: AsyncSession, fields, limit, after=None):
+    """Selects only the given Blog columns, plus the id, version and updated_at needed for cursors and validators."""
+    columns = [getattr(Blog, name) for name in dict.fromkeys(("id", "version", "updated_at", *fields))]
+    query = select(*columns)
+    if after is not None:
+        query = query.where(Blog.id > after)
+    return (await db.execute(query.order_by(Blog.id).limit(limit))).all()
+
+
+async def stream_blogs(db: AsyncSession, batch_size):
+    result = await db.stream(select(Blog.id, Blog.topic, Blog.data).order_by(Blog.id)
+                             .execution_options(yield_per=batch_size))
+    async for partition in result.partitions():
+        yield partition
+
+
+async def search_blogs(db: AsyncSession, q, limit, after=None):
+    statement = search_blogs_statement(db.get_bind().dialect.name, q, limit, after)
+    if statement is None:
+        return []
+    return (await db.execute(statement)).all()
+
+
+async def read_popular_blogs(db: AsyncSession, limit):
+    return (await db.execute(popular_blogs_query(limit))).all()
+
+
+async def create_blogs(db: AsyncSession, blogs):
+    """Inserts (topic, data) pairs in one transaction; returns one result per pair, in order."""
+    created = {}
+    for start in range(0, len(blogs), BULK_CHUNK_SIZE):
+        chunk = blogs[start:start + BULK_CHUNK_SIZE]
+        statement = (insert(Blog).values([{"topic": topic, "data": data} for topic, data in chunk])
+                     .on_conflict_do_nothing(index_elements=[Blog.topic]).returning(Blog.id, Blog.topic))
+        created.update({row.topic: row.id for row in (await db.execute(statement))})
+    await db.commit()
+    return bulk_create_results(blogs, created)
+
+
+async def update_blogs(db: AsyncSession, blogs, attempts=3):
+    """Async crud.update_blogs: one transaction, started over when a concurrent write takes one of the topics."""
+    for attempt in range(attempts):
+        try:
+            return await try_update_blogs(db, blogs)
+        except IntegrityError:
+            await db.rollback()
+            if attempt == attempts - 1:
+                raise
+
+
+async def try_update_blogs(db: AsyncSession, blogs):
+    topics = list({topic for _, topic, _ in blogs})
+    owners_query = select(Blog.topic, Blog.id).where(Blog.topic == any_(array_param(topics, String)))
+    owners = dict((await db.execute(owners_query)).all())
+    results, rows = bulk_update_plan(blogs, owners)
+    new_data = {blog_id: data for blog_id, _, data in rows}
+    updated = set()
+    for start in range(0, len(rows), BULK_CHUNK_SIZE):
+        replaced = (await db.execute(bulk_update_statement(rows[start:start + BULK_CHUNK_SIZE]))).all()
+        if replaced:
+            revision_rows = await run_in_threadpool(replaced_revisions, replaced, new_data)
+            await db.execute(insert(BlogRevision).values(revision_rows))
+        updated.update(row.id for row in replaced)
+    await db.commit()
+    return bulk_update_results(results, blogs, updated)
+
+
+async def delete_blogs(db: AsyncSession, ids):
+    """Deletes blogs by id in one statement; returns one result per id, in order."""
+    statement = delete(Blog).where(Blog.id == any_(array_param(ids, Integer))).returning(Blog.id)
+    deleted = set((await db.execute(statement)).scalars())
+    await db.commit()
+    return bulk_delete_results(ids, deleted)
+
+
+async def delete_blog(db: AsyncSession, id):
+    deleted_id = (await db.execute(delete(Blog).where(Blog.id == id).returning(Blog.id))).scalar()
+    await db.commit()
+    cache.invalidate(cache.blog_key(id))
+    return deleted_id is not None
+
+
+async def update_blog(db: AsyncSession, id, topic, data):
+    """Updates the blog and stores the version it replaces in blog_revisions, in one transaction."""
+    replaced = (await db.execute(update_blog_statement(id, topic, data))).first()
+    db_blog = None
+    if replaced is not None:
+        db_blog = updated_blog(replaced)
+        # Computing a delta of a large blog would hold up the event loop
+        rows = await run_in_threadpool(replaced_revisions, [replaced], {id: data})
+        await db.execute(insert(BlogRevision).values(rows))
+    await db.commit()
+    cache.invalidate(cache.blog_key(id))
+    return db_blog
+
+
+async def read_revisions(db: AsyncSession, blog_id, limit, after=None):
+    return (await db.execute(revisions_query(blog_id, limit, after))).all()
+
+
+async def read_revision(db: AsyncSession, blog_id, revision):
+    chain = (await db.execute(revision_chain_query(blog_id, revision))).all()
+    return await run_in_threadpool(revisions.rebuild, chain, revision)
+
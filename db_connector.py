@@ -1,23 +1,176 @@
 """This file for connection establishment"""
 
-from sqlalchemy import create_engine
+from uuid import uuid4
+
+from fastapi import Depends, Request, Response
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
 from config import *
+from metrics import instrument_engine
+from pool_metrics import PoolMetrics, instrument, instrumented_pool_class
+from replicas import LAST_WRITE_COOKIE, Replica, ReplicaSet, client_key
 
 # Connection string / URL
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:5432/{DB_NAME}"
+SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+ASYNC_SQLALCHEMY_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+
+
+def pool_sizes(background_work=True):
+    """
+        The size and overflow of the sync and async pools on a database; from DB_CONNECTION_BUDGET when it is
+        set, so that the WEB_CONCURRENCY workers together never open more connections than the budget.
+        Args:
+            background_work (bool, optional): Whether the outbox relays, the view counter, the warm-up and the
+                outbox backlog metrics also use the sync pool.
+        Returns:
+            tuple: (pool_size, max_overflow) of the sync pool, then of the async pool.
+        """
+    if not DB_CONNECTION_BUDGET:
+        return (DB_POOL_SIZE, DB_MAX_OVERFLOW), (DB_POOL_SIZE, DB_MAX_OVERFLOW)
+    share = max(DB_CONNECTION_BUDGET // max(WEB_CONCURRENCY, 1), 1)
+    if not USE_ASYNC_DB:
+        # The async engine is never used
+        return (share, 0), (1, 0)
+    # In async mode the sync pool only serves the background work, which holds a connection per outbox relay, one
+    # for the view counter's flushes, and one for the warm-up, then for the outbox backlog metrics, at most
+    background = OUTBOX_RELAY_WORKERS + 2 if background_work else 0
+    return (max(background, 1), 0), (max(share - background, 1), 0)
+
+
+def engine_options(pool_class, metrics, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW):
+    """
+        Keyword arguments for create_engine / create_async_engine from the DB_POOL_* settings.
+        Args:
+            pool_class (type): The pool class to use when not behind PgBouncer.
+            metrics (PoolMetrics): Where the pool records checkout waits and timeouts.
+            pool_size (int, optional): Connections the pool keeps open.
+            max_overflow (int, optional): Connections opened beyond pool_size under load, and closed when returned.
+        Returns:
+            dict: The engine options.
+        """
+    if DB_PGBOUNCER:
+        # PgBouncer already pools server connections; keeping a second pool here would pin them
+        return {"poolclass": instrumented_pool_class(NullPool, metrics), "pool_pre_ping": DB_POOL_PRE_PING}
+    return {"poolclass": instrumented_pool_class(pool_class, metrics), "pool_size": pool_size,
+            "max_overflow": max_overflow, "pool_timeout": DB_POOL_TIMEOUT, "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING}
+
+
+def create_engines(url, async_url, sizes=None):
+    """
+        Creates the sync and async engines on a database, with instrumented pools.
+        Args:
+            url (str | URL): The database URL for psycopg2.
+            async_url (str | URL): The database URL for asyncpg.
+            sizes (tuple, optional): The pool sizes, as returned by pool_sizes(). Defaults to pool_sizes().
+        Returns:
+            tuple: The engine and its PoolMetrics, then the async engine and its PoolMetrics.
+        """
+    sync_size, async_size = sizes or pool_sizes()
+    metrics = PoolMetrics()
+    sync_engine = create_engine(url, **engine_options(QueuePool, metrics, *sync_size))
+    instrument(sync_engine, metrics)
+    instrument_engine(sync_engine)
+
+    async_metrics = PoolMetrics()
+    async_options = engine_options(AsyncAdaptedQueuePool, async_metrics, *async_size)
+    if DB_PGBOUNCER:
+        # Prepared statements do not survive PgBouncer's transaction pooling, so asyncpg must not cache them
+        async_options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0,
+                                         "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__"}
+    async_engine_ = create_async_engine(async_url, **async_options)
+    instrument(async_engine_.sync_engine, async_metrics)
+    instrument_engine(async_engine_.sync_engine)
+    return sync_engine, metrics, async_engine_, async_metrics
+
+
+# The async engine is used instead of the sync one when USE_ASYNC_DB is enabled
+engine, pool_metrics, async_engine, async_pool_metrics = create_engines(SQLALCHEMY_DATABASE_URL,
+                                                                        ASYNC_SQLALCHEMY_DATABASE_URL)
+# Writes return rows with RETURNING, so they must not be expired (and reloaded) by the commit
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine)
+
+
+def create_replica(url):
+    url = make_url(url)
+    name = f"{url.host}:{url.port or 5432}"
+    replica_engine, metrics, replica_async_engine, async_metrics = create_engines(
+        url.set(drivername="postgresql"), url.set(drivername="postgresql+asyncpg"), pool_sizes(background_work=False))
+    replica_pools.append((name, replica_engine, metrics, replica_async_engine, async_metrics))
+    return Replica(name, replica_engine,
+                   sessionmaker(autocommit=False, autoflush=False, bind=replica_engine, info={"replica": name}),
+                   replica_async_engine,
+                   async_sessionmaker(autoflush=False, bind=replica_async_engine, info={"replica": name}))
+
+
+replica_pools = []
+replica_set = ReplicaSet([create_replica(url) for url in DB_REPLICA_URLS])
+
+
+@event.listens_for(Session, "after_commit")
+def record_write(session):
+    # Sessions from get_db / get_async_db carry the request and response; the async ones commit through a sync
+    # Session too. The client is identified at commit time, once the endpoint has verified its token.
+    request = session.info.get("request")
+    if request is not None:
+        replica_set.record_write(client_key(request), session.info.get("response"))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # for model creations
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
+def pool_stats():
+    stats = {"sync": pool_metrics.stats(engine.pool), "async": async_pool_metrics.stats(async_engine.pool)}
+    for name, replica_engine, metrics, replica_async_engine, async_metrics in replica_pools:
+        stats[f"replica {name} sync"] = metrics.stats(replica_engine.pool)
+        stats[f"replica {name} async"] = async_metrics.stats(replica_async_engine.pool)
+    return stats
+
+
+def pool_queue_depth():
+    """Callers currently waiting for a connection, over every pool."""
+    return (pool_metrics.waiting + async_pool_metrics.waiting
+            + sum(metrics.waiting + async_metrics.waiting for _, _, metrics, _, async_metrics in replica_pools))
+
+
+def get_db(request: Request, response: Response):
+    db = SessionLocal(info={"request": request, "response": response})
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request, primary: Session = Depends(get_db)):
+    """Session for read-only endpoints: on a replica, unless none is healthy or the client wrote recently."""
+    replica = replica_set.replica_for(client_key(request), request.cookies.get(LAST_WRITE_COOKIE))
+    if replica is None:
+        yield primary
+        return
+    db = replica.session_factory()
     try:
         yield db
     finally:
         db.close()
+
+
+async def get_async_db(request: Request, response: Response):
+    async with AsyncSessionLocal(info={"request": request, "response": response}) as db:
+        yield db
+
+
+async def get_async_read_db(request: Request, primary: AsyncSession = Depends(get_async_db)):
+    """Async session for read-only endpoints: on a replica, unless none is healthy or the client wrote recently."""
+    replica = replica_set.replica_for(client_key(request), request.cookies.get(LAST_WRITE_COOKIE))
+    if replica is None:
+        yield primary
+        return
+    async with replica.async_session_factory() as db:
+        yield db
@@ -1,14 +1,14 @@
-import json
+"""Connection to the RabbitMQ broker of the Email Microservice.
+
+Emails are written to the outbox table in the transaction of the change that causes them and
+published by outbox_relay, so request handlers never wait on the broker.
+"""
 
 import pika
 
 from config import *
 
-credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_SERVER, RABBITMQ_PORT, '/', credentials))
-
 
-def send_email(payload):
-    channel = connection.channel()
-    channel.queue_declare(queue='email_queue')
-    channel.basic_publish(exchange='', routing_key='email_queue', body=json.dumps(payload))
+def rabbitmq_connection():
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    return pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_SERVER, RABBITMQ_PORT, '/', credentials))
@@ -0,0 +1,161 @@
+"""Startup warm-up and the readiness probe.
+
+Importing the app opens no connection and no file: engines connect on first use, the outbox
+relays connect to RabbitMQ from their own threads, and app.log is opened by the first record
+written to it. Warm-up then runs in the background once the server has started:
+it creates missing tables, opens DB_POOL_WARM_CONNECTIONS connections in each pool of the active
+mode and runs the hot read queries on each of them, so SQLAlchemy has compiled them and asyncpg has
+prepared them on every connection, and computes the password pool's dummy hash. Until it is done,
+/readyz answers 503 and the load balancer sends no traffic; a failed warm-up, e.g. while the
+database is still starting, is retried with backoff.
+"""
+
+import asyncio
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+import crud
+import crud_async
+import models  # registers the tables on Base
+from config import (USE_ASYNC_DB, DB_PGBOUNCER, DB_POOL_WARM_CONNECTIONS, STARTUP_CREATE_TABLES,
+                    STARTUP_RETRY_MAX_BACKOFF)
+from db_connector import AsyncSessionLocal, Base, SessionLocal, async_engine, engine, replica_set
+from log_config import logger
+from passwords import password_pool
+
+# No row has this id, so the lookups below run their query without loading or caching anything
+MISSING_ID = 0
+
+
+def create_tables():
+    Base.metadata.create_all(bind=engine)
+
+
+def warm_connections(engine):
+    # Without a pool (behind PgBouncer) a connection does not outlive its session: compiling the queries is enough
+    return 1 if DB_PGBOUNCER else max(min(DB_POOL_WARM_CONNECTIONS, engine.pool.size()), 1)
+
+
+def run_hot_queries(db):
+    crud.read_blog(db, MISSING_ID)
+    crud.read_blog_validators(db, MISSING_ID)
+    crud.read_all_blog(db, 1)
+    crud.read_all_blog_validators(db, 1)
+    crud.get_user(db, MISSING_ID)
+    crud.get_all_users(db, 1)
+
+
+async def run_hot_queries_async(db):
+    await crud_async.read_blog(db, MISSING_ID)
+    await crud_async.read_blog_validators(db, MISSING_ID)
+    await crud_async.read_all_blog(db, 1)
+    await crud_async.read_all_blog_validators(db, 1)
+    await crud_async.get_user(db, MISSING_ID)
+    await crud_async.get_all_users(db, 1)
+
+
+def warm_pool(session_factory, connections):
+    """
+        Opens connections in a pool and runs the hot queries on each.
+        Args:
+            session_factory (sessionmaker): Creates sessions on the pool's engine.
+            connections (int): Connections held open at once, and left in the pool afterwards.
+        """
+    sessions = [session_factory() for _ in range(connections)]
+    try:
+        # Each session keeps its connection until closed, so every query runs on a different one
+        for db in sessions:
+            run_hot_queries(db)
+    finally:
+        for db in sessions:
+            db.close()
+
+
+async def warm_async_pool(session_factory, connections):
+    sessions = [session_factory() for _ in range(connections)]
+    try:
+        for db in sessions:
+            await run_hot_queries_async(db)
+    finally:
+        for db in sessions:
+            await db.close()
+
+
+def warm_pools():
+    warm_pool(SessionLocal, warm_connections(engine))
+    for replica in replica_set.replicas:
+        # Reads go to the primary while a replica is down, so it must not hold up readiness
+        try:
+            warm_pool(replica.session_factory, warm_connections(replica.engine))
+        except (SQLAlchemyError, OSError) as error:
+            logger.warning("Could not warm up read replica %s: %s", replica.name, error)
+
+
+async def warm_async_pools():
+    await warm_async_pool(AsyncSessionLocal, warm_connections(async_engine))
+    for replica in replica_set.replicas:
+        try:
+            await warm_async_pool(replica.async_session_factory, warm_connections(replica.async_engine))
+        except (SQLAlchemyError, OSError) as error:
+            logger.warning("Could not warm up read replica %s: %s", replica.name, error)
+
+
+async def warm_up():
+    if STARTUP_CREATE_TABLES:
+        await run_in_threadpool(create_tables)
+    if USE_ASYNC_DB:
+        await warm_async_pools()
+    else:
+        await run_in_threadpool(warm_pools)
+    await run_in_threadpool(password_pool.warm_up)
+
+
+class Readiness:
+    def __init__(self, warm_up=warm_up, max_backoff=STARTUP_RETRY_MAX_BACKOFF):
+        """
+            Tracks whether the process is warm; call start() from a startup handler to warm it up.
+            Args:
+                warm_up (Callable, optional): Coroutine function that warms the process up, retried until it succeeds.
+                max_backoff (float, optional): Upper bound in seconds of the delay between attempts.
+            """
+        self.warm_up = warm_up
+        self.max_backoff = max_backoff
+        self.ready = False
+        self.error = None
+        self._task = None
+
+    def start(self):
+        """Starts warming up on the running event loop, without waiting for it."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self.ready = False
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        started = time.perf_counter()
+        backoff = 0.0
+        while True:
+            try:
+                await self.warm_up()
+                break
+            except Exception as error:
+                # Whatever failed, /readyz must not stay at 503 without a retry or a log line
+                self.error = str(error)
+                backoff = min(max(backoff * 2, 0.5), self.max_backoff)
+                logger.exception("Warm-up failed, retrying in %.1fs", backoff)
+                await asyncio.sleep(backoff)
+        self.ready, self.error = True, None
+        logger.info("Warmed up in %.2fs, ready for traffic", time.perf_counter() - started)
+
+
+readiness = Readiness()
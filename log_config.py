@@ -1,23 +1,114 @@
+"""Logging for the application.
+
+Records are handed to a queue by the request threads and written to the console and app.log by
+a background QueueListener, so file and console I/O never happens on the request path. Each
+record carries the id of the request that logged it, and output is text or JSON (LOG_FORMAT).
+"""
+
+import atexit
+import json
 import logging
+import queue
+import random
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from config import (LOG_LEVEL, LOG_CONSOLE_LEVEL, LOG_FILE, LOG_FILE_LEVEL, LOG_FORMAT, LOG_ASYNC,
+                    LOG_DEBUG_SAMPLE_RATE)
+
+request_id: ContextVar = ContextVar("request_id", default=None)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keeps only a fraction of DEBUG records; records of higher levels are always kept."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
 
-logger = logging.getLogger(__name__)
-file_handler = logging.FileHandler("app.log")
-console_handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-# Create a logger
-logger.setLevel(logging.DEBUG)
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage(), "request_id": getattr(record, "request_id", None)}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
-# Create a file handler and set the log level
-file_handler.setLevel(logging.DEBUG)
 
-# Create a console handler and set the log level
-console_handler.setLevel(logging.DEBUG)
+class InProcessQueueHandler(QueueHandler):
+    """Queues the record as is; the listener thread, not the caller, merges its arguments and formats it."""
 
-# Create a formatter and add it to the handlers
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+    def prepare(self, record):
+        return record
+
+
+class RequestIdMiddleware:
+    """ASGI middleware that tags the logs of a request with its X-Request-ID, generating one if absent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        current_id = incoming if 0 < len(incoming) <= 128 else uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", current_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id.set(current_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
+
+
+def build_handlers():
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(LOG_CONSOLE_LEVEL)
+    handlers = [console_handler]
+    if LOG_FILE:
+        # Opened by the first record rather than at import
+        file_handler = logging.FileHandler(LOG_FILE, delay=True)
+        file_handler.setLevel(LOG_FILE_LEVEL)
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+logger.addFilter(RequestIdFilter())
+if LOG_DEBUG_SAMPLE_RATE < 1:
+    logger.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE))
 
-# Add the handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+if LOG_ASYNC:
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *build_handlers(), respect_handler_level=True)
+    listener.start()
+    # Writes out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    logger.addHandler(InProcessQueueHandler(log_queue))
+else:
+    for log_handler in build_handlers():
+        logger.addHandler(log_handler)
@@ -1,23 +1,45 @@
 from __future__ import annotations
 
-from typing import List
+from typing import List, Optional, Union
 
 import uvicorn
-from fastapi import FastAPI, Response, status, Depends
+from fastapi import APIRouter, Body, FastAPI, Request, Response, status, Depends, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.exc import OperationalError
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
+import admission
+import cache
+import compression
 import crud
+import lifecycle
+import metrics
 import models
-from db_connector import Base, engine
-from db_connector import get_db
-from email_service_client import send_email
-from log_config import logger
-from schemas import LoginSchema, CreateAccount, CreateBlog, UpdateBlog, UpdateUser
-from utils import create_access_token, verify_access_token
-
-app = FastAPI()
+import outbox_relay
+import revisions
+import views
+from passwords import PasswordHashingOverloaded, password_pool
+from db_connector import SessionLocal, pool_stats, replica_set
+from async_routes import router as async_router
+from config import (PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, EXPORT_BATCH_SIZE, BULK_MAX_ITEMS, USE_ASYNC_DB,
+                    OUTBOX_RELAY_WORKERS, RESPONSE_COMPRESSION_MIN_SIZE, RESPONSE_COMPRESSION_LEVEL, METRICS_DIR,
+                    POPULAR_BLOGS_SIZE)
+from db_connector import get_db, get_read_db
+from log_config import RequestIdMiddleware, logger
+from schemas import (LoginSchema, CreateAccount, CreateBlog, UpdateBlog, UpdateUser, BulkUpdateBlog, SuccessResponse,
+                     LoginResponse, RegisterResponse, UserOut, UserPage, BlogOut, CreatedBlog, BlogPage, BlogFieldsPage,
+                     SearchPage, BulkResponse, PopularBlogs, RevisionPage, RevisionOut, RevisionDiff)
+from utils import (create_access_token, verify_access_token, decode_cursor, paginate, ndjson_lines,
+                   blog_etag, gzip_etag, page_etag, validator_headers, is_conditional, is_not_modified, token_cache,
+                   decode_search_cursor, search_page, parse_blog_fields, project, revision_page)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Added first so that it runs inside CORSMiddleware and refused requests still carry CORS headers
+app.add_middleware(admission.AdmissionControlMiddleware)
 
 origins = [
     "http://localhost:3000",  # Add the actual URL of your React app
@@ -30,15 +52,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RequestIdMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=RESPONSE_COMPRESSION_MIN_SIZE,
+                   compresslevel=RESPONSE_COMPRESSION_LEVEL)
+
+# Sync endpoints, served from the threadpool. Replaced by async_routes.router when USE_ASYNC_DB is enabled.
+router = APIRouter()
 
 
-@app.get("/api/test")
+@router.get("/api/test")
 def get_test():
     return [1, 2, 3]
 
 
-@app.post("/api/users/login")
-def user_login(login_schema: LoginSchema, response: Response, db: Session = Depends(get_db)):
+@router.post("/api/users/login", response_model=LoginResponse)
+async def user_login(login_schema: LoginSchema, response: Response, db: Session = Depends(get_db)):
     """
         Endpoint for user login.
         Args:
@@ -47,23 +75,34 @@ def user_login(login_schema: LoginSchema, response: Response, db: Session = Depe
             db (Session, optional): The database session. Defaults to Depends(get_db).
         Returns:
             dict: The login response containing a success flag and a token if login is successful,
-            otherwise returns an error response with a 401 status code.
+            otherwise returns an error response with a 401 status code, or 503 if too many passwords
+            are already waiting to be checked.
         """
-
-    record = crud.get_user_email(db, login_schema.email)
-    if record is not None and login_schema.password == record.password:
+    # Async, so that a login waits for a password worker without holding a threadpool thread
+    record = await run_in_threadpool(crud.get_user_email, db, login_schema.email)
+    # Unknown emails are checked against a dummy hash, so they take as long to reject as wrong passwords
+    stored_hash = record.password if record is not None else None
+    try:
+        valid, new_hash = await password_pool.verify_async(stored_hash, login_schema.password)
+    except PasswordHashingOverloaded:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        logger.warning("Password workers overloaded, rejecting login")
+        return {"success": False, "token": None}
+    if valid:
+        if new_hash is not None:
+            await run_in_threadpool(crud.update_password, db, record.id, new_hash)
         # Login Success
         logger.info("Successful login")
         token = create_access_token({"sub": str(record.id)})
         return {"success": True, "token": token}
     # Login Failure
     response.status_code = status.HTTP_401_UNAUTHORIZED
-    logger.warning("Unauthorized user" + login_schema.email)
+    logger.warning("Unauthorized user %s", login_schema.email)
     return {"success": False, "token": None}
 
 
-@app.post("/api/users/register")
-def user_register(create_user: CreateAccount, response: Response, db: Session = Depends(get_db)):
+@router.post("/api/users/register", response_model=Union[RegisterResponse, SuccessResponse])
+async def user_register(create_user: CreateAccount, response: Response, db: Session = Depends(get_db)):
     """
         Endpoint for user registration.
         Args:
@@ -72,16 +111,15 @@ def user_register(create_user: CreateAccount, response: Response, db: Session =
             db (Session, optional): The database session. Defaults to Depends(get_db).
         Returns:
             dict: The registration response containing the user's name, email, and a success flag,
-            or returns an error response with a 403 status code if the user already exists.
+            or returns an error response with a 403 status code if the user already exists, or 503 if too
+            many passwords are already waiting to be hashed.
         """
-    record = crud.get_user_email(db, create_user.email)
-    if record is not None:
-        response.status_code = status.HTTP_403_FORBIDDEN
-        logger.warning("User exists")
+    try:
+        password_hash = await password_pool.hash_async(create_user.password)
+    except PasswordHashingOverloaded:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        logger.warning("Password workers overloaded, rejecting registration")
         return {"success": False}
-    user_record: models.User = crud.create_user(db, create_user.email, create_user.password, create_user.name)
-    response.status_code = status.HTTP_201_CREATED  # for user creation
-    logger.debug("New User Registered")
     data = {
         "template_data": {"name": create_user.name,
                           "country": "Delhi"
@@ -89,80 +127,127 @@ def user_register(create_user: CreateAccount, response: Response, db: Session =
         "email": create_user.email,
         "type": "register_user"
     }
-    # Send email message in RabbitMQ for Email Microservice
-    send_email(payload=data)
+    # Email message for the Email Microservice, inserted with the user (only if the email is new)
+    # in a single statement and published by outbox_relay
+    user_record: models.User = await run_in_threadpool(crud.create_user, db, create_user.email, password_hash,
+                                                       create_user.name, outbox_events=[("email_queue", data)])
+    if user_record is None:
+        response.status_code = status.HTTP_403_FORBIDDEN
+        logger.warning("User exists")
+        return {"success": False}
+    response.status_code = status.HTTP_201_CREATED  # for user creation
+    logger.debug("New User Registered")
     return {"name": user_record.name, "email": user_record.email, "id": user_record.id, "success": True}
 
 
-@app.get("/api/users/{user_id}")
-def get_user(user_id: int, db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.get("/api/users/export")
+def export_users(db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to stream every user record as newline-delimited JSON.
+        Args:
+            db (Session, optional): The database session. Defaults to Depends(get_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            StreamingResponse: One JSON object per line with the user's id, email and name.
+        """
+    logger.debug("Exporting user records")
+    return StreamingResponse(ndjson_lines(crud.stream_users(db, EXPORT_BATCH_SIZE)),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/api/users/{user_id}", response_model=Optional[UserOut])
+def get_user(user_id: int, db: Session = Depends(get_read_db), token_verification=Depends(verify_access_token)):
     """
         Endpoint to retrieve user data by user ID.
         Args:
             user_id (int): The ID of the user to retrieve.
-            db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
             models.User: The user data for the specified user ID.
         """
     user_record: models.User = crud.get_user(db, user_id)
-    logger.debug("User data fetched" + str(user_id))
+    logger.debug("User data fetched %s", user_id)
     return user_record
 
 
-@app.get("/api/users/")
-def get_all_users(db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.get("/api/users/", response_model=UserPage)
+def get_all_users(limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None,
+                  db: Session = Depends(get_read_db), token_verification=Depends(verify_access_token)):
     """
-        Endpoint to retrieve all user records.
+        Endpoint to retrieve user records one page at a time, ordered by id.
         Args:
-            db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            limit (int, optional): The page size. Defaults to PAGE_SIZE_DEFAULT, capped at PAGE_SIZE_MAX.
+            after (Optional[str], optional): The `next_cursor` of the previous page. Defaults to None.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            List[models.User]: A list of all user records.
+            dict: The page of user records and the cursor of the next page.
         """
-    users_records: List[models.User] = crud.get_all_users(db)
-    logger.debug("All user records fetched")
-    return users_records
+    users_records: List[models.User] = crud.get_all_users(db, limit + 1, decode_cursor(after))
+    logger.debug("User records page fetched")
+    return paginate(users_records, limit)
 
 
-@app.put("/api/users/{user_id}")
-def update_user(user_id, update_user_payload: UpdateUser, db: Session = Depends(get_db),
-                token_verification=Depends(verify_access_token)):
+@router.put("/api/users/{user_id}", response_model=Union[UserOut, SuccessResponse])
+async def update_user(user_id: int, update_user_payload: UpdateUser, response: Response,
+                      db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
     """
         Endpoint to update user data by user ID.
         Args:
             user_id (int): The ID of the user to update.
             update_user_payload (UpdateUser): The payload containing the updated user data.
+            response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            models.User: The updated user data.
+            models.User: The updated user data, or an error response with a 404 status code if the user
+            does not exist, a 409 status code if the email belongs to another user, or 503 if too many
+            passwords are already waiting to be hashed.
         """
-    updated_user = crud.update_user(db, user_id, email=update_user_payload.email, name=update_user_payload.name,
-                                    password=update_user_payload.password)
-    logger.info("user date updated: " + str(user_id))
+    try:
+        password_hash = await password_pool.hash_async(update_user_payload.password)
+    except PasswordHashingOverloaded:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        logger.warning("Password workers overloaded, rejecting user update")
+        return {"success": False}
+    try:
+        updated_user = await run_in_threadpool(crud.update_user, db, user_id, email=update_user_payload.email,
+                                               name=update_user_payload.name, password=password_hash)
+    except IntegrityError:
+        response.status_code = status.HTTP_409_CONFLICT
+        logger.warning("Email already in use")
+        return {"success": False}
+    if updated_user is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
+    logger.info("User data updated %s", user_id)
     return updated_user
 
 
-@app.delete("/api/users/{user_id}")
-def delete_user(user_id, db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.delete("/api/users/{user_id}", response_model=SuccessResponse)
+def delete_user(user_id: int, response: Response, db: Session = Depends(get_db),
+                token_verification=Depends(verify_access_token)):
     """
         Endpoint to delete a user by user ID.
         Args:
             user_id (int): The ID of the user to delete.
+            response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            dict: A response indicating the success of the deletion.
-
+            dict: A response indicating the success of the deletion, with a 404 status code if the user
+            does not exist.
         """
-    crud.delete_user(db, user_id)
+    if not crud.delete_user(db, user_id):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
     response = {"success": True}
-    logger.debug("User Deleted " + str(user_id))
+    logger.debug("User deleted %s", user_id)
     return response
 
 
-@app.post("/api/blogs")
+@router.post("/api/blogs", response_model=Union[CreatedBlog, SuccessResponse])
 def create_blog(create_blog_payload: CreateBlog, response: Response, db: Session = Depends(get_db),
                 token_verification=Depends(verify_access_token)):
     """
@@ -171,11 +256,17 @@ def create_blog(create_blog_payload: CreateBlog, response: Response, db: Session
             create_blog_payload (CreateBlog): The payload containing the blog details.
             response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            dict: The response containing the created blog details.
+            dict: The response containing the created blog details, or an error response with a 409
+            status code if the topic already exists.
         """
-    blog_record: models.Blog = crud.create_blog(db, create_blog_payload.topic, create_blog_payload.data)
+    try:
+        blog_record: models.Blog = crud.create_blog(db, create_blog_payload.topic, create_blog_payload.data)
+    except IntegrityError:
+        response.status_code = status.HTTP_409_CONFLICT
+        logger.warning("Blog topic already exists")
+        return {"success": False}
     response.status_code = status.HTTP_201_CREATED
     response = {
         "id": blog_record.id,
@@ -185,80 +276,486 @@ def create_blog(create_blog_payload: CreateBlog, response: Response, db: Session
     return response
 
 
-@app.get("/api/blogs/{blog_id}")
-def read_blog(blog_id: int, db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.post("/api/blogs/bulk", response_model=BulkResponse, response_model_exclude_unset=True)
+def create_blogs(response: Response,
+                 create_blogs_payload: List[CreateBlog] = Body(min_length=1, max_length=BULK_MAX_ITEMS),
+                 db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
     """
-        Endpoint to read a blog by blog ID.
+        Endpoint to create many blogs in one transaction.
         Args:
-            blog_id (int): The ID of the blog to read.
+            create_blogs_payload (List[CreateBlog]): The blogs to create, at most BULK_MAX_ITEMS.
+            response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            dict: The response containing the retrieved blog details.
+            dict: A success flag and one result per blog, in order, with status "created" or "conflict";
+            with a 201 status code if any blog was created, 200 otherwise.
         """
+    results = crud.create_blogs(db, [(blog.topic, blog.data) for blog in create_blogs_payload])
+    if any(result["status"] == "created" for result in results):
+        response.status_code = status.HTTP_201_CREATED
+    logger.info("Bulk created %d blogs", sum(result["status"] == "created" for result in results))
+    return {"success": all(result["status"] == "created" for result in results), "results": results}
+
+
+@router.put("/api/blogs/bulk", response_model=BulkResponse, response_model_exclude_unset=True)
+def update_blogs(response: Response,
+                 update_blogs_payload: List[BulkUpdateBlog] = Body(min_length=1, max_length=BULK_MAX_ITEMS),
+                 db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to update many blogs in one transaction.
+        Args:
+            update_blogs_payload (List[BulkUpdateBlog]): The blogs to update, each with its id, at most BULK_MAX_ITEMS.
+            response (Response): The HTTP response object.
+            db (Session, optional): The database session. Defaults to Depends(get_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: A success flag and one result per blog, in order, with status "updated", "conflict" or "not_found",
+            or an error response with a 409 status code if concurrent writes kept taking the topics.
+        """
+    try:
+        results = crud.update_blogs(db, [(blog.id, blog.topic, blog.data) for blog in update_blogs_payload])
+    except IntegrityError:
+        response.status_code = status.HTTP_409_CONFLICT
+        logger.warning("Bulk update kept conflicting with concurrent writes")
+        return {"success": False, "results": []}
+    logger.info("Bulk updated %d blogs", sum(result["status"] == "updated" for result in results))
+    return {"success": all(result["status"] == "updated" for result in results), "results": results}
+
+
+@router.delete("/api/blogs/bulk", response_model=BulkResponse, response_model_exclude_unset=True)
+def delete_blogs(delete_blogs_payload: List[int] = Body(min_length=1, max_length=BULK_MAX_ITEMS),
+                 db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to delete many blogs in one statement.
+        Args:
+            delete_blogs_payload (List[int]): The ids of the blogs to delete, at most BULK_MAX_ITEMS.
+            db (Session, optional): The database session. Defaults to Depends(get_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: A success flag and one result per id, in order, with status "deleted" or "not_found".
+        """
+    results = crud.delete_blogs(db, delete_blogs_payload)
+    logger.info("Bulk deleted %d blogs", sum(result["status"] == "deleted" for result in results))
+    return {"success": all(result["status"] == "deleted" for result in results), "results": results}
+
+
+@router.get("/api/blogs/export")
+def export_blogs(db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to stream every blog record as newline-delimited JSON.
+        Args:
+            db (Session, optional): The database session. Defaults to Depends(get_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            StreamingResponse: One JSON object per line with the blog's id, topic and data.
+        """
+    logger.debug("Exporting blog records")
+    return StreamingResponse(ndjson_lines(crud.stream_blogs(db, EXPORT_BATCH_SIZE)),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/api/blogs/search", response_model=SearchPage)
+def search_blogs(q: str = Query(min_length=1, max_length=200),
+                 limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None,
+                 db: Session = Depends(get_read_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to full-text search blog topics and data, best matches first.
+        Args:
+            q (str): The search text; words are matched against stemmed topic and data terms.
+            limit (int, optional): The page size. Defaults to PAGE_SIZE_DEFAULT, capped at PAGE_SIZE_MAX.
+            after (Optional[str], optional): The `next_cursor` of the previous page. Defaults to None.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The page of matches, each with its id, topic, rank and a highlighted snippet, and the
+            cursor of the next page.
+        """
+    after_rank = decode_search_cursor(after)
+    rows = crud.search_blogs(db, q, limit + 1, after_rank)
+    logger.debug("Searched blogs")
+    return search_page(rows, limit)
+
+
+@router.get("/api/blogs/popular", response_model=PopularBlogs)
+def read_popular_blogs(limit: int = Query(10, ge=1, le=POPULAR_BLOGS_SIZE), db: Session = Depends(get_read_db),
+                       token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to list the most viewed blogs, from the ranking updated by each flush of the view counts.
+        Args:
+            limit (int, optional): The number of blogs. Defaults to 10, capped at POPULAR_BLOGS_SIZE.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The blogs with their id, topic, excerpt and view count, most viewed first.
+        """
+    rows = crud.read_popular_blogs(db, limit)
+    logger.debug("Read popular blogs")
+    return {"items": [row._asdict() for row in rows]}
+
+
+@router.get("/api/blogs/{blog_id}", response_model=Optional[BlogOut])
+def read_blog(blog_id: int, request: Request, response: Response, db: Session = Depends(get_read_db),
+              token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to read a blog by blog ID, answering conditional requests with 304 Not Modified.
+        Args:
+            blog_id (int): The ID of the blog to read.
+            request (Request): The HTTP request, checked for If-None-Match / If-Modified-Since and Accept-Encoding.
+            response (Response): The HTTP response object.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The response containing the retrieved blog details, with ETag and Last-Modified headers;
+            served as cached gzip bytes, with the ETag suffixed "-gz", when the client accepts gzip and the
+            blog is large.
+        """
+    if is_conditional(request):
+        # Only the version and timestamp are loaded to evaluate the condition, never the body
+        validators = crud.read_blog_validators(db, blog_id)
+        if validators is not None:
+            version, updated_at = validators
+            etag = blog_etag(blog_id, version)
+            if is_not_modified(request, etag, updated_at):
+                views.view_counter.record(blog_id)
+                if gzip_etag(etag) in request.headers.get("if-none-match", ""):
+                    etag = gzip_etag(etag)
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED,
+                                headers={**validator_headers(etag, updated_at), "Vary": "Accept-Encoding"})
     blog_record: models.Blog = crud.read_blog(db, blog_id)
-    logger.debug("Read Blog" + str(blog_id))
+    if blog_record is not None:
+        views.view_counter.record(blog_id)
+        headers = {**validator_headers(blog_etag(blog_id, blog_record.version), blog_record.updated_at),
+                   "Vary": "Accept-Encoding"}
+        if compression.accepts_gzip(request.headers.get("accept-encoding", "")):
+            body = (compression.cached_blog(blog_id, blog_record.version)
+                    or compression.compress_blog(blog_record))
+            if body is not None:
+                logger.debug("Read blog %s, compressed", blog_id)
+                return Response(body, media_type="application/json",
+                                headers={**headers, "ETag": gzip_etag(headers["ETag"]), "Content-Encoding": "gzip"})
+        response.headers.update(headers)
+    logger.debug("Read blog %s", blog_id)
     return blog_record
 
 
-@app.get("/api/blogs")
-def read_all_blogs(db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.get("/api/blogs", response_model=Union[BlogPage, BlogFieldsPage])
+def read_all_blogs(request: Request, response: Response,
+                   limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None,
+                   fields: Optional[str] = None, summary: bool = False,
+                   db: Session = Depends(get_read_db), token_verification=Depends(verify_access_token)):
     """
-        Endpoint to read all blogs.
+        Endpoint to read blogs one page at a time, ordered by id, answering If-None-Match with 304.
         Args:
-            db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            request (Request): The HTTP request, checked for If-None-Match.
+            response (Response): The HTTP response object.
+            limit (int, optional): The page size. Defaults to PAGE_SIZE_DEFAULT, capped at PAGE_SIZE_MAX.
+            after (Optional[str], optional): The `next_cursor` of the previous page. Defaults to None.
+            fields (Optional[str], optional): Comma-separated fields to return instead of whole records, e.g.
+                "id,topic,excerpt". Only those columns are read from the database. Defaults to None.
+            summary (bool, optional): Shorthand for fields=id,topic,excerpt. Defaults to False.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            List[models.Blog]: A list of all blog records.
+            dict: The page of blog records (or of their selected fields) and the cursor of the next page,
+            with an ETag header. There is no Last-Modified: deleting a row changes a page without
+            changing the latest updated_at on it.
         """
-    blog_records: List[models.Blog] = crud.read_all_blog(db)
-    logger.debug("Read all blogs")
-    return blog_records
+    after_id = decode_cursor(after)
+    selected = parse_blog_fields(fields, summary)
+    variant = ",".join(selected) if selected else ""
+    if "if-none-match" in request.headers:
+        validators = crud.read_all_blog_validators(db, limit + 1, after_id)
+        etag = page_etag(validators, variant)
+        if is_not_modified(request, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    if selected is None:
+        blog_records: List[models.Blog] = crud.read_all_blog(db, limit + 1, after_id)
+    else:
+        blog_records = crud.read_all_blog_fields(db, selected, limit + 1, after_id)
+    response.headers["ETag"] = page_etag(blog_records, variant)
+    logger.debug("Read blogs page")
+    page = paginate(blog_records, limit)
+    if selected is not None:
+        page["items"] = project(page["items"], selected)
+    return page
+
+
+@router.get("/api/blogs/{blog_id}/revisions", response_model=Union[RevisionPage, SuccessResponse])
+def read_blog_revisions(blog_id: int, response: Response,
+                        limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX), after: Optional[str] = None,
+                        db: Session = Depends(get_read_db), token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to list the revisions of a blog one page at a time, newest first, from its current version.
+        Args:
+            blog_id (int): The ID of the blog.
+            response (Response): The HTTP response object.
+            limit (int, optional): The page size. Defaults to PAGE_SIZE_DEFAULT, capped at PAGE_SIZE_MAX.
+            after (Optional[str], optional): The `next_cursor` of the previous page. Defaults to None.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The page of revisions, with their number, topic, size and update time, and the cursor of the
+            next page, or an error response with a 404 status code if the blog does not exist.
+        """
+    rows = crud.read_revisions(db, blog_id, limit + 1, decode_cursor(after))
+    if not rows and after is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
+    logger.debug("Read revisions of blog %s", blog_id)
+    return revision_page(rows, limit)
 
 
-@app.put("/api/blogs/{blog_id}")
-def update_blog(blog_id, update_blog_payload: UpdateBlog, db: Session = Depends(get_db),
+@router.get("/api/blogs/{blog_id}/revisions/diff", response_model=Union[RevisionDiff, SuccessResponse])
+def diff_blog_revisions(blog_id: int, response: Response, from_revision: int = Query(alias="from"),
+                        to_revision: int = Query(alias="to"), db: Session = Depends(get_read_db),
+                        token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to compare two revisions of a blog.
+        Args:
+            blog_id (int): The ID of the blog.
+            response (Response): The HTTP response object.
+            from_revision (int): The revision to compare from, given as the `from` query parameter.
+            to_revision (int): The revision to compare to, given as the `to` query parameter.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The topics of both revisions and a unified diff of their data, or an error response with a
+            404 status code if either revision does not exist.
+        """
+    old = crud.read_revision(db, blog_id, from_revision)
+    new = crud.read_revision(db, blog_id, to_revision) if old is not None else None
+    if new is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
+    logger.debug("Diffed revisions %s and %s of blog %s", from_revision, to_revision, blog_id)
+    return {"blog_id": blog_id, "from_revision": from_revision, "to_revision": to_revision,
+            "from_topic": old["topic"], "to_topic": new["topic"], "diff": revisions.unified_diff(old, new)}
+
+
+@router.get("/api/blogs/{blog_id}/revisions/{revision}", response_model=Union[RevisionOut, SuccessResponse])
+def read_blog_revision(blog_id: int, revision: int, response: Response, db: Session = Depends(get_read_db),
+                       token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to read a revision of a blog, rebuilt from the nearest snapshot or the current version.
+        Args:
+            blog_id (int): The ID of the blog.
+            revision (int): The revision, i.e. the version the blog had.
+            response (Response): The HTTP response object.
+            db (Session, optional): The database session. Defaults to Depends(get_read_db).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The revision's topic, data and update time, or an error response with a 404 status code if
+            the blog or the revision does not exist.
+        """
+    record = crud.read_revision(db, blog_id, revision)
+    if record is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
+    logger.debug("Read revision %s of blog %s", revision, blog_id)
+    return {"blog_id": blog_id, **record}
+
+
+@router.put("/api/blogs/{blog_id}", response_model=Union[BlogOut, SuccessResponse])
+def update_blog(blog_id: int, update_blog_payload: UpdateBlog, response: Response, db: Session = Depends(get_db),
                 token_verification=Depends(verify_access_token)):
     """
         Endpoint to update a blog by blog ID.
         Args:
             blog_id (int): The ID of the blog to update.
             update_blog_payload (UpdateBlog): The payload containing the updated blog data.
+            response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            dict: The updated blog data.
+            dict: The updated blog data, or an error response with a 404 status code if the blog does not
+            exist or a 409 status code if the topic belongs to another blog.
         """
-    updated_record = crud.update_blog(db, blog_id, update_blog_payload.topic, update_blog_payload.data)
-    logger.debug("Blog updated" + str(blog_id))
+    try:
+        updated_record = crud.update_blog(db, blog_id, update_blog_payload.topic, update_blog_payload.data)
+    except IntegrityError:
+        response.status_code = status.HTTP_409_CONFLICT
+        logger.warning("Blog topic already exists")
+        return {"success": False}
+    if updated_record is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
+    logger.debug("Blog updated %s", blog_id)
     return updated_record
 
 
-@app.delete("/api/blogs/{blog_id}")
-def delete_blog(blog_id: int, db: Session = Depends(get_db), token_verification=Depends(verify_access_token)):
+@router.delete("/api/blogs/{blog_id}", response_model=SuccessResponse)
+def delete_blog(blog_id: int, response: Response, db: Session = Depends(get_db),
+                token_verification=Depends(verify_access_token)):
     """
         Endpoint to delete a blog by blog ID.
         Args:
             blog_id (int): The ID of the blog to delete.
+            response (Response): The HTTP response object.
             db (Session, optional): The database session. Defaults to Depends(get_db).
-            token_verification (bool, optional): The result of token verification. Defaults to Depends(verify_access_token).
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
         Returns:
-            dict: A response indicating the success of the deletion.
+            dict: A response indicating the success of the deletion, with a 404 status code if the blog
+            does not exist.
         """
-    crud.delete_blog(db, blog_id)
+    if not crud.delete_blog(db, blog_id):
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"success": False}
     response = {"success": True}
-    logger.info("Blog deleted" + str(blog_id))
+    logger.info("Blog deleted %s", blog_id)
     return response
 
 
-def create_tables():
+app.include_router(async_router if USE_ASYNC_DB else router)
+
+
+@app.get("/api/cache/stats")
+def get_cache_stats(token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to report the size and hit, miss and eviction counters of the record, verified-token and
+        compressed-blog caches.
+        Args:
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The statistics of each cache.
+        """
+    return {"records": cache.stats(), "tokens": token_cache.stats(),
+            "compressed_blogs": compression.compressed_blogs.stats()}
+
+
+@app.get("/api/db/stats")
+def get_db_stats(token_verification=Depends(verify_access_token)):
+    """
+        Endpoint to report connection pool metrics: checkout waits and timeouts, connections in use and overflow.
+        Args:
+            token_verification (str, optional): The subject of the verified token. Defaults to Depends(verify_access_token).
+        Returns:
+            dict: The metrics of the sync and async engine pools, of the replicas' pools if any, and the
+            health and lag of each replica.
+        """
+    return {**pool_stats(), "replicas": replica_set.stats()}
+
+
+@app.get("/metrics")
+def get_metrics(db: Session = Depends(get_db)):
+    """
+        Endpoint for Prometheus to scrape per-route latency, response size and SQL metrics, pool metrics,
+        replica health, admission control counters and the outbox backlog; under serve.py, the totals of
+        all its workers.
+        Args:
+            db (Session, optional): The database session, to measure the outbox backlog. Defaults to Depends(get_db).
+        Returns:
+            Response: The metrics in the Prometheus text exposition format.
+        """
+    exposition = render_metrics(db)
+    if METRICS_DIR:
+        exposition = metrics.collect(METRICS_DIR, exposition)
+    return Response(exposition, media_type="text/plain; version=0.0.4")
+
+
+def render_metrics(db=None):
+    if db is None:
+        with SessionLocal() as db:
+            return render_metrics(db)
+    return metrics.render(pool_stats(), replica_set.stats(), admission.stats(), outbox_backlog(db))
+
+
+def outbox_backlog(db):
+    # One aggregate over the outbox per scrape; the gauges are left out while the database is unreachable
     try:
-        Base.metadata.create_all(bind=engine)
-        logger.info("Database connection established successfully")
-    except OperationalError:
-        logger.error("Failed to establish connection to the database.")
+        pending, oldest_age = crud.outbox_backlog(db)
+    except SQLAlchemyError as error:
+        logger.warning("Could not measure the outbox backlog: %s", error)
+        return None
+    return {"pending": pending, "oldest_age_seconds": oldest_age}
+
+
+metrics_snapshots = metrics.Snapshots(METRICS_DIR, render_metrics)
+
+
+@app.on_event("startup")
+def start_metrics_snapshots():
+    if METRICS_DIR:
+        metrics_snapshots.start()
+
+
+@app.on_event("shutdown")
+def stop_metrics_snapshots():
+    metrics_snapshots.stop()
+
+
+relays: List[outbox_relay.OutboxRelay] = []
+
+
+@app.on_event("startup")
+def start_outbox_relays():
+    relays.extend(outbox_relay.start_relays(OUTBOX_RELAY_WORKERS))
+
+
+@app.on_event("shutdown")
+def stop_outbox_relays():
+    while relays:
+        relays.pop().stop()
+
+
+@app.on_event("startup")
+def start_view_counter():
+    views.view_counter.start()
+
+
+@app.on_event("shutdown")
+def stop_view_counter():
+    views.view_counter.stop()
+
+
+@app.on_event("startup")
+def start_replica_health_checks():
+    replica_set.start()
+
+
+@app.on_event("shutdown")
+def stop_replica_health_checks():
+    replica_set.stop()
+
+
+@app.get("/healthz")
+def get_health():
+    """
+        Liveness probe: answers as long as the process can serve requests, without touching its dependencies.
+        Returns:
+            dict: {"status": "ok"}.
+        """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def get_readiness(response: Response):
+    """
+        Readiness probe: whether the process has warmed up and should receive traffic.
+        Args:
+            response (Response): The response object.
+        Returns:
+            dict: {"ready": True}, or {"ready": False} with the last warm-up error and a 503 status code.
+        """
+    if not lifecycle.readiness.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"ready": False, "error": lifecycle.readiness.error}
+    return {"ready": True}
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    # The server accepts connections right away; /readyz reports when the warm-up is done
+    lifecycle.readiness.start()
+
+
+@app.on_event("shutdown")
+async def stop_warm_up():
+    await lifecycle.readiness.stop()
+
+
+metrics.instrument_routes(app)
 
 
 if __name__ == "__main__":
-    create_tables()
     uvicorn.run(app, port=8000)
@@ -0,0 +1,378 @@
+"""Per-route request metrics in the Prometheus text exposition format.
+
+Each route's ASGI app is wrapped once at startup (see instrument_routes), so the route label is
+known without matching the path again, and a request only takes one lock when it finishes.
+SQL statements are attributed to the request that issued them through a context variable set
+by the wrapper and read by cursor execute events on the engines.
+
+Under serve.py each worker also writes its metrics to METRICS_DIR every METRICS_SNAPSHOT_INTERVAL
+seconds, and /metrics, whichever worker serves it, merges them into one exposition. When a worker
+exits, serve.py folds its counters and histograms into a file of totals, so they never go back.
+"""
+
+import operator
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+from config import SLOW_REQUEST_THRESHOLD, SLOW_REQUEST_MAX_STATEMENTS, METRICS_SNAPSHOT_INTERVAL
+from log_config import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+POOL_COUNTERS = ("checkouts", "checkins", "connects", "invalidations", "timeouts")
+POOL_GAUGES = ("in_use", "waiting", "size", "checked_in", "overflow")
+# Gauges that describe state the workers share rather than the worker itself are not summed
+SHARED_GAUGES = {"db_replica_healthy": min, "db_replica_lag_seconds": max, "outbox_pending_messages": max,
+                 "outbox_oldest_pending_age_seconds": max}
+EXITED_WORKERS = "exited.prom"
+
+
+class Histogram:
+    """Bucket counts are kept non-cumulative and summed when rendered. Not thread-safe on its own."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class RequestStats:
+    """SQL issued while serving one request."""
+    __slots__ = ("statements", "db_seconds", "recorded")
+
+    def __init__(self, record_statements=False):
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.recorded = [] if record_statements else None
+
+
+class RouteMetrics:
+    def __init__(self, method, path):
+        self.labels = f'method="{method}",route="{path}"'
+        self.in_flight = 0
+        self.responses = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_time = Histogram(LATENCY_BUCKETS)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, status_code, duration, size, stats):
+        with self._lock:
+            self.in_flight -= 1
+            self.responses[status_code] = self.responses.get(status_code, 0) + 1
+            self.latency.observe(duration)
+            self.response_size.observe(size)
+            self.statements.observe(stats.statements)
+            self.db_time.observe(stats.db_seconds)
+
+
+current_request: ContextVar = ContextVar("current_request", default=None)
+route_metrics = []
+
+
+class InstrumentedRoute:
+    """ASGI wrapper around a route's app that records the route's metrics."""
+
+    def __init__(self, app, path, methods):
+        self.app = app
+        self.path = path
+        self.by_method = {method: RouteMetrics(method, path) for method in methods}
+        route_metrics.extend(self.by_method.values())
+
+    async def __call__(self, scope, receive, send):
+        metrics = self.by_method.get(scope["method"]) if scope["type"] == "http" else None
+        if metrics is None:
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(record_statements=SLOW_REQUEST_THRESHOLD > 0)
+        response = {"status": 500, "size": 0}
+
+        async def send_and_measure(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        token = current_request.set(stats)
+        metrics.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            duration = time.perf_counter() - started
+            current_request.reset(token)
+            metrics.finish(response["status"], duration, response["size"], stats)
+            if 0 < SLOW_REQUEST_THRESHOLD <= duration:
+                log_slow_request(scope["method"], self.path, duration, stats)
+
+
+def instrument_routes(app):
+    """Wraps every API route of the app, once; call after all routes are registered."""
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not isinstance(route.app, InstrumentedRoute):
+            route.app = InstrumentedRoute(route.app, route.path, route.methods)
+
+
+def log_slow_request(method, path, duration, stats):
+    statements = "\n".join(f"  {elapsed * 1000:.1f}ms {statement}" for elapsed, statement in stats.recorded)
+    logger.warning("Slow request %s %s took %.3fs, %d statements in %.3fs:\n%s",
+                   method, path, duration, stats.statements, stats.db_seconds, statements)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_request.get() is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request.get()
+    started = getattr(context, "metrics_started", None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats.statements += 1
+    stats.db_seconds += elapsed
+    if stats.recorded is not None and len(stats.recorded) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.recorded.append((elapsed, statement))
+
+
+def instrument_engine(engine):
+    """Attributes the statements executed on a (sync) engine to the current request."""
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def family(name, kind, help_text, samples):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *samples]
+
+
+def render(pool_stats=None, replica_stats=None, admission_stats=None, outbox_stats=None):
+    """
+        Renders the metrics of every instrumented route, and of the pools, replicas, admission control and
+        outbox backlog if given.
+        Args:
+            pool_stats (dict, optional): PoolMetrics.stats() keyed by engine name.
+            replica_stats (list, optional): ReplicaSet.stats().
+            admission_stats (dict, optional): admission.stats().
+            outbox_stats (dict, optional): The "pending" outbox rows and the "oldest_age_seconds" among them.
+        Returns:
+            str: The metrics in the Prometheus text exposition format.
+        """
+    in_flight, responses, latency, sizes, statements, db_time = [], [], [], [], [], []
+    for metrics in route_metrics:
+        labels = metrics.labels
+        with metrics._lock:
+            in_flight.append(f"http_requests_in_flight{{{labels}}} {metrics.in_flight}")
+            responses.extend(f'http_responses_total{{{labels},status="{status}"}} {count}'
+                             for status, count in metrics.responses.items())
+            latency.extend(metrics.latency.samples("http_request_duration_seconds", labels))
+            sizes.extend(metrics.response_size.samples("http_response_size_bytes", labels))
+            statements.extend(metrics.statements.samples("http_request_db_statements", labels))
+            db_time.extend(metrics.db_time.samples("http_request_db_seconds", labels))
+    lines = [
+        *family("http_requests_in_flight", "gauge", "Requests currently being served.", in_flight),
+        *family("http_responses_total", "counter", "Responses sent, by status code.", responses),
+        *family("http_request_duration_seconds", "histogram", "Time to serve a request.", latency),
+        *family("http_response_size_bytes", "histogram", "Size of the response body.", sizes),
+        *family("http_request_db_statements", "histogram", "SQL statements executed per request.", statements),
+        *family("http_request_db_seconds", "histogram", "Time spent executing SQL per request.", db_time),
+    ]
+    pools = (pool_stats or {}).items()
+    for name in POOL_COUNTERS:
+        lines.extend(family(f"db_pool_{name}_total", "counter", f"Connection pool {name}.",
+                            [f'db_pool_{name}_total{{engine="{engine}"}} {stats[name]}' for engine, stats in pools]))
+    lines.extend(family("db_pool_checkout_wait_seconds_total", "counter", "Time spent waiting for a connection.",
+                        [f'db_pool_checkout_wait_seconds_total{{engine="{engine}"}} {stats["wait_seconds_total"]}'
+                         for engine, stats in pools]))
+    for name in POOL_GAUGES:
+        lines.extend(family(f"db_pool_{name}", "gauge", f"Connection pool {name.replace('_', ' ')}.",
+                            [f'db_pool_{name}{{engine="{engine}"}} {stats[name]}'
+                             for engine, stats in pools if name in stats]))
+    replicas = replica_stats or []
+    lines.extend(family("db_replica_healthy", "gauge", "Whether the read replica passed its last health check.",
+                        [f'db_replica_healthy{{replica="{replica["name"]}"}} {int(replica["healthy"])}'
+                         for replica in replicas]))
+    lines.extend(family("db_replica_lag_seconds", "gauge", "Replication lag measured by the last health check.",
+                        [f'db_replica_lag_seconds{{replica="{replica["name"]}"}} {replica["lag_seconds"]}'
+                         for replica in replicas]))
+    if admission_stats is not None:
+        lines.extend(family("http_admission_rejected_total", "counter", "Requests refused by admission control.",
+                            [f'http_admission_rejected_total{{reason="{reason}"}} {count}'
+                             for reason, count in admission_stats["rejected"].items()]))
+        lines.extend(family("http_admission_in_flight", "gauge", "Admitted requests being served, by route class.",
+                            [f'http_admission_in_flight{{class="{route_class}"}} {count}'
+                             for route_class, count in admission_stats["in_flight"].items()]))
+    if outbox_stats is not None:
+        lines.extend(family("outbox_pending_messages", "gauge", "Outbox rows waiting to be published.",
+                            [f"outbox_pending_messages {outbox_stats['pending']}"]))
+        lines.extend(family("outbox_oldest_pending_age_seconds", "gauge",
+                            "Age of the oldest outbox row waiting to be published.",
+                            [f"outbox_oldest_pending_age_seconds {outbox_stats['oldest_age_seconds']}"]))
+    return "\n".join(lines) + "\n"
+
+
+def parse(exposition):
+    """The families of an exposition rendered by render(), by name: (HELP line, TYPE line, type, {sample: value})."""
+    families = {}
+    samples = None
+    for line in exposition.splitlines():
+        if line.startswith("# HELP "):
+            name = line.split(" ", 3)[2]
+            help_line = line
+        elif line.startswith("# TYPE "):
+            samples = {}
+            families[name] = (help_line, line, line.rsplit(" ", 1)[1], samples)
+        elif line and not line.startswith("#"):
+            sample, _, value = line.rpartition(" ")
+            samples[sample] = float(value)
+    return families
+
+
+def merge(expositions, gauges=True):
+    """
+        Merges expositions rendered by render() in several processes: counters, histograms and gauges are
+        summed, except the SHARED_GAUGES.
+        Args:
+            expositions (Iterable[str]): The expositions to merge.
+            gauges (bool, optional): False to leave the gauges out, e.g. those of workers that exited.
+        Returns:
+            str: The merged exposition.
+        """
+    merged = {}
+    for exposition in expositions:
+        for name, (help_line, type_line, kind, samples) in parse(exposition).items():
+            if kind == "gauge" and not gauges:
+                continue
+            totals = merged.setdefault(name, (help_line, type_line, {}))[2]
+            combine = SHARED_GAUGES.get(name, operator.add)
+            for sample, value in samples.items():
+                totals[sample] = combine(totals[sample], value) if sample in totals else value
+    lines = []
+    for help_line, type_line, totals in merged.values():
+        lines += [help_line, type_line,
+                  *(f"{sample} {int(value) if value.is_integer() else value}" for sample, value in totals.items())]
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_path(directory, pid):
+    return os.path.join(directory, f"worker-{pid}.prom")
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_snapshot(path, exposition):
+    # Readers see the old or the new file, never a partly written one
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+        file.write(exposition)
+    os.replace(temporary, path)
+
+
+def collect(directory, exposition):
+    """
+        Merges this worker's metrics with those the other workers, running or exited, left in the directory.
+        Args:
+            directory (str): The METRICS_DIR shared by the workers.
+            exposition (str): This worker's metrics, fresher than its snapshot.
+        Returns:
+            str: The metrics of all workers.
+        """
+    own = os.path.basename(snapshot_path(directory, os.getpid()))
+    workers = {}
+    for entry in os.scandir(directory):
+        if entry.name.startswith("worker-") and entry.name.endswith(".prom") and entry.name != own:
+            workers[entry.name] = read_snapshot(entry.path)
+    # Read after the workers' snapshots: a snapshot folded in the meantime is listed in its first line
+    exited = read_snapshot(os.path.join(directory, EXITED_WORKERS)) or "# folded\n"
+    folded = exited.split("\n", 1)[0].split()[2:]
+    return merge([exposition, exited, *(snapshot for name, snapshot in workers.items()
+                                        if snapshot is not None and name not in folded)])
+
+
+def fold_exited_worker(directory, pid):
+    """Adds the counters and histograms of an exited worker to the totals of exited workers and removes its snapshot."""
+    path = snapshot_path(directory, pid)
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return
+    exited_path = os.path.join(directory, EXITED_WORKERS)
+    exited = read_snapshot(exited_path) or "# folded\n"
+    header, _, totals = exited.partition("\n")
+    # Only snapshots not yet removed need to stay listed
+    folded = [name for name in header.split()[2:] if os.path.exists(os.path.join(directory, name))]
+    folded.append(os.path.basename(path))
+    write_snapshot(exited_path, f"# folded {' '.join(folded)}\n" + merge([totals, snapshot], gauges=False))
+    os.remove(path)
+
+
+class Snapshots:
+    def __init__(self, directory, render, interval=METRICS_SNAPSHOT_INTERVAL):
+        """
+            Writes this worker's metrics to the directory shared by the workers of serve.py.
+            Args:
+                directory (str): The METRICS_DIR shared by the workers.
+                render (Callable): Returns this worker's metrics in the exposition format.
+                interval (float, optional): Seconds between two snapshots.
+            """
+        self.directory = directory
+        self.render = render
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        return snapshot_path(self.directory, os.getpid())
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-snapshots", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread after a last snapshot, so that serve.py folds everything this worker counted."""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            write_snapshot(self.path, self.render())
+
+    def _run(self):
+        while True:
+            write_snapshot(self.path, self.render())
+            if self._stop.wait(self.interval):
+                break
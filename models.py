@@ -1,5 +1,8 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import (DDL, BigInteger, Boolean, Column, Computed, DateTime, ForeignKey, Integer, String, event, func,
+                        literal_column)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
+from config import BLOG_EXCERPT_LENGTH, BLOG_DATA_COMPRESSION
 from db_connector import Base
 
 
@@ -16,3 +19,89 @@ class Blog(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     topic = Column(String, unique=True, index=True)
     data = Column(String)
+    # Precomputed by the database on every write, so list pages can be served without reading data
+    excerpt = Column(String, Computed(f"substr(data, 1, {BLOG_EXCERPT_LENGTH})", persisted=True))
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+
+
+# Full-text search over topic and data. On Postgres this is a generated tsvector column with a GIN
+# index; it is added with DDL rather than mapped, so ORM loads of Blog never fetch it and the model
+# still creates on SQLite, where an external-content FTS5 table kept in sync by triggers is used.
+blog_search_vector = literal_column("blog.search_vector", TSVECTOR)
+
+blog_search_ddl = {
+    "postgresql": [
+        "ALTER TABLE blog ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(topic, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(data, '')), 'B')) STORED",
+        "CREATE INDEX ix_blog_search_vector ON blog USING gin (search_vector)",
+    ],
+    "sqlite": [
+        "CREATE VIRTUAL TABLE blog_fts USING fts5(topic, data, content='blog', content_rowid='id')",
+        "CREATE TRIGGER blog_fts_insert AFTER INSERT ON blog BEGIN "
+        "INSERT INTO blog_fts(rowid, topic, data) VALUES (new.id, new.topic, new.data); END",
+        "CREATE TRIGGER blog_fts_delete AFTER DELETE ON blog BEGIN "
+        "INSERT INTO blog_fts(blog_fts, rowid, topic, data) VALUES ('delete', old.id, old.topic, old.data); END",
+        "CREATE TRIGGER blog_fts_update AFTER UPDATE ON blog BEGIN "
+        "INSERT INTO blog_fts(blog_fts, rowid, topic, data) VALUES ('delete', old.id, old.topic, old.data); "
+        "INSERT INTO blog_fts(rowid, topic, data) VALUES (new.id, new.topic, new.data); END",
+    ],
+}
+for dialect_name, statements in blog_search_ddl.items():
+    for statement in statements:
+        event.listen(Blog.__table__, "after_create", DDL(statement).execute_if(dialect=dialect_name))
+event.listen(Blog.__table__, "after_drop", DDL("DROP TABLE IF EXISTS blog_fts").execute_if(dialect="sqlite"))
+
+# Postgres compresses bodies larger than about 2 KB when it stores them (TOAST), in SQL-visible form,
+# so search, excerpts and snippets keep working on data. Every stored value records the method it was
+# compressed with, so changing the method only affects new writes and older rows still read correctly.
+# lz4 decompresses several times faster than the default pglz, but needs a server built with it.
+def set_data_compression(table, column):
+    ddl = DDL(f"DO $$ BEGIN ALTER TABLE {table.name} ALTER COLUMN {column} SET COMPRESSION {BLOG_DATA_COMPRESSION}; "
+              "EXCEPTION WHEN feature_not_supported THEN NULL; END $$")
+    event.listen(table, "after_create", ddl.execute_if(
+        callable_=lambda ddl, target, bind, **kw: bind.dialect.name == "postgresql"
+        and bind.dialect.server_version_info >= (14,)))
+
+
+set_data_compression(Blog.__table__, "data")
+
+
+class Outbox(Base):
+    """Messages written in the same transaction as the change that caused them, published by outbox_relay"""
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    queue = Column(String, nullable=False)
+    payload = Column(String, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+
+class BlogViews(Base):
+    """View counts, added in batches by views.ViewCounter; kept out of blog so counting never rewrites a blog row"""
+    __tablename__ = "blog_views"
+    blog_id = Column(Integer, ForeignKey("blog.id", ondelete="CASCADE"), primary_key=True)
+    views = Column(BigInteger, nullable=False)
+
+
+class PopularBlog(Base):
+    """The POPULAR_BLOGS_SIZE most viewed blogs and their counts, updated by each flush of the view counts"""
+    __tablename__ = "popular_blogs"
+    blog_id = Column(Integer, ForeignKey("blog.id", ondelete="CASCADE"), primary_key=True)
+    views = Column(BigInteger, nullable=False)
+
+
+class BlogRevision(Base):
+    """Versions of a blog replaced by updates, as deltas from the next revision or snapshots (see revisions.py)"""
+    __tablename__ = "blog_revisions"
+    blog_id = Column(Integer, ForeignKey("blog.id", ondelete="CASCADE"), primary_key=True)
+    revision = Column(Integer, primary_key=True)
+    topic = Column(String, nullable=False)
+    snapshot = Column(Boolean, nullable=False)
+    # The data of a snapshot, otherwise the delta that rebuilds it from the next revision's data
+    content = Column(String)
+    size = Column(Integer)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+set_data_compression(BlogRevision.__table__, "content")
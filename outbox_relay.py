@@ -0,0 +1,132 @@
+"""Relay that publishes rows of the outbox table to RabbitMQ.
+
+Each relay claims a batch with SELECT ... FOR UPDATE SKIP LOCKED, publishes it with publisher
+confirms and deletes it in the same transaction, so several relays (threads, workers or
+hosts) can drain the table in parallel without publishing a row twice. A crash between the
+publish and the commit leaves the rows in place, so delivery is at-least-once.
+"""
+
+import threading
+
+from pika.exceptions import AMQPError
+from sqlalchemy.exc import SQLAlchemyError
+
+import crud
+from config import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_RELAY_WORKERS, RABBITMQ_RECONNECT_MAX_BACKOFF
+from db_connector import SessionLocal
+from email_service_client import rabbitmq_connection
+from log_config import logger
+
+
+class OutboxRelay:
+    def __init__(self, session_factory=SessionLocal, connection_factory=rabbitmq_connection,
+                 batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_backoff=RABBITMQ_RECONNECT_MAX_BACKOFF):
+        """
+            Creates a relay; call start() to run it on a background thread.
+            Args:
+                session_factory (Callable): Opens a new database session.
+                connection_factory (Callable): Opens a new pika.BlockingConnection-like connection.
+                batch_size (int, optional): Maximum rows claimed per transaction.
+                poll_interval (float, optional): Seconds to wait when the outbox is drained.
+                max_backoff (float, optional): Upper bound in seconds of the delay after a failure.
+            """
+        self.session_factory = session_factory
+        self.connection_factory = connection_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._declared_queues = set()
+
+    def relay_once(self):
+        """
+            Publishes and deletes one batch of outbox rows.
+            Returns:
+                int: The number of rows published.
+            """
+        db = self.session_factory()
+        try:
+            events = crud.claim_outbox_events(db, self.batch_size)
+            if not events:
+                db.rollback()
+                return 0
+            channel = self._ensure_channel()
+            for event in events:
+                if event.queue not in self._declared_queues:
+                    channel.queue_declare(queue=event.queue)
+                    self._declared_queues.add(event.queue)
+                channel.basic_publish(exchange='', routing_key=event.queue, body=event.payload)
+            crud.delete_outbox_events(db, [event.id for event in events])
+            return len(events)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="outbox-relay", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stop.is_set():
+            try:
+                published = self.relay_once()
+                backoff = 0.0
+            except (AMQPError, OSError, SQLAlchemyError) as exc:
+                self._close()
+                backoff = min(max(backoff * 2, 0.5), self.max_backoff)
+                logger.warning("Outbox relay failed (%s), retrying in %.1fs", exc, backoff)
+                self._stop.wait(backoff)
+                continue
+            if published < self.batch_size:
+                self._stop.wait(self.poll_interval)
+        self._close()
+
+    def _ensure_channel(self):
+        if self._channel is not None and self._channel.is_open:
+            return self._channel
+        self._close()
+        self._connection = self.connection_factory()
+        self._channel = self._connection.channel()
+        # basic_publish now blocks until the broker confirms and raises if it nacks
+        self._channel.confirm_delivery()
+        return self._channel
+
+    def _close(self):
+        connection, self._connection, self._channel = self._connection, None, None
+        self._declared_queues.clear()
+        if connection is not None:
+            try:
+                connection.close()
+            except AMQPError:
+                pass
+
+
+def start_relays(workers=OUTBOX_RELAY_WORKERS):
+    relays = [OutboxRelay() for _ in range(workers)]
+    for relay in relays:
+        relay.start()
+    return relays
+
+
+if __name__ == "__main__":
+    running_relays = start_relays()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for running_relay in running_relays:
+            running_relay.stop()
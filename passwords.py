@@ -0,0 +1,131 @@
+"""Password hashing with argon2id on a bounded pool of worker threads.
+
+argon2 releases the GIL while hashing, so a few dedicated threads keep the CPU-bound work off the
+request threads and the event loop, and cap how many cores a login storm can take. When more
+operations are waiting than PASSWORD_HASH_MAX_PENDING, new ones are rejected instead of queued.
+
+Run `python passwords.py [seconds]` to measure verifications per second per core.
+"""
+
+import asyncio
+import hmac
+import os
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+from config import (PASSWORD_HASH_TIME_COST, PASSWORD_HASH_MEMORY_COST, PASSWORD_HASH_PARALLELISM,
+                    PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_ACCEPT_PLAINTEXT)
+from log_config import logger
+
+
+class PasswordHashingOverloaded(Exception):
+    """Raised when too many hash operations are already waiting for a worker."""
+
+
+class PasswordPool:
+    def __init__(self, hasher=None, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 accept_plaintext=PASSWORD_ACCEPT_PLAINTEXT):
+        """
+            Creates a pool; its threads start on first use.
+            Args:
+                hasher (PasswordHasher, optional): Defaults to argon2id with the PASSWORD_HASH_* cost parameters.
+                workers (int, optional): Threads hashing in parallel, at most one core each.
+                max_pending (int, optional): Operations running or queued before new ones are rejected.
+                accept_plaintext (bool, optional): Whether a stored value that is not a hash is compared as a
+                    plain-text password.
+            """
+        self.hasher = hasher or PasswordHasher(time_cost=PASSWORD_HASH_TIME_COST,
+                                               memory_cost=PASSWORD_HASH_MEMORY_COST,
+                                               parallelism=PASSWORD_HASH_PARALLELISM)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._pending = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        self.accept_plaintext = accept_plaintext
+        self._dummy_hash = None
+
+    def hash(self, password):
+        """Hashes a password for storage, blocking the calling thread until a worker is done."""
+        return self._submit(self.hasher.hash, password).result()
+
+    def verify(self, stored_hash, password):
+        """
+            Checks a password, blocking the calling thread until a worker is done.
+            Args:
+                stored_hash (str | None): The stored hash, or None when no user has the email, in which
+                    case a hash of the same cost is still verified so the response takes as long.
+                password (str): The password to check.
+            Returns:
+                tuple: Whether the password matches, and a new hash to store when the stored one uses
+                other cost parameters or predates hashing (None otherwise).
+            """
+        return self._submit(self._verify, stored_hash, password).result()
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit(self.hasher.hash, password))
+
+    async def verify_async(self, stored_hash, password):
+        return await asyncio.wrap_future(self._submit(self._verify, stored_hash, password))
+
+    def warm_up(self):
+        """Computes the dummy hash on a worker, so the first login for an unknown email does not pay for it."""
+        self.executor.submit(self._get_dummy_hash).result()
+
+    def _submit(self, function, *args):
+        if self._pending is not None and not self._pending.acquire(blocking=False):
+            raise PasswordHashingOverloaded()
+        future = self.executor.submit(function, *args)
+        if self._pending is not None:
+            future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def _verify(self, stored_hash, password):
+        if stored_hash is None or not stored_hash.startswith("$argon2"):
+            self._verify_hash(self._get_dummy_hash(), password)
+            if stored_hash is None:
+                return False, None
+            if not self.accept_plaintext:
+                logger.warning("Rejected a login against a password stored in plain text")
+                return False, None
+            # Passwords stored in plain text before hashing was introduced are hashed on their next login
+            if hmac.compare_digest(stored_hash.encode(), password.encode()):
+                logger.warning("Accepted a password stored in plain text, replacing it with its hash")
+                return True, self.hasher.hash(password)
+            return False, None
+        if not self._verify_hash(stored_hash, password):
+            return False, None
+        return True, self.hasher.hash(password) if self.hasher.check_needs_rehash(stored_hash) else None
+
+    def _verify_hash(self, stored_hash, password):
+        try:
+            return self.hasher.verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def _get_dummy_hash(self):
+        if self._dummy_hash is None:
+            self._dummy_hash = self.hasher.hash(secrets.token_urlsafe(16))
+        return self._dummy_hash
+
+
+password_pool = PasswordPool()
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    stored = password_pool.hash("benchmark-password")
+    verified = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        futures = [password_pool._submit(password_pool._verify, stored, "benchmark-password")
+                   for _ in range(PASSWORD_HASH_WORKERS * 2)]
+        verified += sum(future.result()[0] for future in futures)
+    cores = min(PASSWORD_HASH_WORKERS, os.cpu_count() or 1)
+    print(f"{verified / duration:.1f} logins/s with {PASSWORD_HASH_WORKERS} workers, "
+          f"{verified / duration / cores:.1f} logins/s per core "
+          f"(time_cost={PASSWORD_HASH_TIME_COST}, memory_cost={PASSWORD_HASH_MEMORY_COST} KiB, "
+          f"parallelism={PASSWORD_HASH_PARALLELISM})")
@@ -0,0 +1,91 @@
+"""Instrumentation of the database connection pools.
+
+Checkout wait time and checkout timeouts are measured by pool subclasses, since no pool event
+fires before a caller starts waiting; everything else comes from pool events on the engine.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.waiting = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock()
+
+    def start_wait(self):
+        with self._lock:
+            self.waiting += 1
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            self.waiting -= 1
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self, pool):
+        """
+            Counters since startup together with the current state of the pool.
+            Args:
+                pool (Pool): The engine's current pool, which is replaced when the engine is disposed.
+            Returns:
+                dict: The pool metrics.
+            """
+        with self._lock:
+            stats = {"checkouts": self.checkouts, "checkins": self.checkins, "connects": self.connects,
+                     "invalidations": self.invalidations, "timeouts": self.timeouts,
+                     "wait_seconds_total": self.wait_seconds_total, "wait_seconds_max": self.wait_seconds_max,
+                     "wait_seconds_avg": self.wait_seconds_total / self.waits if self.waits else 0.0,
+                     "in_use": self.checkouts - self.checkins, "waiting": self.waiting}
+        stats["pool"] = type(pool).__mro__[1].__name__
+        if hasattr(pool, "overflow"):
+            stats.update(size=pool.size(), checked_in=pool.checkedin(), overflow=max(pool.overflow(), 0))
+        return stats
+
+
+def instrumented_pool_class(pool_class, metrics):
+    """
+        Subclasses a pool class so that the time spent waiting for a connection is recorded.
+        Args:
+            pool_class (type): A Pool class such as QueuePool, AsyncAdaptedQueuePool or NullPool.
+            metrics (PoolMetrics): Where waits and timeouts are recorded.
+        Returns:
+            type: The pool class to pass as `poolclass` to create_engine.
+        """
+    def _do_get(self):
+        started = time.perf_counter()
+        metrics.start_wait()
+        try:
+            return pool_class._do_get(self)
+        except PoolTimeoutError:
+            metrics.increment("timeouts")
+            raise
+        finally:
+            metrics.observe_wait(time.perf_counter() - started)
+
+    # A class attribute rather than an instance one, because Pool.recreate() builds a new instance
+    return type(f"Instrumented{pool_class.__name__}", (pool_class,), {"_do_get": _do_get})
+
+
+def instrument(engine, metrics):
+    """Counts checkouts, checkins, new connections and invalidations on the engine's pools."""
+    event.listen(engine, "checkout", lambda *args: metrics.increment("checkouts"))
+    event.listen(engine, "checkin", lambda *args: metrics.increment("checkins"))
+    event.listen(engine, "connect", lambda *args: metrics.increment("connects"))
+    event.listen(engine, "invalidate", lambda *args: metrics.increment("invalidations"))
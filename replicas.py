@@ -0,0 +1,182 @@
+"""Routing of read-only requests to read replicas.
+
+Reads are spread round-robin over the replicas that passed their last health check, and go to the
+primary when none did. A client that wrote recently keeps reading from the primary for
+DB_READ_YOUR_WRITES_WINDOW seconds, so it always sees its own changes despite replication lag.
+The time of its last write is sent back in the LAST_WRITE_COOKIE cookie, so whichever worker serves
+its next read knows; the worker that served the write also remembers the token subject, for
+clients that do not keep cookies.
+Sessions on a replica have "replica" in their info, and never fill the shared record cache: a
+lagging replica could otherwise put a row back in the cache right after a write invalidated it.
+"""
+
+import itertools
+import math
+import threading
+import time
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from cache import LRUCache
+from config import DB_READ_YOUR_WRITES_WINDOW, DB_REPLICA_HEALTH_INTERVAL, DB_REPLICA_MAX_LAG
+from log_config import logger
+from utils import verified_token_subject
+
+LAST_WRITE_COOKIE = "last_write"
+
+# Seconds the replica is behind the primary; 0 when it has replayed everything it received, so an
+# idle primary does not make its replicas look stale
+REPLICATION_LAG = text("SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                       "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+class Replica:
+    def __init__(self, name, engine, session_factory, async_engine=None, async_session_factory=None):
+        """
+            A read replica and the sessions opened on it.
+            Args:
+                name (str): Identifies the replica in logs and stats, e.g. its host and port.
+                engine (Engine): Engine on the replica, also used for the health checks.
+                session_factory (sessionmaker): Creates sync sessions on the replica.
+                async_engine (AsyncEngine, optional): Engine on the replica for the async endpoints.
+                async_session_factory (async_sessionmaker, optional): Creates async sessions on the replica.
+            """
+        self.name = name
+        self.engine = engine
+        self.session_factory = session_factory
+        self.async_engine = async_engine
+        self.async_session_factory = async_session_factory
+        self.healthy = True
+        self.lag = 0.0
+        self.last_error = None
+        for sync_engine in filter(None, (engine, async_engine and async_engine.sync_engine)):
+            event.listen(sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        # A lost connection takes the replica out of rotation until the next health check passes
+        if context.is_disconnect and self.healthy:
+            self.healthy = False
+            self.last_error = str(context.original_exception)
+            logger.warning("Read replica %s disconnected, reading from the others", self.name)
+
+
+class ReplicaSet:
+    def __init__(self, replicas, window=DB_READ_YOUR_WRITES_WINDOW, health_interval=DB_REPLICA_HEALTH_INTERVAL,
+                 max_lag=DB_REPLICA_MAX_LAG, clock=time.time):
+        """
+            Creates the routing state; call start() to run the health checks in the background.
+            Args:
+                replicas (list): The Replica objects, possibly none.
+                window (float, optional): Seconds after a write during which the client reads from the primary.
+                health_interval (float, optional): Seconds between health checks.
+                max_lag (float, optional): Replicas further behind than this many seconds are skipped; 0 disables.
+                clock (Callable, optional): Time source, replaceable in tests. Defaults to time.time, since the
+                times in last-write cookies are compared by every worker.
+            """
+        self.replicas = replicas
+        self.window = window
+        self.clock = clock
+        self.health_interval = health_interval
+        self.max_lag = max_lag
+        self.recent_writers = LRUCache(ttl=window, clock=clock)
+        self._round_robin = itertools.count()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def record_write(self, client, response=None):
+        """
+            Keeps the client's reads on the primary for the read-your-writes window.
+            Args:
+                client (str | None): The client's identity, see client_key().
+                response (Response, optional): The response to the write, which gets the last-write cookie.
+            """
+        if not self.replicas:
+            return
+        if client is not None:
+            self.recent_writers.set(client, True)
+        if response is not None:
+            response.set_cookie(LAST_WRITE_COOKIE, f"{self.clock():.3f}", max_age=math.ceil(self.window),
+                                httponly=True, samesite="strict")
+
+    def wrote_recently(self, client, last_write=None):
+        if client is not None and self.recent_writers.get(client) is not None:
+            return True
+        try:
+            written_at = float(last_write)
+        except (TypeError, ValueError):
+            return False
+        # Times far in the future are ignored, so a forged cookie cannot pin a client to the primary for good
+        now = self.clock()
+        return now - self.window < written_at < now + self.window
+
+    def replica_for(self, client, last_write=None):
+        """
+            Picks where a read-only request is served.
+            Args:
+                client (str | None): The client's identity, see client_key().
+                last_write (str | None, optional): The client's LAST_WRITE_COOKIE, if it sent one.
+            Returns:
+                Replica | None: The next healthy replica, or None to read from the primary.
+            """
+        if not self.replicas or self.wrote_recently(client, last_write):
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._round_robin) % len(healthy)]
+
+    def check_health(self):
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    replica.lag = float(connection.execute(REPLICATION_LAG).scalar() or 0)
+                healthy, replica.last_error = True, None
+                if 0 < self.max_lag < replica.lag:
+                    healthy, replica.last_error = False, f"{replica.lag:.1f}s behind the primary"
+            except SQLAlchemyError as error:
+                healthy, replica.last_error = False, str(error)
+            if healthy != replica.healthy:
+                if healthy:
+                    logger.info("Read replica %s is healthy again", replica.name)
+                else:
+                    logger.warning("Read replica %s failed its health check: %s", replica.name, replica.last_error)
+            replica.healthy = healthy
+
+    def start(self):
+        if self.replicas and self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="replica-health", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.check_health()
+            self._stopping.wait(self.health_interval)
+
+    def stats(self):
+        return [{"name": replica.name, "healthy": replica.healthy, "lag_seconds": replica.lag,
+                 "last_error": replica.last_error} for replica in self.replicas]
+
+
+def client_key(request):
+    """
+        Identifies a client for read-your-writes.
+        Args:
+            request (Request): The client's request.
+        Returns:
+            str | None: The subject of its bearer token, or None while this worker has not verified the token;
+            its address when it sends no token.
+        """
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        # Only a verified token names a subject; it is looked up without decoding, as in admission.rate_limit_key
+        sub = verified_token_subject(token)
+        return f"sub:{sub}" if sub is not None else None
+    return f"ip:{request.client.host}" if request.client is not None else None
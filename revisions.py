@@ -0,0 +1,122 @@
+"""Blog revision history, stored as deltas.
+
+Updating a blog stores the version it replaces in blog_revisions, in the same transaction. The
+current version is only stored in blog, so reading it costs exactly what it did before. Most past
+revisions are stored as a delta that rebuilds them from the revision after them. Every
+BLOG_REVISION_SNAPSHOT_INTERVAL-th revision is stored whole instead. To rebuild a revision, start
+from the nearest snapshot above it, or from the current version if there is none, and apply at
+most BLOG_REVISION_SNAPSHOT_INTERVAL - 1 deltas. A delta for an edit that changes a few sentences
+of a large post holds only those sentences and a few offsets.
+
+A delta is a JSON list with two kinds of entries. [start, end] copies that range of tokens from the
+newer text. A string is inserted as it is. A text's tokens are its lines and sentences.
+
+Blogs updated before this history existed keep their revisions from their first later update on.
+"""
+
+import difflib
+import json
+import re
+
+from config import BLOG_REVISION_SNAPSHOT_INTERVAL
+
+# Splits after line breaks and sentence ends, so an edit to one sentence leaves the other tokens equal
+TOKEN_BOUNDARY = re.compile(r"(?<=[\n.!?])")
+
+
+def tokenize(text):
+    return [token for token in TOKEN_BOUNDARY.split(text) if token]
+
+
+def make_delta(source, target):
+    """
+        Encodes target as the changes to make to source.
+        Args:
+            source (str): The text the delta is applied to.
+            target (str): The text the delta rebuilds.
+        Returns:
+            str: The delta, in the JSON form apply_delta reads.
+        """
+    source_tokens, target_tokens = tokenize(source), tokenize(target)
+    # Most edits change one part of a post: only the tokens between the common prefix and suffix are matched
+    prefix = 0
+    limit = min(len(source_tokens), len(target_tokens))
+    while prefix < limit and source_tokens[prefix] == target_tokens[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and source_tokens[len(source_tokens) - suffix - 1] == target_tokens[len(target_tokens) - suffix - 1]):
+        suffix += 1
+    matcher = difflib.SequenceMatcher(None, source_tokens[prefix:len(source_tokens) - suffix],
+                                      target_tokens[prefix:len(target_tokens) - suffix], autojunk=False)
+    delta = [[0, prefix]] if prefix else []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            delta.append([prefix + i1, prefix + i2])
+        elif tag != "delete":
+            inserted = "".join(target_tokens[prefix + j1:prefix + j2])
+            if delta and isinstance(delta[-1], str):
+                delta[-1] += inserted
+            else:
+                delta.append(inserted)
+    if suffix:
+        delta.append([len(source_tokens) - suffix, len(source_tokens)])
+    return json.dumps(delta, separators=(",", ":"))
+
+
+def apply_delta(source, delta):
+    tokens = tokenize(source)
+    return "".join("".join(tokens[entry[0]:entry[1]]) if isinstance(entry, list) else entry
+                   for entry in json.loads(delta))
+
+
+def past_revision(blog_id, revision, topic, data, updated_at, newer_data,
+                  snapshot_interval=BLOG_REVISION_SNAPSHOT_INTERVAL):
+    """
+        The blog_revisions row storing a version replaced by an update.
+        Args:
+            blog_id (int): The ID of the blog.
+            revision (int): The version replaced.
+            topic (str): Its topic.
+            data (str | None): Its data.
+            updated_at (datetime): When it was written.
+            newer_data (str | None): The data of the version replacing it, which the delta is applied to.
+            snapshot_interval (int, optional): Every this many revisions is stored whole.
+        Returns:
+            dict: The column values of the BlogRevision row.
+        """
+    content = data
+    if data is not None and revision % snapshot_interval != 0:
+        delta = make_delta(newer_data or "", data)
+        # After a rewrite the delta can be larger than the text itself
+        if len(delta) < len(data):
+            content = delta
+    return {"blog_id": blog_id, "revision": revision, "topic": topic, "snapshot": content is data,
+            "content": content, "size": None if data is None else len(data), "updated_at": updated_at}
+
+
+def rebuild(chain, revision):
+    """
+        Rebuilds a revision from the rows read by the revision chain query.
+        Args:
+            chain (list): Rows with revision, topic, snapshot, content and updated_at. They are ordered
+                newest first and start with a snapshot: a stored one, or the current version.
+            revision (int): The revision to rebuild.
+        Returns:
+            dict | None: The revision's number, topic, data and updated_at, or None if it is not stored.
+        """
+    if not chain or chain[-1].revision != revision:
+        return None
+    data = chain[0].content
+    for row in chain[1:]:
+        data = row.content if row.snapshot else apply_delta(data or "", row.content)
+    last = chain[-1]
+    return {"revision": last.revision, "topic": last.topic, "data": data, "updated_at": last.updated_at}
+
+
+def unified_diff(old, new):
+    """A unified diff of two rebuilt revisions' data, line by line."""
+    lines = difflib.unified_diff((old["data"] or "").splitlines(), (new["data"] or "").splitlines(),
+                                 fromfile=f"revision {old['revision']}", tofile=f"revision {new['revision']}",
+                                 lineterm="")
+    return "\n".join(lines)
@@ -1,4 +1,7 @@
-from pydantic import BaseModel, EmailStr, Field
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 
 
 class LoginSchema(BaseModel):
@@ -26,3 +29,132 @@ class CreateBlog(BaseModel):
 class UpdateBlog(BaseModel):
     topic: str = Field(max_length=25)
     data: str
+
+
+class BulkUpdateBlog(UpdateBlog):
+    id: int
+
+
+# Response models. Endpoints return ORM records, result rows or dicts and FastAPI validates and
+# serializes them with pydantic-core, so only these fields ever reach the client.
+
+class SuccessResponse(BaseModel):
+    success: bool
+
+
+class LoginResponse(BaseModel):
+    success: bool
+    token: Optional[str]
+
+
+class RegisterResponse(BaseModel):
+    name: Optional[str]
+    email: str
+    id: int
+    success: bool
+
+
+class UserOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    email: str
+    name: Optional[str]
+
+
+class UserPage(BaseModel):
+    items: List[UserOut]
+    next_cursor: Optional[str]
+
+
+class BlogOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    topic: str
+    data: Optional[str]
+    excerpt: Optional[str]
+    version: int
+    updated_at: datetime
+
+
+class CreatedBlog(BaseModel):
+    id: int
+    topic: str
+    data: Optional[str]
+
+
+class BlogPage(BaseModel):
+    items: List[BlogOut]
+    next_cursor: Optional[str]
+
+
+class BlogFieldsPage(BaseModel):
+    """A page of blogs projected to the fields given in the `fields` query parameter."""
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str]
+
+
+class PopularBlogOut(BaseModel):
+    id: int
+    topic: str
+    excerpt: Optional[str]
+    views: int
+
+
+class PopularBlogs(BaseModel):
+    items: List[PopularBlogOut]
+
+
+class RevisionSummary(BaseModel):
+    revision: int
+    topic: str
+    size: Optional[int]
+    updated_at: datetime
+
+
+class RevisionPage(BaseModel):
+    """The revisions of a blog, newest first, starting with its current version."""
+    items: List[RevisionSummary]
+    next_cursor: Optional[str]
+
+
+class RevisionOut(BaseModel):
+    blog_id: int
+    revision: int
+    topic: str
+    data: Optional[str]
+    updated_at: datetime
+
+
+class RevisionDiff(BaseModel):
+    blog_id: int
+    from_revision: int
+    to_revision: int
+    from_topic: str
+    to_topic: str
+    diff: str
+
+
+class SearchHit(BaseModel):
+    id: int
+    topic: str
+    rank: float
+    snippet: Optional[str]
+
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str]
+
+
+class BulkResult(BaseModel):
+    id: Optional[int]
+    topic: Optional[str] = None
+    status: str
+    detail: Optional[str] = None
+
+
+class BulkResponse(BaseModel):
+    success: bool
+    results: List[BulkResult]
@@ -0,0 +1,138 @@
+"""Production entry point: serves main:app from several worker processes sharing one listening socket.
+
+    python serve.py --host 0.0.0.0 --port 8000 [--workers N]
+
+The socket is bound once here and handed to WEB_CONCURRENCY workers (by default one per available
+core), each a uvicorn server with its own event loop, threads and database pools. When
+DB_CONNECTION_BUDGET is set, each worker's pools get an equal share of it, so the workers together
+stay within Postgres max_connections however many there are. A worker exits gracefully after
+WORKER_MAX_REQUESTS requests, plus a random part of WORKER_MAX_REQUESTS_JITTER so that workers
+restart one at a time, and is replaced at once; a worker that crashes is replaced after a second.
+Each worker writes its metrics to METRICS_DIR, and /metrics, whichever worker serves it, reports
+the totals of all of them. SIGTERM or SIGINT stop the workers gracefully.
+
+Caches and admission control state are kept per worker. A write only invalidates the record cache
+of the worker that served it, so every worker checks a cached blog's version against the database
+before serving it and does not cache users, unless a shared backend is installed with
+cache.set_backend(). Reads stay on the primary after a write whichever worker serves them, from the
+last-write cookie (see replicas.py).
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+import uvicorn
+
+import metrics
+from config import (DB_CONNECTION_BUDGET, WEB_CONCURRENCY, WORKER_MAX_REQUESTS, WORKER_MAX_REQUESTS_JITTER,
+                    WORKER_GRACEFUL_TIMEOUT, METRICS_DIR)
+from log_config import logger
+
+# Delay before a crashed worker is replaced, so that a worker failing at startup does not spin
+CRASH_RESTART_DELAY = 1.0
+
+
+def available_cores():
+    # Cores this process may run on, which in a container can be fewer than the machine has
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+
+def run_worker(config, sock):
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def start_worker(host, port, sock):
+    max_requests = WORKER_MAX_REQUESTS + random.randint(0, WORKER_MAX_REQUESTS_JITTER) if WORKER_MAX_REQUESTS else None
+    config = uvicorn.Config("main:app", host=host, port=port, limit_max_requests=max_requests,
+                            timeout_graceful_shutdown=WORKER_GRACEFUL_TIMEOUT)
+    # Spawned rather than forked, so that no thread or connection of this process is copied into the worker
+    process = multiprocessing.get_context("spawn").Process(target=run_worker, args=(config, sock), name="worker")
+    process.start()
+    return process
+
+
+def serve(workers, host, port, metrics_dir):
+    """
+        Runs the workers until SIGTERM or SIGINT, replacing those that exit.
+        Args:
+            workers (int): Worker processes kept running.
+            host (str): Address to listen on.
+            port (int): Port to listen on.
+            metrics_dir (str): Directory where the workers write their metrics.
+        """
+    for entry in os.scandir(metrics_dir):
+        # Left by an earlier run; the new workers start counting from zero
+        if entry.name.endswith(".prom"):
+            os.remove(entry.path)
+    sock = uvicorn.Config("main:app", host=host, port=port).bind_socket()
+    processes = [None] * workers
+    restart_at = [0.0] * workers
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    try:
+        while not stopping.is_set():
+            for slot, process in enumerate(processes):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    process.join()
+                    metrics.fold_exited_worker(metrics_dir, process.pid)
+                    if process.exitcode == 0:
+                        logger.info("Worker %d reached its request limit, replacing it", process.pid)
+                    else:
+                        logger.error("Worker %d exited with code %s, replacing it", process.pid, process.exitcode)
+                        restart_at[slot] = time.monotonic() + CRASH_RESTART_DELAY
+                    processes[slot] = None
+                if time.monotonic() >= restart_at[slot]:
+                    processes[slot] = start_worker(host, port, sock)
+            stopping.wait(0.2)
+    finally:
+        running = [process for process in processes if process is not None]
+        for process in running:
+            # uvicorn finishes the requests in flight, for at most WORKER_GRACEFUL_TIMEOUT seconds
+            process.terminate()
+        for process in running:
+            process.join(WORKER_GRACEFUL_TIMEOUT + 5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            metrics.fold_exited_worker(metrics_dir, process.pid)
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY or available_cores(),
+                        help="worker processes. Defaults to WEB_CONCURRENCY, or one per available core")
+    args = parser.parse_args()
+
+    workers = max(args.workers, 1)
+    if DB_CONNECTION_BUDGET and DB_CONNECTION_BUDGET < workers:
+        logger.warning("DB_CONNECTION_BUDGET of %d cannot serve %d workers, starting %d",
+                       DB_CONNECTION_BUDGET, workers, DB_CONNECTION_BUDGET)
+        workers = DB_CONNECTION_BUDGET
+    # The workers read these at import, to size their pools and share their metrics
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    metrics_dir = METRICS_DIR or tempfile.mkdtemp(prefix="blogging-metrics-")
+    os.environ["METRICS_DIR"] = metrics_dir
+    logger.info("Starting %d workers on %s:%d%s", workers, args.host, args.port,
+                f", {DB_CONNECTION_BUDGET // workers} database connections each" if DB_CONNECTION_BUDGET else "")
+    try:
+        serve(workers, args.host, args.port, metrics_dir)
+    finally:
+        if not METRICS_DIR:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,37 @@
+import json
+import os
+
+# The suite sends many requests from one client in quick succession; rate limits have their own tests
+os.environ.setdefault("ADMISSION_RATE", "0")
+
 import pytest
+from pika.exceptions import AMQPConnectionError
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
+from async_routes import router as async_router
 from config import *
-from db_connector import Base, get_db
+from db_connector import Base, get_async_db, get_db
 from main import app
 from models import User
+from passwords import password_pool
 
 client = TestClient(app)
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:5432/{DB_TEST_NAME}"
+SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:{DB_PORT}/{DB_TEST_NAME}"
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+ASYNC_SQLALCHEMY_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_SERVER}:{DB_PORT}/{DB_TEST_NAME}"
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+
+AsyncTestingSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine)
 
 
 @pytest.fixture(scope="session")
@@ -39,11 +57,33 @@ def client(db):
     yield client
 
 
+@pytest.fixture(scope="session")
+def async_client(db):
+    """Client of the app as it runs with USE_ASYNC_DB enabled: the async endpoints instead of the sync ones."""
+    async def override_get_async_db():
+        async with AsyncTestingSessionLocal() as db:
+            yield db
+
+    async_app = FastAPI(default_response_class=ORJSONResponse)
+    async_app.user_middleware = list(app.user_middleware)
+    async_app.include_router(async_router)
+    async_app.dependency_overrides[get_async_db] = override_get_async_db
+    # Entered, so that every request runs on the same event loop
+    with TestClient(async_app) as client:
+        yield client
+
+
+@pytest.fixture(params=["sync", "async"])
+def api_client(request, client, async_client):
+    """Runs the test against the sync endpoints, then against the async ones."""
+    yield client if request.param == "sync" else async_client
+
+
 @pytest.fixture(scope="session")
 def initialize_sample_data(request, db):
     """Initializing testing database with sample records"""
     if not hasattr(request.session, "_sample_data_initialized"):
-        test_data = {"name": "john_doe", "email": "admin@test.com", "password": "admin"}
+        test_data = {"name": "john_doe", "email": "admin@test.com", "password": password_pool.hash("admin")}
         user = User(**test_data)
         db.add(user)
         db.commit()
@@ -51,6 +91,19 @@ def initialize_sample_data(request, db):
     yield
 
 
+@pytest.fixture
+def statements():
+    """SQL statements sent to the test database while the test runs."""
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
+
+
 @pytest.fixture(scope="session")
 def jwt_header(client):
     response = client.post("/api/users/login", json={"email": "admin@test.com", "password": "admin"})
@@ -59,3 +112,51 @@ def jwt_header(client):
         "Authorization": f"Bearer {jwt_token}"
     }
     yield headers
+
+
+class InMemoryBroker:
+    """Stand-in for RabbitMQ that records published messages and can refuse connections."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.connections = 0
+        self.messages = []
+
+    def connect(self):
+        if self.failures:
+            self.failures -= 1
+            raise AMQPConnectionError("broker unavailable")
+        self.connections += 1
+        return InMemoryConnection(self)
+
+
+class InMemoryConnection:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def channel(self):
+        return InMemoryChannel(self.broker)
+
+    def close(self):
+        pass
+
+
+class InMemoryChannel:
+    is_open = True
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def queue_declare(self, queue):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body):
+        self.broker.messages.append((routing_key, json.loads(body)))
+
+
+@pytest.fixture
+def broker():
+    yield InMemoryBroker()
@@ -0,0 +1,75 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from admission import AdmissionControlMiddleware, ConcurrencyLimits, TokenBuckets, route_class
+import utils
+from utils import create_access_token, token_subject
+
+
+def test_token_buckets():
+    now = [0.0]
+    buckets = TokenBuckets(rate=2, burst=2, clock=lambda: now[0])
+    assert buckets.take("a") == buckets.take("a") == 0
+    assert buckets.take("a") == 0.5
+    assert buckets.take("b") == 0
+    now[0] += 0.25
+    assert buckets.take("a") == 0.25
+    now[0] += 0.25
+    assert buckets.take("a") == 0
+    assert TokenBuckets(rate=0).take("a") == 0
+
+
+def test_concurrency_limits():
+    limits = ConcurrencyLimits({"read": 2, "write": 0})
+    assert limits.acquire("read") and limits.acquire("read")
+    assert not limits.acquire("read")
+    limits.release("read")
+    assert limits.acquire("read")
+    assert all(limits.acquire("write") for _ in range(100))
+
+    assert route_class("GET", "/api/blogs/1") == "read"
+    assert route_class("DELETE", "/api/blogs/1") == "write"
+    assert route_class("POST", "/api/users/login") == "login"
+    assert route_class("GET", "/metrics") is None
+
+
+def test_admission_middleware(mocker):
+    now, queue = [0.0], [0]
+    app = FastAPI()
+    app.add_middleware(AdmissionControlMiddleware, buckets=TokenBuckets(rate=1, burst=1, clock=lambda: now[0]),
+                       limits=ConcurrencyLimits({"read": 10, "write": 10, "login": 10}), max_queue=5,
+                       current_queue_depth=lambda: queue[0])
+
+    @app.get("/api/items")
+    def items():
+        return []
+
+    @app.get("/metrics")
+    def metrics():
+        return {}
+
+    client = TestClient(app)
+    assert client.get("/api/items").status_code == 200
+    response = client.get("/api/items")
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+
+    # Tokens are never decoded here: until one is verified, its client is limited by address
+    user_token = create_access_token({"sub": "admission"})
+    user_header = {"Authorization": f"Bearer {user_token}"}
+    decode = mocker.spy(utils.jwt, "decode")
+    assert client.get("/api/items", headers=user_header).status_code == 429
+    assert client.get("/api/items", headers={"Authorization": "Bearer garbage"}).status_code == 429
+    assert decode.call_count == 0
+
+    # Once verified, a token's client is limited by subject
+    token_subject(user_token)
+    assert client.get("/api/items", headers=user_header).status_code == 200
+    assert client.get("/api/items", headers=user_header).status_code == 429
+
+    now[0] += 1
+    queue[0] = 5
+    response = client.get("/api/items")
+    assert response.status_code == 503
+    assert "retry-after" in response.headers
+    assert client.get("/metrics").status_code == 200
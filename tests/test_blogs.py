@@ -1,23 +1,287 @@
-def test_blog_flow(client, initialize_sample_data, jwt_header):
-    response = client.post("/api/blogs",
+import json
+
+from sqlalchemy.orm import sessionmaker
+
+import crud
+from models import Blog
+
+
+def test_blog_flow(api_client, initialize_sample_data, jwt_header):
+    response = api_client.post("/api/blogs",
                            json={"topic": "new", "data": "This a new blog created"},
                            headers=jwt_header)
     assert response.status_code == 201
     blog_id = response.json()["id"]
 
-    response = client.put(f"/api/blogs/{blog_id}",
+    response = api_client.put(f"/api/blogs/{blog_id}",
                           json={"topic": "new2", "data": "This a new2 blog created"},
                           headers=jwt_header)
     assert response.status_code == 200
 
-    response = client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    response = api_client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
     assert response.status_code == 200
     assert response.json()["topic"] == "new2"
 
-    response = client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+    response = api_client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
     assert response.status_code == 200
 
 
-def test_get_all_blogs(client, initialize_sample_data, jwt_header):
-    response = client.get("/api/blogs", headers=jwt_header)
+def test_get_all_blogs(api_client, initialize_sample_data, jwt_header):
+    response = api_client.get("/api/blogs", headers=jwt_header)
     assert response.status_code == 200
+
+
+def test_blogs_pagination(api_client, initialize_sample_data, jwt_header):
+    blog_ids = []
+    for i in range(3):
+        response = api_client.post("/api/blogs",
+                               json={"topic": f"page{i}", "data": "This a paginated blog"},
+                               headers=jwt_header)
+        blog_ids.append(response.json()["id"])
+
+    seen_ids = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["after"] = cursor
+        response = api_client.get("/api/blogs", params=params, headers=jwt_header)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page["items"]) <= 2
+        seen_ids.extend(blog["id"] for blog in page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen_ids == sorted(seen_ids)
+    assert set(blog_ids) <= set(seen_ids)
+
+    response = api_client.get("/api/blogs", params={"after": "not-a-cursor"}, headers=jwt_header)
+    assert response.status_code == 400
+
+    for blog_id in blog_ids:
+        api_client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+
+
+def test_blogs_projection(client, initialize_sample_data, jwt_header, statements):
+    response = client.post("/api/blogs", json={"topic": "projected", "data": "x" * 1000}, headers=jwt_header)
+    blog_id = response.json()["id"]
+
+    statements.clear()
+    response = client.get("/api/blogs", params={"summary": True, "limit": 500}, headers=jwt_header)
+    assert response.status_code == 200
+    item = next(item for item in response.json()["items"] if item["id"] == blog_id)
+    assert item == {"id": blog_id, "topic": "projected", "excerpt": "x" * 200}
+    assert all(".data" not in statement for statement in statements)
+    summary_etag = response.headers["ETag"]
+
+    response = client.get("/api/blogs", params={"fields": "topic,version", "limit": 500}, headers=jwt_header)
+    item = next(item for item in response.json()["items"] if item["topic"] == "projected")
+    assert item == {"topic": "projected", "version": 1}
+
+    response = client.get("/api/blogs", params={"limit": 500}, headers=jwt_header)
+    assert response.headers["ETag"] != summary_etag
+    assert response.json()["items"][-1]["excerpt"] == "x" * 200
+
+    response = client.get("/api/blogs", params={"fields": "id,password"}, headers=jwt_header)
+    assert response.status_code == 400
+
+    client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+
+
+def test_compressed_blog(api_client, initialize_sample_data, jwt_header):
+    data = "A long post about growing tomatoes in raised beds. " * 400
+    response = api_client.post("/api/blogs", json={"topic": "compressed", "data": data}, headers=jwt_header)
+    blog_id = response.json()["id"]
+
+    gzip_header = {**jwt_header, "Accept-Encoding": "gzip"}
+    response = api_client.get(f"/api/blogs/{blog_id}", headers=gzip_header)
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < len(data) / 10
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.json()["data"] == data
+    etag = response.headers["etag"]
+    assert api_client.get(f"/api/blogs/{blog_id}", headers=gzip_header).content == response.content
+
+    identity_header = {**jwt_header, "Accept-Encoding": "identity"}
+    response = api_client.get(f"/api/blogs/{blog_id}", headers=identity_header)
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Accept-Encoding"
+    # Each encoding has its own strong ETag, and either one validates the blog
+    identity_etag = response.headers["etag"]
+    assert etag == identity_etag[:-1] + '-gz"'
+    assert response.json()["data"] == data
+    response = api_client.get(f"/api/blogs/{blog_id}", headers={**gzip_header, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    response = api_client.get(f"/api/blogs/{blog_id}", headers={**identity_header, "If-None-Match": identity_etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == identity_etag
+
+    api_client.put(f"/api/blogs/{blog_id}", json={"topic": "compressed", "data": data + "Updated."}, headers=jwt_header)
+    response = api_client.get(f"/api/blogs/{blog_id}", headers=gzip_header)
+    assert response.headers["etag"] != etag
+    assert response.json()["data"].endswith("Updated.")
+
+    # Large list pages are compressed on the fly
+    response = api_client.get("/api/blogs", headers=gzip_header)
+    assert response.headers["content-encoding"] == "gzip"
+    api_client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+
+
+def test_export_blogs(api_client, initialize_sample_data, jwt_header):
+    response = api_client.post("/api/blogs",
+                           json={"topic": "export", "data": "This a blog to export"},
+                           headers=jwt_header)
+    blog_id = response.json()["id"]
+
+    response = api_client.get("/api/blogs/export", headers=jwt_header)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert {"id": blog_id, "topic": "export", "data": "This a blog to export"} in records
+
+    api_client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+
+
+def test_conditional_get(api_client, initialize_sample_data, jwt_header):
+    response = api_client.post("/api/blogs",
+                           json={"topic": "etag", "data": "This a blog with an etag"},
+                           headers=jwt_header)
+    blog_id = response.json()["id"]
+
+    response = api_client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    response = api_client.get(f"/api/blogs/{blog_id}", headers={**jwt_header, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    response = api_client.get(f"/api/blogs/{blog_id}", headers={**jwt_header, "If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    response = api_client.get("/api/blogs", headers=jwt_header)
+    page_etag = response.headers["ETag"]
+    response = api_client.get("/api/blogs", headers={**jwt_header, "If-None-Match": page_etag})
+    assert response.status_code == 304
+
+    api_client.put(f"/api/blogs/{blog_id}",
+               json={"topic": "etag2", "data": "This a blog with a new etag"},
+               headers=jwt_header)
+    response = api_client.get(f"/api/blogs/{blog_id}", headers={**jwt_header, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    response = api_client.get("/api/blogs", headers={**jwt_header, "If-None-Match": page_etag})
+    assert response.status_code == 200
+
+    api_client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+
+
+def test_page_conditional_get_after_delete(api_client, initialize_sample_data, jwt_header):
+    blogs = [{"topic": "etag page 1", "data": "First"}, {"topic": "etag page 2", "data": "Second"}]
+    response = api_client.post("/api/blogs/bulk", json=blogs, headers=jwt_header)
+    blog_ids = [result["id"] for result in response.json()["results"]]
+    response = api_client.get("/api/blogs", params={"limit": 500}, headers=jwt_header)
+    page_etag = response.headers["ETag"]
+    assert "Last-Modified" not in response.headers
+
+    # Deleting the older blog leaves the latest updated_at on the page as it was
+    api_client.delete(f"/api/blogs/{blog_ids[0]}", headers=jwt_header)
+    for condition in ({"If-None-Match": page_etag}, {"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"}):
+        response = api_client.get("/api/blogs", params={"limit": 500}, headers={**jwt_header, **condition})
+        assert response.status_code == 200
+        assert blog_ids[0] not in [blog["id"] for blog in response.json()["items"]]
+
+    api_client.delete(f"/api/blogs/{blog_ids[1]}", headers=jwt_header)
+
+
+def test_bulk_blog_flow(api_client, initialize_sample_data, jwt_header):
+    response = api_client.post("/api/blogs/bulk",
+                           json=[{"topic": "bulk1", "data": "First bulk blog"},
+                                 {"topic": "bulk2", "data": "Second bulk blog"},
+                                 {"topic": "bulk1", "data": "Duplicate topic"}],
+                           headers=jwt_header)
+    assert response.status_code == 201
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["created", "created", "conflict"]
+    first_id, second_id = results[0]["id"], results[1]["id"]
+
+    response = api_client.post("/api/blogs/bulk", json=[{"topic": "bulk1", "data": "Taken"}], headers=jwt_header)
+    assert response.status_code == 200
+    assert response.json()["success"] is False
+
+    response = api_client.put("/api/blogs/bulk",
+                          json=[{"id": first_id, "topic": "bulk1b", "data": "First bulk blog updated"},
+                                {"id": second_id, "topic": "bulk1b", "data": "Topic taken by the first item"},
+                                {"id": 0, "topic": "bulk3", "data": "Missing blog"}],
+                          headers=jwt_header)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == ["updated", "conflict", "not_found"]
+
+    response = api_client.get(f"/api/blogs/{first_id}", headers=jwt_header)
+    assert response.json()["topic"] == "bulk1b"
+
+    response = api_client.request("DELETE", "/api/blogs/bulk", json=[first_id, second_id, 0], headers=jwt_header)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == ["deleted", "deleted", "not_found"]
+    assert response.json()["results"][0] == {"id": first_id, "status": "deleted"}
+    assert api_client.get(f"/api/blogs/{first_id}", headers=jwt_header).json() is None
+
+    response = api_client.post("/api/blogs/bulk", json=[], headers=jwt_header)
+    assert response.status_code == 422
+
+
+def test_bulk_update_topic_taken_concurrently(db, mocker):
+    blog = crud.create_blog(db, "race1", "Renamed while another blog takes its new topic")
+    other_session = sessionmaker(bind=db.get_bind())
+    bulk_update_plan = crud.bulk_update_plan
+
+    def take_topic_after_owners_read(blogs, owners):
+        if "race2" not in owners:
+            with other_session() as other:
+                other.add(Blog(topic="race2", data="Took the topic first"))
+                other.commit()
+        return bulk_update_plan(blogs, owners)
+
+    mocker.patch("crud.bulk_update_plan", side_effect=take_topic_after_owners_read)
+    results = crud.update_blogs(db, [(blog.id, "race2", "Renamed")])
+    assert results == [{"id": blog.id, "topic": "race2", "status": "conflict", "detail": "Topic already exists"}]
+    assert crud.read_blog(db, blog.id).topic == "race1"
+
+    db.query(Blog).filter(Blog.topic.in_(["race1", "race2"])).delete()
+    db.commit()
+
+
+def test_search_blogs(api_client, initialize_sample_data, jwt_header):
+    blogs = [{"topic": f"search gardening {index}", "data": "Growing tomatoes in raised beds"} for index in range(3)]
+    blogs.append({"topic": "search cooking", "data": "A quick tomato sauce for gardening season"})
+    response = api_client.post("/api/blogs/bulk", json=blogs, headers=jwt_header)
+    blog_ids = [result["id"] for result in response.json()["results"]]
+
+    response = api_client.get("/api/blogs/search", params={"q": "tomato", "limit": 2}, headers=jwt_header)
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page["items"]) == 2
+    assert "<b>" in page["items"][0]["snippet"]
+    found = [item["id"] for item in page["items"]]
+    while page["next_cursor"]:
+        response = api_client.get("/api/blogs/search", params={"q": "tomato", "limit": 2, "after": page["next_cursor"]},
+                              headers=jwt_header)
+        page = response.json()
+        found.extend(item["id"] for item in page["items"])
+    assert sorted(found) == sorted(blog_ids)
+
+    # Topic matches are weighted above body matches
+    response = api_client.get("/api/blogs/search", params={"q": "gardening"}, headers=jwt_header)
+    items = response.json()["items"]
+    assert items[-1]["id"] == blog_ids[-1]
+    assert items[0]["rank"] > items[-1]["rank"]
+
+    response = api_client.get("/api/blogs/search", params={"q": "tomato", "after": "not-a-cursor"}, headers=jwt_header)
+    assert response.status_code == 400
+
+    api_client.request("DELETE", "/api/blogs/bulk", json=blog_ids, headers=jwt_header)
+    response = api_client.get("/api/blogs/search", params={"q": "tomato"}, headers=jwt_header)
+    assert response.json()["items"] == []
@@ -0,0 +1,139 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import timedelta
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import utils
+from config import DB_TEST_NAME
+from cache import LRUCache
+from utils import create_access_token, verify_access_token, token_cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache_expires_entries():
+    clock = FakeClock()
+    lru = LRUCache(max_size=10, ttl=30, clock=clock)
+    lru.set("blog:1", {"id": 1})
+    assert lru.get("blog:1") == {"id": 1}
+
+    clock.now = 31
+    assert lru.get("blog:1") is None
+    assert lru.stats()["hits"] == 1
+    assert lru.stats()["misses"] == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache(max_size=2, ttl=30)
+    lru.set("blog:1", {"id": 1})
+    lru.set("blog:2", {"id": 2})
+    lru.get("blog:1")
+    lru.set("blog:3", {"id": 3})
+
+    assert lru.get("blog:2") is None
+    assert lru.get("blog:1") == {"id": 1}
+    assert lru.stats()["evictions"] == 1
+    assert lru.stats()["size"] == 2
+
+
+def test_blog_reads_are_cached_and_invalidated(client, initialize_sample_data, jwt_header):
+    response = client.post("/api/blogs", json={"topic": "cached", "data": "This a cached blog"}, headers=jwt_header)
+    blog_id = response.json()["id"]
+
+    client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    hits = client.get("/api/cache/stats", headers=jwt_header).json()["records"]["hits"]
+    response = client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert response.json()["topic"] == "cached"
+    assert client.get("/api/cache/stats", headers=jwt_header).json()["records"]["hits"] == hits + 1
+
+    client.put(f"/api/blogs/{blog_id}", json={"topic": "cached2", "data": "This a cached blog"}, headers=jwt_header)
+    response = client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert response.json()["topic"] == "cached2"
+
+    client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+    response = client.get(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert response.json() is None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def workers(db):
+    """Two servers of the app on the test database, as serve.py runs them: each with its own caches."""
+    env = {**os.environ, "DB_NAME": DB_TEST_NAME, "WEB_CONCURRENCY": "2", "OUTBOX_RELAY_WORKERS": "0",
+           "ADMISSION_RATE": "0", "METRICS_DIR": ""}
+    ports = [free_port(), free_port()]
+    processes = [subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for port in ports]
+    clients = [httpx.Client(base_url=f"http://127.0.0.1:{port}") for port in ports]
+    try:
+        deadline = time.monotonic() + 30
+        for worker in clients:
+            while True:
+                try:
+                    if worker.get("/healthz").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                assert time.monotonic() < deadline, "the workers did not start"
+                time.sleep(0.1)
+        yield clients
+    finally:
+        for worker in clients:
+            worker.close()
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def test_caches_are_coherent_across_workers(workers, initialize_sample_data, jwt_header):
+    first, second = workers
+    response = first.post("/api/blogs", json={"topic": "workers", "data": "Read by two workers"}, headers=jwt_header)
+    blog_id = response.json()["id"]
+    user_id = first.get("/api/users/", headers=jwt_header).json()["items"][0]["id"]
+    user = second.get(f"/api/users/{user_id}", headers=jwt_header).json()
+    for worker in workers:
+        assert worker.get(f"/api/blogs/{blog_id}", headers=jwt_header).json()["topic"] == "workers"
+    etag = second.get(f"/api/blogs/{blog_id}", headers=jwt_header).headers["etag"]
+
+    # Written through the first worker, after the second one cached the blog and the user
+    first.put(f"/api/blogs/{blog_id}", json={"topic": "workers2", "data": "Updated"}, headers=jwt_header)
+    first.put(f"/api/users/{user_id}", json={"name": "renamed", "email": user["email"], "password": "admin"},
+              headers=jwt_header)
+    assert second.get(f"/api/blogs/{blog_id}", headers=jwt_header).json()["topic"] == "workers2"
+    assert second.get(f"/api/blogs/{blog_id}", headers={**jwt_header, "If-None-Match": etag}).status_code == 200
+    assert second.get(f"/api/users/{user_id}", headers=jwt_header).json()["name"] == "renamed"
+
+    first.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert second.get(f"/api/blogs/{blog_id}", headers=jwt_header).json() is None
+    first.put(f"/api/users/{user_id}", json={**user, "password": "admin"}, headers=jwt_header)
+
+
+def test_verified_tokens_are_cached_until_expiry(mocker):
+    token = create_access_token({"sub": "42"}, expires_delta=timedelta(minutes=5))
+    decode = mocker.spy(utils.jwt, "decode")
+
+    assert verify_access_token(token) == "42"
+    assert verify_access_token(token) == "42"
+    assert decode.call_count == 1
+    assert token_cache.stats()["hits"] >= 1
+
+    expired = create_access_token({"sub": "42"}, expires_delta=timedelta(seconds=-1))
+    with pytest.raises(HTTPException):
+        verify_access_token(expired)
@@ -0,0 +1,21 @@
+import gzip
+
+from compression import accepts_gzip, compress
+
+
+def test_accepts_gzip():
+    assert accepts_gzip("gzip, deflate, br")
+    assert accepts_gzip("br;q=1.0, gzip;q=0.8")
+    assert accepts_gzip("*")
+    assert accepts_gzip("x-gzip")
+    assert not accepts_gzip("")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("*, gzip;q=0")
+    assert not accepts_gzip("gzip;q=invalid")
+
+
+def test_compress_is_deterministic():
+    body = b'{"data": "' + b"tomato " * 1000 + b'"}'
+    assert compress(body) == compress(body)
+    assert gzip.decompress(compress(body)) == body
@@ -0,0 +1,53 @@
+import asyncio
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import lifecycle
+from lifecycle import Readiness, warm_pool
+
+
+def test_warm_pool(db, statements):
+    engine = db.get_bind()
+    engine.dispose()
+    # Each of the three connections runs the six hot queries
+    warm_pool(sessionmaker(bind=engine), 3)
+    assert engine.pool.checkedin() == 3
+    assert len(statements) == 3 * 6
+
+
+def test_readiness_retries_warm_up():
+    attempts = []
+
+    async def warm_up():
+        attempts.append(len(attempts))
+        if len(attempts) == 1:
+            raise OperationalError("SELECT 1", {}, ConnectionRefusedError("database starting"))
+        if len(attempts) == 2:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+
+    async def run():
+        readiness = Readiness(warm_up=warm_up, max_backoff=0.01)
+        readiness.start()
+        await asyncio.sleep(0)
+        assert not readiness.ready and "database starting" in readiness.error
+        # Errors of any kind are retried
+        for _ in range(100):
+            if readiness.ready:
+                break
+            await asyncio.sleep(0.01)
+        assert readiness.ready and readiness.error is None
+        await readiness.stop()
+        assert not readiness.ready
+
+    asyncio.run(run())
+    assert attempts == [0, 1, 2]
+
+
+def test_probes(client, monkeypatch):
+    assert client.get("/healthz").json() == {"status": "ok"}
+    monkeypatch.setattr(lifecycle.readiness, "ready", False)
+    assert client.get("/readyz").status_code == 503
+    monkeypatch.setattr(lifecycle.readiness, "ready", True)
+    response = client.get("/readyz")
+    assert response.status_code == 200 and response.json() == {"ready": True}
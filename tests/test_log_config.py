@@ -0,0 +1,35 @@
+import json
+import logging
+
+from log_config import DebugSamplingFilter, JsonFormatter, RequestIdFilter, request_id
+
+
+def make_record(level=logging.INFO):
+    return logging.LogRecord("log_config", level, __file__, 1, "Read blog %s", (7,), None)
+
+
+def test_json_formatter_includes_request_id():
+    token = request_id.set("abc123")
+    try:
+        record = make_record()
+        RequestIdFilter().filter(record)
+    finally:
+        request_id.reset(token)
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Read blog 7"
+    assert entry["request_id"] == "abc123"
+    assert entry["level"] == "INFO"
+
+
+def test_debug_sampling():
+    drop_all = DebugSamplingFilter(0)
+    assert not drop_all.filter(make_record(logging.DEBUG))
+    assert drop_all.filter(make_record(logging.WARNING))
+    assert DebugSamplingFilter(1).filter(make_record(logging.DEBUG))
+
+
+def test_request_id_header(client, initialize_sample_data, jwt_header, caplog):
+    response = client.get("/api/blogs", headers={**jwt_header, "X-Request-ID": "req-1"})
+    assert response.headers["x-request-id"] == "req-1"
+    assert [record.request_id for record in caplog.records if record.getMessage() == "Read blogs page"] == ["req-1"]
+    assert len(client.get("/api/blogs", headers=jwt_header).headers["x-request-id"]) == 32
@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+from sqlalchemy import func
+
+import metrics
+from models import Outbox
+
+
+def sample(text, prefix):
+    return next(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(prefix))
+
+
+def test_metrics(client, db, initialize_sample_data, jwt_header):
+    metrics.instrument_engine(db.get_bind())
+    labels = 'method="GET",route="/api/blogs"'
+    before = client.get("/metrics").text
+    count_before = sample(before, f"http_request_duration_seconds_count{{{labels}}}")
+
+    response = client.get("/api/blogs", headers=jwt_header)
+    assert response.status_code == 200
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert sample(text, f"http_request_duration_seconds_count{{{labels}}}") == count_before + 1
+    assert sample(text, f'http_responses_total{{{labels},status="200"}}') >= 1
+    assert sample(text, f"http_requests_in_flight{{{labels}}}") == 0
+    assert sample(text, f"http_response_size_bytes_sum{{{labels}}}") > 0
+    assert sample(text, f"http_request_db_statements_sum{{{labels}}}") >= 1
+    assert sample(text, 'db_pool_checkouts_total{engine="sync"}') >= 0
+    assert "# TYPE http_request_duration_seconds histogram" in text
+
+
+def test_slow_request_log(client, db, initialize_sample_data, jwt_header, mocker, caplog):
+    metrics.instrument_engine(db.get_bind())
+    mocker.patch("metrics.SLOW_REQUEST_THRESHOLD", 1e-9)
+    client.get("/api/blogs", headers=jwt_header)
+    slow = [record.getMessage() for record in caplog.records if record.getMessage().startswith("Slow request")]
+    assert slow and "GET /api/blogs took" in slow[0]
+    assert "SELECT" in slow[0]
+
+
+def test_outbox_backlog_metrics(client, db):
+    db.add(Outbox(queue="email_queue", payload="{}", created_at=func.now() - timedelta(minutes=5)))
+    db.commit()
+    try:
+        text = client.get("/metrics").text
+        assert sample(text, "outbox_pending_messages") >= 1
+        assert sample(text, "outbox_oldest_pending_age_seconds") >= 300
+        assert "# TYPE outbox_pending_messages gauge" in text
+    finally:
+        db.query(Outbox).filter(Outbox.queue == "email_queue", Outbox.payload == "{}").delete()
+        db.commit()
+
+
+def test_worker_metrics(tmp_path):
+    def exposition(responses, in_flight, lag):
+        return "\n".join([
+            *metrics.family("http_responses_total", "counter", "Responses.",
+                            [f'http_responses_total{{status="200"}} {responses}']),
+            *metrics.family("http_requests_in_flight", "gauge", "In flight.", [f"http_requests_in_flight {in_flight}"]),
+            *metrics.family("db_replica_lag_seconds", "gauge", "Lag.", [f"db_replica_lag_seconds {lag}"]),
+            *metrics.family("outbox_pending_messages", "gauge", "Pending.", [f"outbox_pending_messages {responses}"]),
+        ]) + "\n"
+
+    directory = str(tmp_path)
+    metrics.write_snapshot(metrics.snapshot_path(directory, 1), exposition(5, 2, 1.5))
+    metrics.write_snapshot(metrics.snapshot_path(directory, 2), exposition(7, 1, 0.5))
+    text = metrics.collect(directory, exposition(1, 1, 0.25))
+    assert sample(text, "http_responses_total") == 13
+    assert sample(text, "http_requests_in_flight") == 4
+    assert sample(text, "db_replica_lag_seconds") == 1.5
+    # Every worker measures the same outbox
+    assert sample(text, "outbox_pending_messages") == 7
+
+    # Counters of exited workers are kept, their gauges are not
+    metrics.fold_exited_worker(directory, 1)
+    text = metrics.collect(directory, exposition(1, 1, 0.25))
+    assert sample(text, "http_responses_total") == 13
+    assert sample(text, "http_requests_in_flight") == 2
+    metrics.fold_exited_worker(directory, 2)
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == [metrics.EXITED_WORKERS]
+    assert sample(metrics.collect(directory, exposition(1, 1, 0.25)), "http_responses_total") == 13
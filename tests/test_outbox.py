@@ -0,0 +1,51 @@
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from models import Outbox, User
+from outbox_relay import OutboxRelay
+
+
+def test_register_writes_outbox_event(client, db, broker):
+    response = client.post("/api/users/register",
+                           json={"name": "outbox", "email": "outbox@test.com", "password": "password"})
+    assert response.status_code == 201
+
+    db.rollback()
+    events = db.query(Outbox).filter(Outbox.payload.contains("outbox@test.com")).all()
+    assert len(events) == 1
+    assert events[0].queue == "email_queue"
+
+    relay = OutboxRelay(session_factory=sessionmaker(bind=db.get_bind()), connection_factory=broker.connect,
+                        batch_size=2)
+    while relay.relay_once():
+        pass
+
+    assert ("email_queue", {"template_data": {"name": "outbox", "country": "Delhi"},
+                            "email": "outbox@test.com", "type": "register_user"}) in broker.messages
+    db.rollback()
+    assert db.query(Outbox).count() == 0
+
+    db.query(User).filter(User.email == "outbox@test.com").delete()
+    db.commit()
+
+
+def test_relay_reconnects_after_broker_failure(client, db, broker):
+    response = client.post("/api/users/register",
+                           json={"name": "relayed", "email": "relayed@test.com", "password": "password"})
+    assert response.status_code == 201
+
+    broker.failures = 2
+    relay = OutboxRelay(session_factory=sessionmaker(bind=db.get_bind()), connection_factory=broker.connect,
+                        poll_interval=0.01, max_backoff=0.01)
+    relay.start()
+    deadline = time.monotonic() + 5
+    while not broker.messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    relay.stop()
+
+    assert [message["email"] for _, message in broker.messages] == ["relayed@test.com"]
+    assert broker.connections == 1
+
+    db.query(User).filter(User.email == "relayed@test.com").delete()
+    db.commit()
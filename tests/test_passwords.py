@@ -0,0 +1,40 @@
+import pytest
+from argon2 import PasswordHasher
+
+from passwords import PasswordHashingOverloaded, PasswordPool
+
+
+def cheap_hasher(time_cost=1):
+    return PasswordHasher(time_cost=time_cost, memory_cost=64, parallelism=1)
+
+
+def test_hash_and_verify():
+    pool = PasswordPool(cheap_hasher(), workers=2)
+    stored = pool.hash("secret")
+    assert stored.startswith("$argon2id$")
+    assert pool.verify(stored, "secret") == (True, None)
+    assert pool.verify(stored, "wrong") == (False, None)
+    assert pool.verify(None, "secret") == (False, None)
+
+
+def test_rehash_on_login():
+    stored = PasswordPool(cheap_hasher(time_cost=1)).hash("secret")
+    valid, new_hash = PasswordPool(cheap_hasher(time_cost=2)).verify(stored, "secret")
+    assert valid
+    assert "t=2" in new_hash
+
+    # Passwords stored before hashing was introduced, only accepted while the migration is enabled
+    migrating = PasswordPool(cheap_hasher(), accept_plaintext=True)
+    valid, new_hash = migrating.verify("secret", "secret")
+    assert valid and new_hash.startswith("$argon2id$")
+    assert migrating.verify("secret", "wrong") == (False, None)
+    assert PasswordPool(cheap_hasher(), accept_plaintext=False).verify("secret", "secret") == (False, None)
+
+
+def test_overloaded():
+    pool = PasswordPool(cheap_hasher(), workers=1, max_pending=1)
+    pool._pending.acquire()
+    with pytest.raises(PasswordHashingOverloaded):
+        pool.hash("secret")
+    pool._pending.release()
+    assert pool.verify(pool.hash("secret"), "secret")[0]
@@ -0,0 +1,49 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+import db_connector
+from pool_metrics import PoolMetrics, instrument, instrumented_pool_class
+
+
+def test_pool_metrics(db):
+    metrics = PoolMetrics()
+    engine = create_engine(db.get_bind().url, poolclass=instrumented_pool_class(QueuePool, metrics),
+                           pool_size=1, max_overflow=0, pool_timeout=0.1)
+    instrument(engine, metrics)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            assert metrics.stats(engine.pool)["in_use"] == 1
+            with pytest.raises(PoolTimeoutError):
+                engine.connect()
+        stats = metrics.stats(engine.pool)
+        assert stats["pool"] == "QueuePool"
+        assert stats["checkouts"] == stats["checkins"] == 1
+        assert stats["in_use"] == 0
+        assert stats["connects"] == 1
+        assert stats["timeouts"] == 1
+        assert stats["wait_seconds_max"] >= 0.1
+    finally:
+        engine.dispose()
+
+
+def test_db_stats(client, jwt_header):
+    response = client.get("/api/db/stats", headers=jwt_header)
+    assert response.status_code == 200
+    assert {"in_use", "timeouts", "wait_seconds_avg"} <= response.json()["sync"].keys()
+
+
+def test_pool_sizes(mocker):
+    mocker.patch.multiple("db_connector", DB_CONNECTION_BUDGET=100, WEB_CONCURRENCY=8, OUTBOX_RELAY_WORKERS=2,
+                          USE_ASYNC_DB=False)
+    assert db_connector.pool_sizes() == ((12, 0), (1, 0))
+    mocker.patch("db_connector.USE_ASYNC_DB", True)
+    # The connections of the relays, the view counter and the warm-up come out of the worker's share
+    assert db_connector.pool_sizes() == ((4, 0), (8, 0))
+    mocker.patch("db_connector.OUTBOX_RELAY_WORKERS", 0)
+    assert db_connector.pool_sizes() == ((2, 0), (10, 0))
+    assert db_connector.pool_sizes(background_work=False) == ((1, 0), (12, 0))
+    mocker.patch("db_connector.DB_CONNECTION_BUDGET", 0)
+    assert db_connector.pool_sizes() == ((db_connector.DB_POOL_SIZE, db_connector.DB_MAX_OVERFLOW),) * 2
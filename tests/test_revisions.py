@@ -0,0 +1,74 @@
+from sqlalchemy import select
+
+from models import BlogRevision
+from revisions import apply_delta, make_delta, past_revision
+
+
+def test_deltas():
+    newer = "A post.\nIts second line. With two sentences!\nThe end."
+    older = "A post.\nIts second line. With one sentence!\nThe end."
+    delta = make_delta(newer, older)
+    assert apply_delta(newer, delta) == older
+    # Only the changed sentence is stored
+    assert "A post" not in delta and "The end" not in delta
+    assert apply_delta("", make_delta("", older)) == older
+    assert apply_delta(newer, make_delta(newer, "")) == ""
+
+    assert not past_revision(1, 3, "topic", older, None, newer, snapshot_interval=10)["snapshot"]
+    snapshot = past_revision(1, 10, "topic", older, None, newer, snapshot_interval=10)
+    assert snapshot["snapshot"] and snapshot["content"] == older
+    # A delta that would be larger than the text is not worth storing
+    assert past_revision(1, 3, "topic", "Short.", None, newer, snapshot_interval=10)["snapshot"]
+
+
+def test_revision_history(client, db, initialize_sample_data, jwt_header, statements):
+    texts = ["Revised post.\nFirst paragraph."]
+    response = client.post("/api/blogs", json={"topic": "revised 1", "data": texts[0]}, headers=jwt_header)
+    blog_id = response.json()["id"]
+    for version in range(2, 13):
+        edited = texts[-1].replace("First", f"Edit {version}.") if version % 2 else texts[-1] + f"\nMore {version}."
+        texts.append(edited)
+        response = client.put(f"/api/blogs/{blog_id}", json={"topic": f"revised {version}", "data": edited},
+                              headers=jwt_header)
+        assert response.status_code == 200
+
+    snapshots = db.execute(select(BlogRevision.revision).where(BlogRevision.blog_id == blog_id,
+                                                               BlogRevision.snapshot)).scalars().all()
+    assert snapshots == [10]
+
+    for revision, text in enumerate(texts, start=1):
+        statements.clear()
+        response = client.get(f"/api/blogs/{blog_id}/revisions/{revision}", headers=jwt_header)
+        assert response.status_code == 200
+        assert response.json()["data"] == text
+        assert response.json()["topic"] == f"revised {revision}"
+        assert len(statements) == 1
+
+    response = client.get(f"/api/blogs/{blog_id}/revisions", params={"limit": 5}, headers=jwt_header)
+    page = response.json()
+    assert [item["revision"] for item in page["items"]] == [12, 11, 10, 9, 8]
+    assert page["items"][0]["size"] == len(texts[-1])
+    response = client.get(f"/api/blogs/{blog_id}/revisions", params={"limit": 10, "after": page["next_cursor"]},
+                          headers=jwt_header)
+    assert [item["revision"] for item in response.json()["items"]] == [7, 6, 5, 4, 3, 2, 1]
+    assert response.json()["next_cursor"] is None
+
+    response = client.get(f"/api/blogs/{blog_id}/revisions/diff", params={"from": 1, "to": 2}, headers=jwt_header)
+    assert response.status_code == 200
+    assert response.json()["from_topic"] == "revised 1" and response.json()["to_topic"] == "revised 2"
+    assert response.json()["diff"].splitlines()[-1] == "+More 2."
+
+    response = client.put("/api/blogs/bulk", json=[{"id": blog_id, "topic": "revised 13", "data": "Rewritten."}],
+                          headers=jwt_header)
+    assert response.json()["results"][0]["status"] == "updated"
+    response = client.get(f"/api/blogs/{blog_id}/revisions/12", headers=jwt_header)
+    assert response.json()["data"] == texts[-1]
+
+    assert client.get(f"/api/blogs/{blog_id}/revisions/14", headers=jwt_header).status_code == 404
+    response = client.get(f"/api/blogs/{blog_id}/revisions/diff", params={"from": 0, "to": 2}, headers=jwt_header)
+    assert response.status_code == 404
+    assert client.get("/api/blogs/0/revisions", headers=jwt_header).status_code == 404
+
+    # Deleting the blog deletes its history
+    client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert not db.execute(select(BlogRevision).where(BlogRevision.blog_id == blog_id)).all()
@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud
+from db_connector import Base
+from models import Blog
+
+
+def test_sqlite_fts5_fallback():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    try:
+        db.add_all([Blog(topic="tomato gardening", data="Raised beds"),
+                    Blog(topic="cooking", data="A quick tomato sauce"),
+                    Blog(topic="cycling", data="Mountain trails")])
+        db.commit()
+
+        rows = crud.search_blogs(db, "tomato", 10)
+        assert [row.topic for row in rows] == ["tomato gardening", "cooking"]
+        assert "<b>tomato</b>" in rows[1].snippet
+
+        page = crud.search_blogs(db, "tomato", 1, after=(rows[0].rank, rows[0].id))
+        assert [row.topic for row in page] == ["cooking"]
+
+        cooking = db.query(Blog).filter(Blog.topic == "cooking").one()
+        cooking.data = "Pasta with pesto"
+        db.commit()
+        assert [row.topic for row in crud.search_blogs(db, "tomato", 10)] == ["tomato gardening"]
+        # Query syntax characters are matched literally instead of raising
+        assert crud.search_blogs(db, 'tomato" OR', 10) == []
+        assert crud.search_blogs(db, "   ", 10) == []
+    finally:
+        db.close()
+        Base.metadata.drop_all(bind=engine)
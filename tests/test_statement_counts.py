@@ -0,0 +1,67 @@
+def test_write_endpoints_issue_one_statement(client, initialize_sample_data, jwt_header, statements):
+    response = client.post("/api/users/register",
+                           json={"name": "count", "email": "count@test.com", "password": "password"})
+    assert response.status_code == 201
+    assert len(statements) == 1
+    user_id = response.json()["id"]
+
+    statements.clear()
+    response = client.post("/api/users/register",
+                           json={"name": "count", "email": "count@test.com", "password": "password"})
+    assert response.status_code == 403
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.put(f"/api/users/{user_id}",
+                          json={"name": "count2", "email": "count@test.com", "password": "password"},
+                          headers=jwt_header)
+    assert response.status_code == 200
+    assert response.json()["name"] == "count2"
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.put(f"/api/users/{user_id}",
+                          json={"name": "count2", "email": "admin@test.com", "password": "password"},
+                          headers=jwt_header)
+    assert response.status_code == 409
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.delete(f"/api/users/{user_id}", headers=jwt_header)
+    assert response.status_code == 200
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.delete(f"/api/users/{user_id}", headers=jwt_header)
+    assert response.status_code == 404
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.post("/api/blogs", json={"topic": "count", "data": "Counted blog"}, headers=jwt_header)
+    assert response.status_code == 201
+    assert len(statements) == 1
+    blog_id = response.json()["id"]
+
+    statements.clear()
+    response = client.post("/api/blogs", json={"topic": "count", "data": "Same topic"}, headers=jwt_header)
+    assert response.status_code == 409
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.put(f"/api/blogs/{blog_id}", json={"topic": "count2", "data": "Counted blog"},
+                          headers=jwt_header)
+    assert response.status_code == 200
+    assert response.json()["version"] == 2
+    # The update, then the revision it replaced
+    assert len(statements) == 2
+
+    statements.clear()
+    response = client.delete(f"/api/blogs/{blog_id}", headers=jwt_header)
+    assert response.status_code == 200
+    assert len(statements) == 1
+
+    statements.clear()
+    response = client.put(f"/api/blogs/{blog_id}", json={"topic": "count3", "data": "Counted blog"},
+                          headers=jwt_header)
+    assert response.status_code == 404
+    assert len(statements) == 1
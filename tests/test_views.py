@@ -0,0 +1,103 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import crud
+import views
+from db_connector import Base
+from views import ViewCounter
+
+
+@pytest.fixture
+def view_counter(db, monkeypatch):
+    counter = ViewCounter(session_factory=sessionmaker(bind=db.get_bind()), top_size=2)
+    monkeypatch.setattr(views, "view_counter", counter)
+    yield counter
+
+
+def test_view_counts(client, initialize_sample_data, jwt_header, view_counter, statements, mocker):
+    ids = {}
+    for topic in ("most read", "least read", "often read"):
+        response = client.post("/api/blogs", json={"topic": topic, "data": f"About {topic}"}, headers=jwt_header)
+        ids[topic] = response.json()["id"]
+
+    def read(topic, times):
+        for _ in range(times):
+            assert client.get(f"/api/blogs/{ids[topic]}", headers=jwt_header).status_code == 200
+
+    def popular():
+        response = client.get("/api/blogs/popular", headers=jwt_header)
+        assert response.status_code == 200
+        return [(item["topic"], item["views"]) for item in response.json()["items"]]
+
+    # Reads are only counted in memory
+    statements.clear()
+    read("most read", 3)
+    read("least read", 1)
+    read("often read", 2)
+    assert not any(statement.lstrip().startswith(("INSERT", "UPDATE")) for statement in statements)
+    assert view_counter.flush() == 3
+    assert popular() == [("most read", 3), ("often read", 2)]
+
+    # A conditional read that is answered with 304 is a view too
+    etag = client.get(f"/api/blogs/{ids['least read']}", headers=jwt_header).headers["etag"]
+    response = client.get(f"/api/blogs/{ids['least read']}", headers={**jwt_header, "If-None-Match": etag})
+    assert response.status_code == 304
+    read("least read", 3)
+    view_counter.flush()
+    assert popular() == [("least read", 6), ("most read", 3)]
+
+    # A failed flush keeps its counts for the next one
+    mocker.patch("crud.flush_views", side_effect=OperationalError("UPDATE", {}, Exception("connection lost")))
+    read("often read", 2)
+    with pytest.raises(OperationalError):
+        view_counter.flush()
+    assert view_counter.pending == 1
+    mocker.stopall()
+    view_counter.flush()
+    assert popular() == [("least read", 6), ("often read", 4)]
+
+    # Deleting a ranked blog lets the next flush rank the others again
+    client.delete(f"/api/blogs/{ids['least read']}", headers=jwt_header)
+    read("most read", 1)
+    view_counter.flush()
+    assert popular() == [("most read", 4), ("often read", 4)]
+
+    for topic in ("most read", "often read"):
+        client.delete(f"/api/blogs/{ids[topic]}", headers=jwt_header)
+
+
+def test_view_counts_on_sqlite():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine, expire_on_commit=False)
+    db = session_factory()
+    ids = [crud.create_blog(db, f"sqlite {number}", "Counted on SQLite").id for number in range(3)]
+
+    counter = ViewCounter(session_factory=session_factory, top_size=2)
+    for blog_id, views in zip(ids, (2, 5, 1)):
+        for _ in range(views):
+            counter.record(blog_id)
+    counter.record(ids[-1] + 1)
+    assert counter.flush() == 4
+    counter.record(ids[0])
+    counter.record(ids[2])
+    counter.flush()
+
+    assert [(row.id, row.views) for row in crud.read_popular_blogs(db, 2)] == [(ids[1], 5), (ids[0], 3)]
+    db.close()
+
+
+def test_flush_thread_survives_errors(mocker):
+    counter = ViewCounter(session_factory=mocker.Mock(), interval=0.01)
+    flush = mocker.patch.object(counter, "flush", side_effect=[TypeError("bad counts"), 0, 0, 0])
+    counter.start()
+    deadline = time.monotonic() + 5
+    while flush.call_count < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert flush.call_count >= 2
+    counter.stop()
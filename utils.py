@@ -1,19 +1,29 @@
 from __future__ import annotations
 
-from datetime import timedelta, datetime
+import base64
+import binascii
+import hashlib
+import json
+import time
+from datetime import timedelta, datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 from typing import Annotated
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from starlette import status
 
-from config import SECRET_KEY
+from cache import LRUCache
+from config import SECRET_KEY, TOKEN_CACHE_MAX_SIZE
 from log_config import logger
 
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Subjects of tokens that already passed jwt.decode, keyed by SHA-256 of the token, each kept until its exp
+token_cache = LRUCache(max_size=TOKEN_CACHE_MAX_SIZE, ttl=0)
+
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     """
@@ -43,30 +53,286 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-def verify_access_token(token: Annotated[str, Depends(oauth2_scheme)]):
+def verified_token_subject(token: str):
+    """The subject of a token already verified by token_subject and not expired, or None, without decoding it."""
+    return token_cache.get(hashlib.sha256(token.encode()).hexdigest())
+
+
+def token_subject(token: str):
     """
-        Verifies the provided access token.
+        Verifies an access token, skipping the signature check for tokens verified before.
         Args:
             token (str): The access token to verify.
         Returns:
-            bool: True if the token is valid, otherwise raises an HTTPException.
+            str | None: The subject (user id) of the token, or None if the token is invalid or has expired.
         """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+    token_key = hashlib.sha256(token.encode()).hexdigest()
+    sub = token_cache.get(token_key)
+    if sub is not None:
+        return sub
+
     try:
         # Decode the token using the secret key and algorithm
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError as exc:
+        logger.warning("Token verification failed with following exception: %s", exc)
+        return None
 
-        # Extract the subject claim from the payload
-        sub: str = payload.get("sub")
+    # Extract the subject claim from the payload
+    sub = payload.get("sub")
+    if sub is None:
+        return None
 
-        # If subject is None, raise credentials_exception
-        if sub is None:
-            raise credentials_exception
-    except JWTError as exc:
-        logger.warning(f"Token verification failed with following exception: {exc}")
-        raise credentials_exception
-    return True
+    # jwt.decode has checked exp, so the token stays valid until then
+    expires_at = payload.get("exp")
+    if expires_at is not None:
+        token_cache.set(token_key, sub, ttl=expires_at - time.time())
+    return sub
+
+
+def verify_access_token(token: Annotated[str, Depends(oauth2_scheme)]):
+    """
+        Verifies the provided access token, skipping the signature check for tokens verified before.
+        Args:
+            token (str): The access token to verify.
+        Returns:
+            str: The subject (user id) of the token if it is valid, otherwise raises an HTTPException.
+        """
+    sub = token_subject(token)
+    if sub is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return sub
+
+
+def encode_cursor(last_id: int) -> str:
+    """
+        Encodes the id of the last row of a page into an opaque pagination cursor.
+        Args:
+            last_id (int): The id of the last record returned on the current page.
+        Returns:
+            str: A URL-safe cursor to pass back as the `after` query parameter.
+        """
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str | None) -> int | None:
+    """
+        Decodes a pagination cursor produced by encode_cursor.
+        Args:
+            cursor (str | None): The cursor received from the client, if any.
+        Returns:
+            int | None: The id to continue after, or None for the first page.
+            Raises an HTTPException with a 400 status code if the cursor is malformed.
+        """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+def paginate(records: list, limit: int) -> dict:
+    """
+        Builds a page response from records fetched with `limit + 1` rows.
+        Args:
+            records (list): The records ordered by id, at most one more than the page size.
+            limit (int): The requested page size.
+        Returns:
+            dict: The page items and the cursor of the next page, or None on the last page.
+        """
+    items = records[:limit]
+    next_cursor = encode_cursor(items[-1].id) if len(records) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def revision_page(rows: list, limit: int) -> dict:
+    """
+        Builds a page of blog revisions from rows fetched with `limit + 1` rows.
+        Args:
+            rows (list): The revisions, newest first, at most one more than the page size.
+            limit (int): The requested page size.
+        Returns:
+            dict: The page items and the cursor of the next page, or None on the last page.
+        """
+    items = [row._asdict() for row in rows[:limit]]
+    next_cursor = encode_cursor(items[-1]["revision"]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def encode_search_cursor(rank: float, last_id: int) -> str:
+    """
+        Encodes the rank and id of the last search result of a page into an opaque pagination cursor.
+        Args:
+            rank (float): The rank of the last result returned on the current page.
+            last_id (int): The id of the last result returned on the current page.
+        Returns:
+            str: A URL-safe cursor to pass back as the `after` query parameter.
+        """
+    return base64.urlsafe_b64encode(json.dumps([rank, last_id]).encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str | None) -> tuple | None:
+    """
+        Decodes a search pagination cursor produced by encode_search_cursor.
+        Args:
+            cursor (str | None): The cursor received from the client, if any.
+        Returns:
+            tuple | None: The (rank, id) to continue after, or None for the first page.
+            Raises an HTTPException with a 400 status code if the cursor is malformed.
+        """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        rank, last_id = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return float(rank), int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
+
+
+def search_page(rows: list, limit: int) -> dict:
+    """
+        Builds a search response from results fetched with `limit + 1` rows.
+        Args:
+            rows (list): The (id, topic, rank, snippet) rows ordered by rank, at most one more than the page size.
+            limit (int): The requested page size.
+        Returns:
+            dict: The page items and the cursor of the next page, or None on the last page.
+        """
+    items = [row._asdict() for row in rows[:limit]]
+    next_cursor = encode_search_cursor(items[-1]["rank"], items[-1]["id"]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def ndjson_lines(partitions):
+    """
+        Serializes batches of result rows as newline-delimited JSON, one chunk per batch.
+        Args:
+            partitions (Iterable[Sequence[Row]]): The row batches fetched from a server-side cursor.
+        Returns:
+            Iterator[str]: One NDJSON chunk per batch.
+        """
+    for rows in partitions:
+        yield "".join(json.dumps(row._asdict()) + "\n" for row in rows)
+
+
+async def async_ndjson_lines(partitions):
+    """
+        Async counterpart of ndjson_lines for partitions streamed from an AsyncSession.
+        Args:
+            partitions (AsyncIterable[Sequence[Row]]): The row batches fetched from a server-side cursor.
+        Returns:
+            AsyncIterator[str]: One NDJSON chunk per batch.
+        """
+    async for rows in partitions:
+        yield "".join(json.dumps(row._asdict()) + "\n" for row in rows)
+
+
+def blog_etag(blog_id: int, version: int) -> str:
+    """Strong ETag of a single blog, which changes whenever the blog is updated."""
+    return f'"{blog_id}-{version}"'
+
+
+def gzip_etag(etag: str) -> str:
+    """Strong ETag of the gzip-encoded representation, which must differ from that of the identity one."""
+    return f'{etag[:-1]}-gz"'
+
+
+def page_etag(rows, variant: str = "") -> str:
+    """
+        Strong ETag of a page of blogs, derived from the id and version of every row on it.
+        Args:
+            rows (Iterable): The rows of the page, each with an id and a version.
+            variant (str, optional): Distinguishes representations of the same rows, such as a field projection.
+        Returns:
+            str: The quoted entity tag.
+        """
+    rows_key = ",".join(f"{row.id}:{row.version}" for row in rows)
+    digest = hashlib.sha1(f"{variant}|{rows_key}".encode() if variant else rows_key.encode()).hexdigest()
+    return f'"{digest}"'
+
+
+BLOG_FIELDS = ("id", "topic", "data", "excerpt", "version", "updated_at")
+SUMMARY_FIELDS = ("id", "topic", "excerpt")
+
+
+def parse_blog_fields(fields: str | None, summary: bool = False) -> tuple | None:
+    """
+        Parses the `fields` query parameter of blog listings.
+        Args:
+            fields (str | None): Comma-separated blog fields to return.
+            summary (bool, optional): Shorthand for the id, topic and excerpt fields, used when fields is not given.
+        Returns:
+            tuple | None: The fields to select, or None for whole records.
+            Raises an HTTPException with a 400 status code if a field is unknown.
+        """
+    if not fields:
+        return SUMMARY_FIELDS if summary else None
+    names = tuple(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    unknown = [name for name in names if name not in BLOG_FIELDS]
+    if unknown or not names:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+def project(rows, fields: tuple) -> list:
+    """Keeps only the given fields of each row, as dicts."""
+    return [{name: getattr(row, name) for name in fields} for row in rows]
+
+
+def validator_headers(etag: str, last_modified: datetime) -> dict:
+    """
+        Builds the ETag and Last-Modified response headers.
+        Args:
+            etag (str): The quoted entity tag.
+            last_modified (datetime): The modification time, treated as UTC when naive.
+        Returns:
+            dict: The headers to set on the response.
+        """
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return {"ETag": etag, "Last-Modified": format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)}
+
+
+def is_conditional(request: Request) -> bool:
+    return "if-none-match" in request.headers or "if-modified-since" in request.headers
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None = None) -> bool:
+    """
+        Evaluates If-None-Match, or If-Modified-Since when no If-None-Match is sent (RFC 9110).
+        Args:
+            request (Request): The incoming request.
+            etag (str): The current entity tag.
+            last_modified (datetime | None, optional): The current modification time; None when the resource
+                has none, and If-Modified-Since is ignored.
+        Returns:
+            bool: True if the client's copy is current and a 304 can be returned.
+        """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # Weak comparison, as required for If-None-Match
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        # A copy in either encoding is current, and a 304 has no body to encode
+        return etag in candidates or gzip_etag(etag) in candidates
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    # HTTP dates have a resolution of one second
+    return last_modified.replace(microsecond=0) <= since
@@ -0,0 +1,100 @@
+"""Write-behind view counts for blogs.
+
+Reading a blog only increments a counter in this process's memory. A background thread adds the
+counts to blog_views every VIEW_FLUSH_INTERVAL seconds, in one statement for every blog read since
+the last flush, and in the same transaction updates popular_blogs, the POPULAR_BLOGS_SIZE most
+viewed blogs. Reads never write, and a hot blog costs one row update per flush and worker however
+often it is read. Counts live in a table of their own, so counting never rewrites a blog row (and
+its stored search vector). A crash loses at most one interval of counts; the counts of a failed
+flush are kept for the next one.
+"""
+
+import threading
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import crud
+from config import VIEW_FLUSH_INTERVAL, POPULAR_BLOGS_SIZE
+from db_connector import SessionLocal
+from log_config import logger
+
+
+class ViewCounter:
+    def __init__(self, session_factory=SessionLocal, interval=VIEW_FLUSH_INTERVAL, top_size=POPULAR_BLOGS_SIZE):
+        """
+            Creates a counter; call start() to flush it periodically on a background thread.
+            Args:
+                session_factory (Callable): Opens a new database session.
+                interval (float, optional): Seconds between two flushes.
+                top_size (int, optional): Blogs kept ranked in popular_blogs.
+            """
+        self.session_factory = session_factory
+        self.interval = interval
+        self.top_size = top_size
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, blog_id):
+        with self._lock:
+            self._counts[blog_id] = self._counts.get(blog_id, 0) + 1
+
+    @property
+    def pending(self):
+        """Blogs with views not flushed yet."""
+        return len(self._counts)
+
+    def flush(self):
+        """
+            Writes the buffered counts; on failure they are put back, to be written by the next flush.
+            Returns:
+                int: The number of blogs whose count was written.
+            """
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        if not counts:
+            return 0
+        db = self.session_factory()
+        try:
+            crud.flush_views(db, counts, self.top_size)
+        except Exception:
+            db.rollback()
+            with self._lock:
+                for blog_id, views in counts.items():
+                    self._counts[blog_id] = self._counts.get(blog_id, 0) + views
+            raise
+        finally:
+            db.close()
+        return len(counts)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="view-counter", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread after a last flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            stopping = self._stop.wait(self.interval)
+            try:
+                flushed = self.flush()
+                if flushed:
+                    logger.debug("Flushed the view counts of %d blogs", flushed)
+            except SQLAlchemyError as exc:
+                logger.warning("Flushing view counts failed (%s), retrying in %.1fs", exc, self.interval)
+            except Exception:
+                # Anything else must not end the thread, or views would pile up in memory from then on
+                logger.exception("Flushing view counts failed, retrying in %.1fs", self.interval)
+            if stopping:
+                break
+
+
+view_counter = ViewCounter()